@@ -0,0 +1,225 @@
+import argparse
+import time
+
+from pl import (
+    AstEvalContext, Ir, IterParser, Lexer, Parser, RegexLexer, Token, TokenKind,
+    ast_compile, ast_fold, ast_pycompile, compile_program, ir_compile, ir_eval, ir_run, py_run,
+)
+
+BENCH_PROGRAMS = {
+    'sum': """
+var i, s;
+begin
+    i := 0;
+    s := 0;
+    while i < 100000 do
+    begin
+        i := i + 1;
+        s := i * 2 - 1 + s
+    end
+end.
+""",
+    'fib': """
+var a, b, n, t;
+begin
+    n := 0;
+    while n < 20000 do
+    begin
+        a := 0;
+        b := 1;
+        t := 0;
+        while t < 5 do
+        begin
+            b := a + b;
+            a := b - a;
+            t := t + 1
+        end;
+        n := n + 1
+    end
+end.
+""",
+    'odd': """
+var i, c;
+begin
+    i := 0;
+    c := 0;
+    while i < 100000 do
+    begin
+        if odd i then c := c + 1;
+        i := i + 1
+    end
+end.
+""",
+    'calls': """
+var i, s;
+procedure add;
+    var k;
+    procedure twice;
+        begin k := k * 2 end;
+    begin
+        k := i;
+        call twice;
+        s := s + k - 1
+    end;
+begin
+    i := 0;
+    s := 0;
+    while i < 20000 do
+    begin
+        call add;
+        i := i + 1
+    end
+end.
+""",
+}
+
+
+def count_instructions(buf: list[Ir], nslots: int) -> int:
+    count = 0
+
+    def counted(handler):
+        def wrapper(sp, display, rstack):
+            nonlocal count
+            count += 1
+            return handler(sp, display, rstack)
+        return wrapper
+
+    ir_run([counted(h) for h in ir_compile(buf)], [None] * nslots)
+    return count
+
+
+def best_of(repeat: int, fn) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_dispatch(name: str, src: str, repeat: int):
+    buf, names = compile_program(src)
+    nslots = len(names)
+    count = count_instructions(buf, nslots)
+
+    t_eval = best_of(repeat, lambda: ir_eval(buf, [None] * nslots))
+    t_compile = best_of(repeat, lambda: ir_compile(buf))
+    code = ir_compile(buf)
+    t_run = best_of(repeat, lambda: ir_run(code, [None] * nslots))
+
+    print('%-6s %10d insts  eval %8.2f Minst/s  compiled %8.2f Minst/s  (x%.1f, compile %.3f ms)' % (
+        name,
+        count,
+        count / t_eval / 1e6,
+        count / t_run / 1e6,
+        t_eval / t_run,
+        t_compile * 1e3,
+    ))
+
+
+def bench_ast(name: str, src: str, repeat: int):
+    ast, _ = ast_fold(IterParser(RegexLexer(src)).program())
+    buf, names = compile_program(src)
+    nslots = len(ast.block.vars)
+    code = ast_pycompile(ast)
+
+    t_tree = best_of(repeat, lambda: ast.eval(AstEvalContext({}, {})))
+    t_eval = best_of(repeat, lambda: ir_eval(buf, [None] * len(names)))
+    t_closure = best_of(repeat, lambda: ast_compile(ast, [None] * nslots)())
+    t_python = best_of(repeat, lambda: py_run(code, [None] * nslots))
+    t_pycompile = best_of(repeat, lambda: ast_pycompile(ast))
+
+    print('%-6s Program.eval %8.1f ms  ir_eval %8.1f ms  closure %8.1f ms  python %8.1f ms  (pycompile %.3f ms)' % (
+        name,
+        t_tree * 1e3,
+        t_eval * 1e3,
+        t_closure * 1e3,
+        t_python * 1e3,
+        t_pycompile * 1e3,
+    ))
+
+
+def lex_source(size: int) -> str:
+    lines = ['var i, s, total_count;', 'begin', '    i := 0; s := 0;']
+    n = 0
+    total = sum(map(len, lines))
+    while total < size:
+        lines.append('    while i <= %d do begin s := (s + i * 3) / 2 - 17; i := i + 1 end;' % n)
+        lines.append('    if total_count # i then total_count := total_count - 1;')
+        total += len(lines[-1]) + len(lines[-2])
+        n += 1
+    lines.append('    !s')
+    lines.append('end.')
+    return '\n'.join(lines)
+
+
+def tokens(lexer: Lexer) -> list[Token]:
+    ret = []
+    while (tk := lexer.next()).ty != TokenKind.Eof:
+        ret.append(tk)
+    return ret
+
+
+def bench_lexer(mb: float, repeat: int):
+    src = lex_source(int(mb * (1 << 20)))
+    size = len(src) / (1 << 20)
+
+    assert tokens(Lexer(src)) == tokens(RegexLexer(src)), 'token streams differ'
+
+    for lexer in (Lexer, RegexLexer):
+        t = best_of(repeat, lambda: tokens(lexer(src)))
+        print('%-10s %6.2f MB  %8.2f MB/s' % (lexer.__name__, size, size / t))
+
+
+def counting(lexer: type[Lexer]) -> type[Lexer]:
+    class Counting(lexer):
+        calls = 0
+
+        def next(self) -> Token:
+            Counting.calls += 1
+            return super().next()
+
+    return Counting
+
+
+def bench_parser(mb: float, repeat: int):
+    src = lex_source(int(mb * (1 << 20)))
+    size = len(src) / (1 << 20)
+
+    for parser in (Parser, IterParser):
+        for lexer in (Lexer, RegexLexer):
+            ntokens = len(tokens(lexer(src))) + 1
+            lx = counting(lexer)
+            parser(lx(src)).program()
+            t = best_of(repeat, lambda: parser(lexer(src)).program())
+            print('%-10s %-10s %6.2f MB  %8.2f MB/s  %5.2f lexes/token' % (
+                parser.__name__, lexer.__name__, size, size / t, lx.calls / ntokens,
+            ))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('programs', nargs='*', help='one of %s, all if omitted' % ', '.join(BENCH_PROGRAMS))
+    ap.add_argument('--repeat', type=int, default=3)
+    ap.add_argument('--lexer', type=float, metavar='MB', help='measure lexer throughput on a generated source instead')
+    ap.add_argument('--ast', action='store_true', help='compare Program.eval, ir_eval, the closure engine and the python backend')
+    ap.add_argument('--parse', type=float, metavar='MB', help='measure lexer + parser throughput on a generated source instead')
+    args = ap.parse_args()
+
+    if args.parse is not None:
+        bench_parser(args.parse, args.repeat)
+        return
+
+    if args.lexer is not None:
+        bench_lexer(args.lexer, args.repeat)
+        return
+
+    for name in args.programs or BENCH_PROGRAMS:
+        if args.ast:
+            bench_ast(name, BENCH_PROGRAMS[name], args.repeat)
+        else:
+            bench_dispatch(name, BENCH_PROGRAMS[name], args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,43 @@
-import copy
+import argparse
+import atexit
+import bisect
+import collections
+import contextlib
+import hashlib
+import importlib.util
+import io
+import json
+import marshal
+import mmap
+import multiprocessing
+import os
+import re
 import string
+import struct
+import sys
+import tempfile
+import threading
+import time
+import types
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from enum import IntEnum
-from typing import NamedTuple
+from typing import BinaryIO, Callable, Iterable, Iterator, NamedTuple
 from PeachPy.peachpy import x86_64 as asm
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 编译结果缓存的版本号, 改了 IR 或编译流程要同步修改
+COMPILER_VERSION = 'pl0-ir-3'
+
 TEST_PROGRAM = """
 var a, b, n, t;
 begin
@@ -50,35 +84,42 @@ KEYWORD_SET = {
 class Token(NamedTuple):
     ty: TokenKind
     val: int | str
+    # 记号第一个字符的行号和列号, 从 1 开始; 0 表示未知
+    line: int = 0
+    col: int = 0
 
     @classmethod
-    def op(cls, op: str) -> 'Token':
-        return cls(ty=TokenKind.Op, val=op)
+    def op(cls, op: str, line: int = 0, col: int = 0) -> 'Token':
+        return cls(TokenKind.Op, op, line, col)
 
     @classmethod
-    def num(cls, num: int) -> 'Token':
-        return cls(ty=TokenKind.Num, val=num)
+    def num(cls, num: int, line: int = 0, col: int = 0) -> 'Token':
+        return cls(TokenKind.Num, num, line, col)
 
     @classmethod
-    def name(cls, name: str) -> 'Token':
-        return cls(ty=TokenKind.Name, val=name)
+    def name(cls, name: str, line: int = 0, col: int = 0) -> 'Token':
+        return cls(TokenKind.Name, name, line, col)
 
     @classmethod
-    def keyword(cls, keyword: str) -> 'Token':
-        return cls(ty=TokenKind.KeyWord, val=keyword)
+    def keyword(cls, keyword: str, line: int = 0, col: int = 0) -> 'Token':
+        return cls(TokenKind.KeyWord, keyword, line, col)
 
     @classmethod
-    def eof(cls) -> 'Token':
-        return cls(ty=TokenKind.Eof, val=0)
+    def eof(cls, line: int = 0, col: int = 0) -> 'Token':
+        return cls(TokenKind.Eof, 0, line, col)
 
 
 class Lexer:
     i: int
     s: str
+    line: int
+    bol: int # 当前行行首在 s 里的下标
 
     def __init__(self, src: str):
         self.i = 0
         self.s = src
+        self.line = 1
+        self.bol = 0
 
     @property
     def eof(self) -> bool:
@@ -86,20 +127,24 @@ class Lexer:
 
     def _skip_blank(self):
         while not self.eof and self.s[self.i].isspace():
+            if self.s[self.i] == '\n':
+                self.line += 1
+                self.bol = self.i + 1
             self.i += 1
 
     def next(self) -> Token:
         val = ''
         self._skip_blank()
+        line, col = self.line, self.i - self.bol + 1
 
         if self.eof:
-            return Token.eof()
+            return Token.eof(line, col)
 
         elif self.s[self.i].isdigit():
             while self.s[self.i].isdigit():
                 val += self.s[self.i]
                 self.i += 1
-            return Token.num(int(val))
+            return Token.num(int(val), line, col)
 
         elif self.s[self.i] in IDENT_FIRST:
             while self.s[self.i] in IDENT_REMAIN:
@@ -107,39 +152,311 @@ class Lexer:
                 self.i += 1
 
             if val in KEYWORD_SET:
-                return Token.keyword(val)
+                return Token.keyword(val, line, col)
             else:
-                return Token.name(val)
+                return Token.name(val, line, col)
 
         elif self.s[self.i] in '=#*+-/,;.()?!':
             ch = self.s[self.i]
             self.i += 1
-            return Token.op(ch)
+            return Token.op(ch, line, col)
 
         elif self.s[self.i] == ':':
             self.i += 1
             if self.eof or self.s[self.i] != '=':
                 raise SyntaxError(' "=" expected')
             self.i += 1
-            return Token.op(':=')
+            return Token.op(':=', line, col)
 
         elif self.s[self.i] in '<>':
             ch = self.s[self.i]
             self.i += 1
             if not self.eof and self.s[self.i] == '=':
                 self.i += 1
-                return Token.op(ch + '=')
+                return Token.op(ch + '=', line, col)
             else:
-                return Token.op(ch)
+                return Token.op(ch, line, col)
 
         else:
             raise SyntaxError("invaild charset " + repr(self.s[self.i]))
 
 
+_TOKEN_RE = re.compile(r"""
+    \s*
+    (?:
+        ([0-9]+)
+      | ([A-Za-z_][A-Za-z0-9_]*)
+      | (:=|<=|>=|[=#*+\-/,;.()?!<>])
+      | (\Z)
+    )
+""", re.VERBOSE)
+
+# 热路径上绕过 NamedTuple 的 __new__, 直接构造 Token
+_new_token = tuple.__new__
+
+
+class RegexLexer(Lexer):
+    nl: int # 下一个换行符的下标, 记号越过它时才更新行号
+
+    def __init__(self, src: str):
+        super().__init__(src)
+        self.nl = self._find_newline(0)
+
+    def _find_newline(self, i: int) -> int:
+        nl = self.s.find('\n', i)
+        return nl if nl >= 0 else sys.maxsize
+
+    def _newline(self, start: int):
+        while self.nl < start:
+            self.line += 1
+            self.bol = self.nl + 1
+            self.nl = self._find_newline(self.bol)
+
+    def next(self) -> Token:
+        m = _TOKEN_RE.match(self.s, self.i)
+        if m is None:
+            self._skip_blank()
+            if self.s[self.i] == ':':
+                raise SyntaxError(' "=" expected')
+            raise SyntaxError("invaild charset " + repr(self.s[self.i]))
+
+        self.i = m.end()
+        kind = m.lastindex
+        start = m.start(kind)
+        if start > self.nl:
+            self._newline(start)
+        line, col = self.line, start - self.bol + 1
+
+        if kind == 2:
+            val = m.group(2)
+            return _new_token(Token, (TokenKind.KeyWord if val in KEYWORD_SET else TokenKind.Name, val, line, col))
+        elif kind == 3:
+            return _new_token(Token, (TokenKind.Op, m.group(3), line, col))
+        elif kind == 1:
+            return _new_token(Token, (TokenKind.Num, int(m.group(1)), line, col))
+        else:
+            return Token(TokenKind.Eof, 0, line, col)
+
+
+_BTOKEN_RE = re.compile(_TOKEN_RE.pattern.encode(), re.VERBOSE)
+_BKEYWORDS = {kw.encode(): kw for kw in KEYWORD_SET}
+_BOPS = {op.encode(): op for op in [':=', '<=', '>=', *'=#*+-/,;.()?!<>']}
+
+
+class StreamLexer(Lexer):
+    # 从文件对象或 mmap 按块读 ASCII 字节, 只保留未消费的窗口
+    fp: BinaryIO | mmap.mmap
+    s: bytes
+    chunk: int
+    done: bool
+
+    def __init__(self, fp, chunk: int = 1 << 16):
+        self.i = 0
+        self.s = b''
+        self.line = 1
+        self.bol = 0
+        self.fp = fp
+        self.chunk = chunk
+        self.done = False
+
+    @property
+    def eof(self) -> bool:
+        return self.done and self.i >= len(self.s)
+
+    def _fill(self):
+        data = self.fp.read(self.chunk)
+        if not data:
+            self.done = True
+        self.s = self.s[self.i:] + data
+        # 行首下标跟着窗口平移, 可以是负数
+        self.bol -= self.i
+        self.i = 0
+
+    def next(self) -> Token:
+        while True:
+            m = _BTOKEN_RE.match(self.s, self.i)
+            # 记号可能跨块边界, 匹配到窗口末尾时先补数据再重试
+            if self.done or (m is not None and m.end() < len(self.s)):
+                break
+            if m is None and len(self.s[self.i:].lstrip()) > 1:
+                break
+            self._fill()
+
+        if m is None:
+            self.i = len(self.s) - len(self.s[self.i:].lstrip())
+            ch = chr(self.s[self.i])
+            if ch == ':':
+                raise SyntaxError(' "=" expected')
+            raise SyntaxError("invaild charset " + repr(ch))
+
+        s, i = self.s, self.i
+        self.i = m.end()
+        kind = m.lastindex
+        start = m.start(kind)
+        if start != i and (nl := s.count(b'\n', i, start)):
+            self.line += nl
+            self.bol = s.rindex(b'\n', i, start) + 1
+        line, col = self.line, start - self.bol + 1
+
+        if kind == 2:
+            val = m.group(2)
+            if val in _BKEYWORDS:
+                return Token(TokenKind.KeyWord, _BKEYWORDS[val], line, col)
+            return Token(TokenKind.Name, val.decode('ascii'), line, col)
+        elif kind == 3:
+            return Token(TokenKind.Op, _BOPS[m.group(3)], line, col)
+        elif kind == 1:
+            return Token(TokenKind.Num, int(m.group(1)), line, col)
+        else:
+            return Token(TokenKind.Eof, 0, line, col)
+
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+
+def int_wrap(val: int) -> int:
+    return (val - INT64_MIN) % (1 << 64) + INT64_MIN
+
+
+def int_trap(val: int) -> int:
+    raise RuntimeError('integer overflow')
+
+
+def int_div(v1: int, v2: int) -> int:
+    # 向零截断, 和 C 以及 IDIV 一致
+    if v2 == 0:
+        raise RuntimeError('division by zero')
+    q = abs(v1) // abs(v2)
+    return q if (v1 < 0) == (v2 < 0) else -q
+
+
+def _int_fix(overflow: Callable[[int], int]) -> Callable[[int], int]:
+    def fix(val: int) -> int:
+        if INT64_MIN <= val <= INT64_MAX:
+            return val
+        return overflow(val)
+    return fix
+
+
+# 整数语义, 值是规整运算结果的函数, 用 INT_MODES.get(ints) 取.
+# ints 为 None 时保持 Python 的语义, 除法得到 float; 其余都是向零截断的整数除法,
+# 结果超出 int64 时分别回绕, 报错, 或者保留 Python 大整数
+INT_MODES = {
+    'wrap': _int_fix(int_wrap),
+    'trap': _int_fix(int_trap),
+    'bigint': None,
+}
+
+
+class Pl0IO:
+    # ? 和 ! 的输入输出通道.
+    # input 是二进制流 (默认 sys.stdin.buffer) 或者整数的可迭代对象; 流在第一次读时整个读入,
+    # 按空白切分, 用到时才转成整数, 只有终端才一行一行地读.
+    # output 是二进制流 (默认 sys.stdout.buffer) 或者接受整数的函数 (比如 list.append);
+    # 写到流的输出先攒在 bytearray 里, 超过 limit 字节或者 flush 时才真正写出
+    input: 'BinaryIO | Iterable[int] | None'
+    output: 'BinaryIO | Callable[[int], object] | None'
+    limit: int
+
+    def __init__(self, input=None, output=None, limit: int = 1 << 16):
+        self.input = input
+        self.output = output
+        self.limit = limit
+        self.values = None
+        self.buf = bytearray()
+        self.sink = output if callable(output) else None
+
+    def _tokens(self, stream) -> Iterator:
+        if getattr(stream, 'isatty', lambda: False)():
+            # 终端上读之前先把提示之类的输出写出去
+            while True:
+                self.flush()
+                line = stream.readline()
+                if not line:
+                    return
+                yield from line.split()
+        data = stream.read()
+        for m in re.finditer(rb'\S+' if isinstance(data, bytes) else r'\S+', data):
+            yield m.group()
+
+    def read(self) -> int:
+        if self.values is None:
+            if self.input is None:
+                self.values = self._tokens(getattr(sys.stdin, 'buffer', sys.stdin))
+            elif hasattr(self.input, 'read'):
+                self.values = self._tokens(self.input)
+            else:
+                self.values = iter(self.input)
+        try:
+            return int(next(self.values))
+        except StopIteration:
+            raise EOFError('no more input') from None
+
+    def write(self, val: int | float):
+        if self.sink is not None:
+            self.sink(val)
+            return
+        # 旧的整数语义下除法得到 float, 按 print 的格式输出
+        self.buf += b'%d\n' % val if type(val) is int else b'%r\n' % val
+        if len(self.buf) >= self.limit:
+            self.flush()
+
+    def flush(self):
+        if not self.buf:
+            return
+        if self.output is not None:
+            self.output.write(self.buf)
+            self.output.flush()
+        elif hasattr(sys.stdout, 'buffer'):
+            sys.stdout.flush()
+            sys.stdout.buffer.write(self.buf)
+            sys.stdout.buffer.flush()
+        else:
+            sys.stdout.write(self.buf.decode())
+        self.buf.clear()
+
+
+# 当前的输入输出通道, 各个引擎执行 ? 和 ! 时都用它; 默认是标准输入输出, 退出时写出剩下的输出
+stdio = Pl0IO()
+pl0_io = stdio
+atexit.register(stdio.flush)
+
+
+@contextlib.contextmanager
+def io_channel(input=None, output=None, limit: int = 1 << 16):
+    # 执行期间换成给定的通道, 结束时写出剩下的输出
+    global pl0_io
+    saved = pl0_io
+    pl0_io = Pl0IO(input, output, limit)
+    try:
+        yield pl0_io
+    finally:
+        try:
+            pl0_io.flush()
+        finally:
+            pl0_io = saved
+
+
+class AstScope(collections.ChainMap):
+    # 嵌套作用域, 第一层是本层声明; 给外层已有的名字赋值时改外层, 不在本层新建
+    def __setitem__(self, key, value):
+        for scope in self.maps:
+            if key in scope:
+                scope[key] = value
+                return
+        self.maps[0][key] = value
+
+
+def _scope_local(scope: dict) -> dict:
+    return scope.maps[0] if isinstance(scope, AstScope) else scope
+
+
 class AstEvalContext(NamedTuple):
-    vars: dict[str, int | None]
-    procs: dict[str, 'Block | list[Ir]']
-    consts: dict[str, int]
+    # 变量和常量放在同一条作用域链里, 常量存成 Const, 按从内到外的顺序一起查找
+    vars: dict[str, 'int | Const | None']
+    procs: dict[str, 'Procedure | tuple[Procedure, AstEvalContext]']
+    ints: str | None = None
 
 
 class IrOpCode(IntEnum):
@@ -164,6 +481,16 @@ class IrOpCode(IntEnum):
     DefLit = 18
     DefProc = 19
     Call = 20
+    Ret = 21
+    Loc = 22 # 源码位置标记, 只在 ir_resolve 之前出现
+    IncVar = 30 # LoadVar a; LoadLit c; Add; Store a, args 是 (level, slot, 变量名), value 是 c
+    AddVarLit = 31 # LoadVar a; LoadLit c; Add
+    BrIfNotEq = 32 # 比较 + BrFalse
+    BrIfNotNe = 33
+    BrIfNotLt = 34
+    BrIfNotLte = 35
+    BrIfNotGt = 36
+    BrIfNotGte = 37
     Input = 100
     Output = 101
     Halt = 255
@@ -171,8 +498,8 @@ class IrOpCode(IntEnum):
 
 class Ir(NamedTuple):
     op: IrOpCode
-    args: str | int | None = None
-    value: list['Ir'] | int | None = None
+    args: str | int | tuple[int, int] | tuple[int, int, str] | None = None
+    value: 'list[Ir] | IrProc | int | str | None' = None
 
 
 class Factor(NamedTuple):
@@ -190,16 +517,18 @@ class Factor(NamedTuple):
 
     def eval(self, ctx: AstEvalContext) -> int | None:
         if isinstance(self.value, int):
+            if (fix := INT_MODES.get(ctx.ints)) is not None:
+                return fix(self.value)
             return self.value
         elif isinstance(self.value, str):
             if (key := self.value) in ctx.vars:
                 ret = ctx.vars[self.value]
                 if ret is None:
                     raise RuntimeError('variable %s referenced before initialize' % key)
+                elif isinstance(ret, Const):
+                    return ret.value
                 else:
                     return ret
-            elif self.value in ctx.consts:
-                return ctx.consts[self.value]
             else:
                 raise RuntimeError('undefined symbol: ' + self.value)
         elif isinstance(self.value, Expression):
@@ -230,6 +559,7 @@ class Term(NamedTuple):
     def eval(self, ctx: AstEvalContext) -> int | None:
         ret = self.lhs.eval(ctx)
         assert ret is not None, 'invalid expression lhs'
+        fix = INT_MODES.get(ctx.ints)
 
         for op, rhs in self.rhs:
             val = rhs.eval(ctx)
@@ -237,6 +567,8 @@ class Term(NamedTuple):
 
             if op == '*':
                 ret *= val
+            elif op == '/' and ctx.ints is not None:
+                ret = int_div(ret, val)
             elif op == '/':
                 if val == 0:
                     raise RuntimeError('division error')
@@ -244,6 +576,9 @@ class Term(NamedTuple):
             else:
                 raise RuntimeError('invalid expression operator')
 
+            if fix is not None:
+                ret = fix(ret)
+
         return ret
 
 
@@ -279,6 +614,9 @@ class Expression(NamedTuple):
 
         ret = self.lhs.eval(ctx) * sign
         assert ret is not None, 'invalid expression lhs'
+        fix = INT_MODES.get(ctx.ints)
+        if fix is not None:
+            ret = fix(ret)
 
         for op, rhs in self.rhs:
             val = rhs.eval(ctx)
@@ -291,6 +629,9 @@ class Expression(NamedTuple):
             else:
                 raise RuntimeError('invalid expression operator')
 
+            if fix is not None:
+                ret = fix(ret)
+
         return ret
 
 
@@ -308,7 +649,7 @@ class Assign(NamedTuple):
         buf.append(Ir(IrOpCode.Store, self.name))
 
     def eval(self, ctx: AstEvalContext) -> int | None:
-        if self.name not in ctx.vars:
+        if self.name not in ctx.vars or isinstance(ctx.vars[self.name], Const):
             raise RuntimeError('undefined variable: ' + self.name)
 
         val = self.expr.eval(ctx)
@@ -327,18 +668,9 @@ class Call(NamedTuple):
     def eval(self, ctx: AstEvalContext) -> int | None:
         if self.name not in ctx.procs:
             raise RuntimeError('call name not found')
-        proc = ctx.procs[self.name]
+        proc, scope = ctx.procs[self.name]
         assert isinstance(proc, Procedure), 'invalid proc'
-        return proc.eval(ctx)
-        # temp_ctx = copy.deepcopy(ctx)
-        # # 调用block
-        # block.eval(temp_ctx)
-        # # 更新ctx里的变量, 新的覆盖旧的
-        # for name, value in temp_ctx.vars:
-        #     if name in ctx.vars:
-        #         ctx.vars[name] = value
-        #
-        # return None
+        return proc.eval(scope)
 
 
 class InputOutput(NamedTuple):
@@ -355,9 +687,12 @@ class InputOutput(NamedTuple):
 
     def eval(self, ctx: AstEvalContext):
         if not self.is_input:
-            print(Factor(self.name).eval(ctx))
-        elif self.name in ctx.vars:
-            ctx.vars[self.name] = int(input())
+            pl0_io.write(Factor(self.name).eval(ctx))
+        elif self.name in ctx.vars and not isinstance(ctx.vars[self.name], Const):
+            val = pl0_io.read()
+            if (fix := INT_MODES.get(ctx.ints)) is not None:
+                val = fix(val)
+            ctx.vars[self.name] = val
             return None
         else:
             raise RuntimeError('undefined variable: ' + self.name)
@@ -365,6 +700,9 @@ class InputOutput(NamedTuple):
 
 class Statement(NamedTuple):
     stmt: any
+    # 语句第一个记号的位置
+    line: int = 0
+    col: int = 0
 
     def gen(self, buf: list[Ir]):
         self.stmt.gen(buf)
@@ -417,7 +755,7 @@ class StdCondition(NamedTuple):
             buf.append(Ir(IrOpCode.Lt))
         elif self.op == '<=':
             buf.append(Ir(IrOpCode.Lte))
-        elif self.op == '==':
+        elif self.op == '=':
             buf.append(Ir(IrOpCode.Eq))
         elif self.op == '#':
             buf.append(Ir(IrOpCode.Ne))
@@ -438,9 +776,9 @@ class StdCondition(NamedTuple):
             return 1 if lhs < rhs else 0
         elif self.op == '<=':
             return 1 if lhs <= rhs else 0
-        elif self.op == '==':
+        elif self.op == '=':
             return 1 if lhs == rhs else 0
-        elif self.op == '!=':
+        elif self.op == '#':
             return 1 if lhs != rhs else 0
         else:
             raise RuntimeError('invalid std condition operation ' + self.op)
@@ -502,15 +840,22 @@ class While(NamedTuple):
 class Procedure(NamedTuple):
     name: str
     body: 'Block'
+    # 过程名的位置
+    line: int = 0
+    col: int = 0
 
     def gen(self, buf: list[Ir]):
         self.body.gen(buf)
 
     def eval(self, ctx: AstEvalContext) -> int | None:
+        # ctx 是定义过程的那一层, 每次调用都在它下面开一层新的作用域, 递归调用各有各的局部变量
         if not isinstance(self.body, Block):
             raise RuntimeError('invalid procedure body.')
-        ctx.procs[self.name] = self.body
-        return None
+        return self.body.eval(AstEvalContext(
+            AstScope({}, ctx.vars),
+            AstScope({}, ctx.procs),
+            ctx.ints,
+        ))
 
 
 class Block(NamedTuple):
@@ -531,20 +876,24 @@ class Block(NamedTuple):
         self.stmt.gen(buf)
 
     def eval(self, ctx: AstEvalContext) -> int | None:
+        # 只和本层的声明冲突, 可以遮住外层的同名声明
+        vars = _scope_local(ctx.vars)
         for cc in self.consts:
-            if cc.name in ctx.consts:
+            if cc.name in vars:
                 raise RuntimeError('const redefinition ' + cc.name)
             else:
-                ctx.consts[cc.name] = cc.value
+                vars[cc.name] = cc
 
         for vv in self.vars:
-            if vv in ctx.vars or vv in ctx.consts:
+            if vv in vars:
                 raise RuntimeError('variable redefinition ' + vv)
             else:
-                ctx.vars[vv] = None
+                vars[vv] = None
 
+        # 过程记下定义它的这一层, 调用时按词法作用域查找变量
+        procs = _scope_local(ctx.procs)
         for pp in self.procs:
-            ctx.procs[pp.name] = pp
+            procs[pp.name] = (pp, ctx)
 
         self.stmt.eval(ctx)
         return None
@@ -558,27 +907,47 @@ class Program(NamedTuple):
         buf.append(Ir(IrOpCode.Halt))
 
     def eval(self, ctx: AstEvalContext) -> int | None:
-        return self.block.eval(ctx)
+        return _deep_call(self.block.eval, ctx)
+
+
+class TokenStream:
+    lx: Lexer
+    buf: collections.deque[Token]
+
+    def __init__(self, lx: Lexer):
+        self.lx = lx
+        self.buf = collections.deque()
+
+    def peek(self, k: int = 0) -> Token:
+        while len(self.buf) <= k:
+            self.buf.append(self.lx.next())
+        return self.buf[k]
+
+    def advance(self) -> Token:
+        if self.buf:
+            return self.buf.popleft()
+        return self.lx.next()
 
 
 class Parser:
     lx: Lexer
+    ts: TokenStream
 
     def __init__(self, lx: Lexer):
         self.lx = lx
+        self.ts = TokenStream(lx)
 
     def check(self, ty: TokenKind, val) -> bool:
-        p = self.lx.i
-        tk = self.lx.next()
+        tk = self.ts.peek()
 
         if tk.ty == ty and tk.val == val:
+            self.ts.advance()
             return True
 
-        self.lx.i = p
         return False
 
     def expect(self, ty: TokenKind, val: str | int | None = None):
-        tk = self.lx.next()
+        tk = self.ts.advance()
         tty, tval = tk.ty, tk.val
 
         if tty != ty:
@@ -613,13 +982,13 @@ class Parser:
     def const(self):
         ret = []
         while True:
-            ident = self.lx.next()
+            ident = self.ts.advance()
             name = ident.ty
             if name != TokenKind.Name:
                 raise SyntaxError('name expected')
 
             self.expect(TokenKind.Op, '=')
-            num = self.lx.next()
+            num = self.ts.advance()
 
             if num.ty != TokenKind.Num:
                 raise SyntaxError('num expected')
@@ -633,7 +1002,7 @@ class Parser:
     def var(self):
         ret = []
         while True:
-            name = self.lx.next()
+            name = self.ts.advance()
             ty = name.ty
             if ty != TokenKind.Name:
                 raise SyntaxError('name expected')
@@ -645,7 +1014,7 @@ class Parser:
                 self.expect(TokenKind.Op, ',')
 
     def procedure(self):
-        ident = self.lx.next()
+        ident = self.ts.advance()
         ty = ident.ty
         if ty != TokenKind.Name:
             raise SyntaxError('name expected')
@@ -657,15 +1026,18 @@ class Parser:
         if not self.check(TokenKind.Op, ';'):
             raise SyntaxError('";" expected')
 
-        return Procedure(ident.val, block)
+        return Procedure(ident.val, block, ident.line, ident.col)
 
     def statement(self):
+        first = self.ts.peek()
+        line, col = first.line, first.col
+
         if self.check(TokenKind.KeyWord, 'call'):
-            ident = self.lx.next()
+            ident = self.ts.advance()
             if ident.ty != TokenKind.Name:
                 raise SyntaxError('name expected')
             else:
-                return Statement(Call(ident))
+                return Statement(Call(ident.val), line, col)
 
         elif self.check(TokenKind.KeyWord, 'begin'):
             body = []
@@ -676,44 +1048,44 @@ class Parser:
                     break
                 else:
                     self.expect(TokenKind.Op, ';')
-            return Statement(Begin(body))
+            return Statement(Begin(body), line, col)
 
         elif self.check(TokenKind.KeyWord, 'if'):
             cond = self.condition()
             self.expect(TokenKind.KeyWord, 'then')
-            return Statement(If(cond, self.statement()))
+            return Statement(If(cond, self.statement()), line, col)
 
         elif self.check(TokenKind.KeyWord, 'while'):
             cond = self.condition()
             self.expect(TokenKind.KeyWord, 'do')
-            return Statement(While(cond, self.statement()))
+            return Statement(While(cond, self.statement()), line, col)
 
         elif self.check(TokenKind.Op, '?'):
-            name = self.lx.next()
+            name = self.ts.advance()
             ty = name.ty
 
             if ty != TokenKind.Name:
                 raise SyntaxError('name expected')
             else:
-                return Statement(InputOutput(name.val, True))
+                return Statement(InputOutput(name.val, True), line, col)
         elif self.check(TokenKind.Op, '!'):
-            name = self.lx.next()
+            name = self.ts.advance()
             ty = name.ty
 
             if ty != TokenKind.Name:
                 raise SyntaxError('name expected')
             else:
-                return Statement(InputOutput(name.val, False))
+                return Statement(InputOutput(name.val, False), line, col)
 
         else:
-            tk = self.lx.next()
+            tk = self.ts.advance()
             ty = tk.ty
 
             if ty != TokenKind.Name:
                 raise SyntaxError('name expected')
 
             self.expect(TokenKind.Op, ':=')
-            return Statement(Assign(tk.val, self.expression()))
+            return Statement(Assign(tk.val, self.expression()), line, col)
 
     def condition(self):
         if self.check(TokenKind.KeyWord, 'odd'):
@@ -726,7 +1098,7 @@ class Parser:
 
     def std_condition(self):
         lhs = self.expression()
-        cmp = self.lx.next()
+        cmp = self.ts.advance()
         if cmp.ty != TokenKind.Op:
             raise SyntaxError('op expected')
 
@@ -747,9 +1119,9 @@ class Parser:
         rhs = []
         while True:
             if self.check(TokenKind.Op, '+'):
-                rhs.append(('+', self.factor()))
+                rhs.append(('+', self.term()))
             elif self.check(TokenKind.Op, '-'):
-                rhs.append(('-', self.factor()))
+                rhs.append(('-', self.term()))
             else:
                 return Expression(mod, lhs, rhs)
 
@@ -758,14 +1130,14 @@ class Parser:
         lhs = self.factor()
         while True:
             if self.check(TokenKind.Op, '*'):
-                rhs.append(('*', self.term()))
+                rhs.append(('*', self.factor()))
             elif self.check(TokenKind.Op, '/'):
-                rhs.append(('/', self.term()))
+                rhs.append(('/', self.factor()))
             else:
                 return Term(lhs, rhs)
 
     def factor(self):
-        tk = self.lx.next()
+        tk = self.ts.advance()
         ty, val = tk.ty, tk.val
 
         if ty in {TokenKind.Num, TokenKind.Name}:
@@ -778,181 +1150,2853 @@ class Parser:
         return Factor(expr)
 
 
-def ir_eval(buf: list[Ir], ctx: AstEvalContext):
+def _build_expression(mod: str, items: list) -> Expression:
+    # items 是 [因子, 运算符, 因子, ...], 按优先级切成项
+    terms = []
+    term_ops = []
+    lhs, rhs = items[0], []
+    for op, factor in zip(items[1::2], items[2::2]):
+        if op in {'*', '/'}:
+            rhs.append((op, factor))
+        else:
+            terms.append(Term(lhs, rhs))
+            term_ops.append(op)
+            lhs, rhs = factor, []
+    terms.append(Term(lhs, rhs))
+    return Expression(mod, terms[0], list(zip(term_ops, terms[1:])))
+
+
+class IterParser(Parser):
+    # 用显式栈代替递归下降, 嵌套深度只受内存限制
+
+    def block(self):
+        # 外层块的 (consts, vars, procs, 正在解析的过程名记号)
+        stack = []
+        while True:
+            const = self.const() if self.check(TokenKind.KeyWord, 'const') else []
+            var = self.var() if self.check(TokenKind.KeyWord, 'var') else []
+            procs = []
+
+            while True:
+                if self.check(TokenKind.KeyWord, 'procedure'):
+                    ident = self.ts.advance()
+                    if ident.ty != TokenKind.Name:
+                        raise SyntaxError('name expected')
+                    if not self.check(TokenKind.Op, ';'):
+                        raise SyntaxError('";" expected')
+                    stack.append((const, var, procs, ident))
+                    break
+
+                block = Block(const, var, procs, self.statement())
+                if not stack:
+                    return block
+
+                const, var, procs, ident = stack.pop()
+                if not self.check(TokenKind.Op, ';'):
+                    raise SyntaxError('";" expected')
+                procs.append(Procedure(ident.val, block, ident.line, ident.col))
+
+    def statement(self):
+        # 未完成的外层语句: ('begin', body, 首记号) / ('if', cond, 首记号) / ('while', cond, 首记号)
+        stack = []
+        while True:
+            first = self.ts.peek()
+            if self.check(TokenKind.KeyWord, 'begin'):
+                stack.append(('begin', [], first))
+                continue
+            elif self.check(TokenKind.KeyWord, 'if'):
+                cond = self.condition()
+                self.expect(TokenKind.KeyWord, 'then')
+                stack.append(('if', cond, first))
+                continue
+            elif self.check(TokenKind.KeyWord, 'while'):
+                cond = self.condition()
+                self.expect(TokenKind.KeyWord, 'do')
+                stack.append(('while', cond, first))
+                continue
+
+            stmt = super().statement()
+
+            # 内层语句完成, 逐层向外收尾
+            while stack:
+                kind, val, first = stack[-1]
+                if kind == 'begin':
+                    val.append(stmt)
+                    if not self.check(TokenKind.KeyWord, 'end'):
+                        self.expect(TokenKind.Op, ';')
+                        break
+                    stmt = Statement(Begin(val), first.line, first.col)
+                elif kind == 'if':
+                    stmt = Statement(If(val, stmt), first.line, first.col)
+                else:
+                    stmt = Statement(While(val, stmt), first.line, first.col)
+                stack.pop()
+            else:
+                return stmt
+
+    def sign(self) -> str:
+        if self.check(TokenKind.Op, '+'):
+            return '+'
+        elif self.check(TokenKind.Op, '-'):
+            return '-'
+        return ''
+
+    def expression(self):
+        # 每层括号一帧: (符号, 已读的因子和运算符)
+        stack = []
+        mod, items = self.sign(), []
+        while True:
+            tk = self.ts.advance()
+            ty, val = tk.ty, tk.val
+
+            if ty == TokenKind.Op and val == '(':
+                stack.append((mod, items))
+                mod, items = self.sign(), []
+                continue
+            elif ty not in {TokenKind.Num, TokenKind.Name}:
+                raise SyntaxError('( need')
+            items.append(Factor(val))
+
+            while True:
+                tk = self.ts.peek()
+                if tk.ty == TokenKind.Op and tk.val in {'+', '-', '*', '/'}:
+                    items.append(self.ts.advance().val)
+                    break
+
+                expr = _build_expression(mod, items)
+                if not stack:
+                    return expr
+                self.expect(TokenKind.Op, ')')
+                mod, items = stack.pop()
+                items.append(Factor(expr))
+
+
+_BINARY_IR = {
+    '+': Ir(IrOpCode.Add),
+    '-': Ir(IrOpCode.Sub),
+    '*': Ir(IrOpCode.Mul),
+    '/': Ir(IrOpCode.Div),
+}
+
+_CMP_IR = {
+    '=': Ir(IrOpCode.Eq),
+    '#': Ir(IrOpCode.Ne),
+    '<': Ir(IrOpCode.Lt),
+    '<=': Ir(IrOpCode.Lte),
+    '>': Ir(IrOpCode.Gt),
+    '>=': Ir(IrOpCode.Gte),
+}
+
+
+def ast_gen(node, buf: list[Ir]):
+    # 与各节点的 gen 输出相同, 用显式栈代替递归.
+    # 栈里是待生成的节点, 现成的 Ir, 或者回填跳转的动作
+    bufs = [buf]
+    marks = []
+    locs = []
+    stack = [node]
+
+    while stack:
+        node = stack.pop()
+        buf = bufs[-1]
+
+        match node:
+            case Ir():
+                buf.append(node)
+
+            case 'mark':
+                marks.append(len(buf))
+            case 'branch':
+                marks.append(len(buf))
+                buf.append(Ir(IrOpCode.BrFalse))
+            case 'patch':
+                i = marks.pop()
+                buf[i] = Ir(IrOpCode.BrFalse, len(buf))
+            case 'loop':
+                j = marks.pop()
+                buf.append(Ir(IrOpCode.Jump, marks.pop()))
+                buf[j] = Ir(IrOpCode.BrFalse, len(buf))
+
+            case Program(block):
+                stack += [Ir(IrOpCode.Halt), block]
+
+            case Block(consts, vars, procs, stmt):
+                for cc in consts:
+                    buf.append(Ir(IrOpCode.DefLit, cc.name, cc.value))
+                for vv in vars:
+                    buf.append(Ir(IrOpCode.DefVar, vv))
+                stack.append(stmt)
+                # 过程体生成到单独的 buf, 结束时包成 DefProc
+                for pp in reversed(procs):
+                    stack += [('proc', pp.name), pp.body, 'enter']
+            case 'enter':
+                bufs.append([])
+
+            # 有位置的语句前后插入 Loc 标记, 语句结束后恢复外层的位置
+            case Statement(stmt, line, col) if line:
+                stack += ['unloc', stmt, ('loc', (line, col))]
+            case 'unloc':
+                locs.pop()
+                buf.append(Ir(IrOpCode.Loc, locs[-1] if locs else (0, 0)))
+
+            case Statement(stmt) | Condition(stmt) | Procedure(_, stmt):
+                stack.append(stmt)
+            case Begin(body):
+                stack += reversed(body)
+            case Assign(name, expr):
+                stack += [Ir(IrOpCode.Store, name), expr]
+            case Call(name):
+                buf.append(Ir(IrOpCode.Call, name))
+            case InputOutput(name, False):
+                buf += [Ir(IrOpCode.LoadVar, name), Ir(IrOpCode.Output)]
+            case InputOutput(name, True):
+                buf += [Ir(IrOpCode.Input), Ir(IrOpCode.Store, name)]
+            case If(cond, then):
+                stack += ['patch', then, 'branch', cond]
+            case While(cond, do):
+                stack += ['loop', do, 'branch', cond, 'mark']
+
+            case OddCondition(expr):
+                stack += [Ir(IrOpCode.Odd), expr]
+            case StdCondition(op, lhs, rhs):
+                if op not in _CMP_IR:
+                    raise RuntimeError('invalid std condition operation ' + op)
+                stack += [_CMP_IR[op], rhs, lhs]
+
+            case Expression(mod, lhs, rhs):
+                for op, term in reversed(rhs):
+                    if op not in {'+', '-'}:
+                        raise RuntimeError('invalid expression operator')
+                    stack += [_BINARY_IR[op], term]
+                if mod == '-':
+                    stack.append(Ir(IrOpCode.Neg))
+                elif mod not in {'+', ''}:
+                    raise RuntimeError('invalid expression sign ' + mod)
+                stack.append(lhs)
+            case Term(lhs, rhs):
+                for op, factor in reversed(rhs):
+                    if op not in {'*', '/'}:
+                        raise RuntimeError('invalid expression operator')
+                    stack += [_BINARY_IR[op], factor]
+                stack.append(lhs)
+
+            case Factor(int(val)):
+                buf.append(Ir(IrOpCode.LoadLit, val))
+            case Factor(str(val)):
+                buf.append(Ir(IrOpCode.LoadVar, val))
+            case Factor(Expression() as expr):
+                stack.append(expr)
+
+            # 放在最后, 免得和两个字段的节点 (比如 Assign('proc', ...)) 混淆
+            case ('proc', name):
+                bufs.pop()
+                bufs[-1].append(Ir(IrOpCode.DefProc, name, buf))
+            case ('loc', pos):
+                locs.append(pos)
+                buf.append(Ir(IrOpCode.Loc, pos))
+
+            case _:
+                raise RuntimeError('invalid ast node %r' % (node,))
+
+
+def _signed_terms(expr: Expression) -> list[tuple[int, Term]]:
+    if expr.mod == '-':
+        ret = [(-1, expr.lhs)]
+    elif expr.mod in {'+', ''}:
+        ret = [(1, expr.lhs)]
+    else:
+        raise RuntimeError('invalid expression sign ' + expr.mod)
+
+    for op, rhs in expr.rhs:
+        if op == '+':
+            ret.append((1, rhs))
+        elif op == '-':
+            ret.append((-1, rhs))
+        else:
+            raise RuntimeError('invalid expression operator')
+    return ret
+
+
+def _as_expression(val: int | Expression) -> Expression:
+    if isinstance(val, int):
+        return Expression('', Term(Factor(val), []), [])
+    return val
+
+
+def _fold_trapped(val: int, ints: str | None) -> bool:
+    # trap 语义下超出 int64 的常量不折叠, 留到运行时按原来的顺序报错
+    return ints == 'trap' and not INT64_MIN <= val <= INT64_MAX
+
+
+def _fold_factor(factor: Factor, consts: dict[str, int], inner: list, ints: str | None) -> int | Factor:
+    fix = INT_MODES.get(ints)
+    if isinstance(factor.value, int):
+        if _fold_trapped(factor.value, ints):
+            return factor
+        return factor.value if fix is None else fix(factor.value)
+    elif isinstance(factor.value, str):
+        val = consts.get(factor.value, factor)
+        if not isinstance(val, int) or _fold_trapped(val, ints):
+            return factor
+        return val if fix is None else fix(val)
+    elif isinstance(factor.value, Expression):
+        val, = inner
+        if isinstance(val, int):
+            return val
+        elif val.mod == '' and not val.rhs and not val.lhs.rhs:
+            return val.lhs.lhs
+        else:
+            return Factor(val)
+    else:
+        raise RuntimeError('invalid factor value')
+
+
+def _fold_term(term: Term, folded: list, ints: str | None) -> int | Term:
+    fix = INT_MODES.get(ints)
+    factors = list(zip(['*'] + [op for op, _ in term.rhs], folded))
+
+    # trap 语义下中间结果溢出就要报错, 保持原来的顺序和结合方式, 只合并开头连续的常量
+    if ints == 'trap':
+        head, i = folded[0], 1
+        while isinstance(head, int) and i < len(factors) and isinstance(factors[i][1], int):
+            op, val = factors[i]
+            if op == '/' and val == 0:
+                break
+            val = head * val if op == '*' else int_div(head, val)
+            if _fold_trapped(val, ints):
+                break
+            head, i = val, i + 1
+        if isinstance(head, int) and i == len(factors):
+            return head
+        factors = [(op, Factor(f) if isinstance(f, int) else f) for op, f in [('*', head)] + factors[i:]]
+        return Term(factors[0][1], factors[1:])
+
+    # 除法的结果依赖运算顺序, 只折叠操作数
+    if any(op == '/' for op, _ in factors):
+        factors = [(op, Factor(f) if isinstance(f, int) else f) for op, f in factors]
+        return Term(factors[0][1], factors[1:])
+
+    product = 1
+    rest = []
+    for op, f in factors:
+        if op != '*':
+            raise RuntimeError('invalid expression operator')
+        elif isinstance(f, int):
+            product *= f
+            if fix is not None:
+                product = fix(product)
+        else:
+            rest.append(f)
+
+    if not rest:
+        return product
+    elif product != 1:
+        rest.append(Factor(product))
+    return Term(rest[0], [('*', f) for f in rest[1:]])
+
+
+def _fold_expression(expr: Expression, folded: list, ints: str | None) -> int | Expression:
+    fix = INT_MODES.get(ints)
+    total = 0
+    terms = []
+
+    # 和 _fold_term 一样, trap 语义下不展开括号也不调整顺序, -(-x) 也要保留
+    if ints == 'trap':
+        signed = [(sign, Term(Factor(f), []) if isinstance(f, int) else f)
+                  for (sign, _), f in zip(_signed_terms(expr), folded)]
+        head, i = folded[0], 1
+        if isinstance(head, int) and not _fold_trapped(signed[0][0] * head, ints):
+            head = signed[0][0] * head
+            while i < len(signed) and isinstance(folded[i], int):
+                val = head + signed[i][0] * folded[i]
+                if _fold_trapped(val, ints):
+                    break
+                head, i = val, i + 1
+            if i == len(signed):
+                return head
+            signed[i - 1] = (1, Term(Factor(head), []))
+        return Expression(
+            '-' if signed[i - 1][0] < 0 else '',
+            signed[i - 1][1],
+            [('+' if sign > 0 else '-', term) for sign, term in signed[i:]],
+        )
+
+    for (sign, _), val in zip(_signed_terms(expr), folded):
+        if isinstance(val, int):
+            total += sign * val
+        elif not val.rhs and isinstance(val.lhs.value, Expression):
+            # 括号里的加减直接展开, -(-x) 在这里变成 x
+            for s2, t2 in _signed_terms(val.lhs.value):
+                if not t2.rhs and isinstance(t2.lhs.value, int):
+                    total += sign * s2 * t2.lhs.value
+                else:
+                    terms.append((sign * s2, t2))
+        else:
+            terms.append((sign, val))
+        if fix is not None:
+            total = fix(total)
+
+    if not terms:
+        return total
+    elif total == INT64_MIN and fix is not None:
+        # 取绝对值会超出 int64
+        terms.append((1, Term(Factor(total), [])))
+    elif total != 0:
+        terms.append((1 if total > 0 else -1, Term(Factor(abs(total)), [])))
+
+    # 正项放在前面, 省掉一条 Neg
+    terms.sort(key=lambda t: t[0] < 0)
+    return Expression(
+        '-' if terms[0][0] < 0 else '',
+        terms[0][1],
+        [('+' if sign > 0 else '-', term) for sign, term in terms[1:]],
+    )
+
+
+def _fold_condition(cond: Condition, folded: list) -> int | Condition:
+    if isinstance(cond.cond, OddCondition):
+        val, = folded
+        if isinstance(val, int):
+            return val & 1
+        return Condition(OddCondition(val))
+
+    lhs, rhs = folded
+    if isinstance(lhs, int) and isinstance(rhs, int):
+        return StdCondition(cond.cond.op, _as_expression(lhs), _as_expression(rhs)).eval(
+            AstEvalContext({}, {}),
+        )
+    return Condition(StdCondition(cond.cond.op, _as_expression(lhs), _as_expression(rhs)))
+
+
+def _fold_statement(stmt: Statement, folded: list) -> Statement:
+    node = stmt.stmt
+
+    if isinstance(node, Assign):
+        return stmt._replace(stmt=Assign(node.name, _as_expression(folded[0])))
+
+    elif isinstance(node, Begin):
+        return stmt._replace(stmt=Begin(folded))
+
+    elif isinstance(node, If):
+        cond, then = folded
+        if isinstance(cond, int):
+            return then if cond else stmt._replace(stmt=Begin([]))
+        return stmt._replace(stmt=If(cond, then))
+
+    elif isinstance(node, While):
+        cond, do = folded
+        if isinstance(cond, int) and not cond:
+            return stmt._replace(stmt=Begin([]))
+        elif isinstance(cond, int):
+            cond = node.cond
+        return stmt._replace(stmt=While(cond, do))
+
+    else:
+        return stmt
+
+
+def _fold_block(block: Block, folded: list) -> Block:
+    return Block(
+        block.consts,
+        block.vars,
+        [pp._replace(body=body) for pp, body in zip(block.procs, folded)],
+        folded[-1],
+    )
+
+
+def _fold_children(node, consts: dict[str, int]) -> tuple[dict[str, int], list]:
+    match node:
+        case Factor(Expression() as expr):
+            return consts, [expr]
+        case Term(lhs, rhs):
+            return consts, [lhs] + [f for _, f in rhs]
+        case Expression():
+            return consts, [t for _, t in _signed_terms(node)]
+        case Condition(OddCondition(expr)):
+            return consts, [expr]
+        case Condition(StdCondition(_, lhs, rhs)):
+            return consts, [lhs, rhs]
+        case Statement(Assign(_, expr)):
+            return consts, [expr]
+        case Statement(Begin(body)):
+            return consts, body
+        case Statement(If(cond, stmt) | While(cond, stmt)):
+            return consts, [cond, stmt]
+        case Block():
+            consts = {k: v for k, v in consts.items() if k not in node.vars}
+            consts.update((cc.name, cc.value) for cc in node.consts)
+            return consts, [pp.body for pp in node.procs] + [node.stmt]
+        case _:
+            return consts, []
+
+
+def _fold_node(node, consts: dict[str, int], folded: list, ints: str | None):
+    match node:
+        case Factor():
+            return _fold_factor(node, consts, folded, ints)
+        case Term():
+            return _fold_term(node, folded, ints)
+        case Expression():
+            return _fold_expression(node, folded, ints)
+        case Condition():
+            return _fold_condition(node, folded)
+        case Statement():
+            return _fold_statement(node, folded)
+        case Block():
+            return _fold_block(node, folded)
+        case _:
+            raise RuntimeError('invalid ast node %r' % (node,))
+
+
+def _fold(root, consts: dict[str, int], ints: str | None = None):
+    # 后序遍历, 子节点先折叠; 用显式栈, 嵌套深度不受递归限制
+    stack = [(root, consts, None)]
+    out = []
+    while stack:
+        node, consts, n = stack.pop()
+        if n is None:
+            inner, children = _fold_children(node, consts)
+            stack.append((node, consts, len(children)))
+            stack += [(child, inner, None) for child in reversed(children)]
+        else:
+            folded = out[len(out) - n:]
+            del out[len(out) - n:]
+            out.append(_fold_node(node, consts, folded, ints))
+    return out[0]
+
+
+def ast_fold(program: Program, ints: str | None = None) -> tuple[Program, int]:
+    before = []
+    after = []
+    ret = Program(_fold(program.block, {}, ints))
+
+    ast_gen(program, before)
+    ast_gen(ret, after)
+    return ret, _ir_size(before) - _ir_size(after)
+
+
+def _ir_size(buf: list[Ir]) -> int:
+    n = 0
+    stack = [buf]
+    while stack:
+        for ir in stack.pop():
+            if ir.op == IrOpCode.DefProc:
+                stack.append(ir.value)
+            elif ir.op != IrOpCode.Loc:
+                n += 1
+    return n
+
+
+class IrProc(NamedTuple):
+    name: str
+    level: int
+    size: int
+
+
+class SourceMap:
+    # IR 序号到源码位置的对照表, 按区间压缩: 从 starts[k] 起的指令都来自 (lines[k], cols[k]);
+    # 行号 0 表示没有对应的源码
+    starts: array
+    lines: array
+    cols: array
+
+    def __init__(self):
+        self.starts = array('l')
+        self.lines = array('l')
+        self.cols = array('l')
+
+    def mark(self, pc: int, line: int, col: int):
+        if self.starts and self.lines[-1] == line and self.cols[-1] == col:
+            return
+        self.starts.append(pc)
+        self.lines.append(line)
+        self.cols.append(col)
+
+    def lookup(self, pc: int) -> tuple[int, int]:
+        k = bisect.bisect_right(self.starts, pc) - 1
+        if k < 0:
+            return 0, 0
+        return self.lines[k], self.cols[k]
+
+    def line_table(self, n: int) -> list[int]:
+        ret = []
+        for k, start in enumerate(self.starts):
+            end = self.starts[k + 1] if k + 1 < len(self.starts) else n
+            ret += [self.lines[k]] * (min(end, n) - len(ret))
+        return ret + [0] * (n - len(ret))
+
+    def remap(self, origin: list[int]):
+        # origin[i] 是新指令 i 在原来 IR 里的序号
+        positions = [self.lookup(i) for i in origin]
+        self.__init__()
+        for pc, (line, col) in enumerate(positions):
+            self.mark(pc, line, col)
+
+
+def ir_resolve(buf: list[Ir], srcmap: SourceMap | None = None) -> tuple[list[Ir], list[str]]:
+    ret = []
+    names = []
+    pending = collections.deque()
+    calls = []
+
+    def lookup(scopes: list[dict], name: str) -> tuple[IrOpCode, any]:
+        for scope in reversed(scopes):
+            if name in scope:
+                return scope[name]
+        raise RuntimeError('undefined symbol: ' + name)
+
+    def resolve(body: list[Ir], scopes: list[dict], level: int) -> int:
+        scope = {}
+        size = 0
+
+        # 先登记本层所有声明, 过程体里可以引用同层后面定义的过程
+        for ir in body:
+            if ir.op not in {IrOpCode.DefVar, IrOpCode.DefLit, IrOpCode.DefProc}:
+                continue
+            elif not isinstance(ir.args, str):
+                raise RuntimeError('invalid declaration args')
+            elif ir.args in scope:
+                raise RuntimeError('variable redeclared: ' + ir.args)
+            elif ir.op == IrOpCode.DefVar:
+                scope[ir.args] = (ir.op, (level, size))
+                size += 1
+                if level == 0:
+                    names.append(ir.args)
+            elif ir.op == IrOpCode.DefLit:
+                if not isinstance(ir.value, int):
+                    raise RuntimeError('invalid deflit args')
+                scope[ir.args] = (ir.op, ir.value)
+            else:
+                if not isinstance(ir.value, list):
+                    raise RuntimeError('invalid defproc args')
+                proc = {'name': ir.args}
+                scope[ir.args] = (ir.op, proc)
+                pending.append((ir.value, scopes + [scope], level + 1, proc))
+
+        scopes = scopes + [scope]
+
+        # 声明被删掉之后, 跳转目标需要重新映射
+        remap = []
+        n = len(ret)
+        for ir in body:
+            remap.append(n)
+            if ir.op not in {IrOpCode.DefVar, IrOpCode.DefLit, IrOpCode.DefProc, IrOpCode.Loc}:
+                n += 1
+        remap.append(n)
+
+        pos = (0, 0)
+        for ir in body:
+            if ir.op == IrOpCode.Loc:
+                pos = ir.args
+                continue
+            elif ir.op in {IrOpCode.DefVar, IrOpCode.DefLit, IrOpCode.DefProc}:
+                continue
+            elif srcmap is not None:
+                srcmap.mark(len(ret), *pos)
+
+            if ir.op == IrOpCode.LoadVar:
+                kind, val = lookup(scopes, ir.args)
+                if kind == IrOpCode.DefLit:
+                    ret.append(Ir(IrOpCode.LoadLit, val))
+                elif kind == IrOpCode.DefVar:
+                    ret.append(Ir(IrOpCode.LoadVar, val, ir.args))
+                else:
+                    raise RuntimeError('invalid loadvar args')
+
+            elif ir.op == IrOpCode.Store:
+                kind, val = lookup(scopes, ir.args)
+                if kind != IrOpCode.DefVar:
+                    raise RuntimeError('undefined variable: ' + ir.args)
+                ret.append(Ir(IrOpCode.Store, val, ir.args))
+
+            elif ir.op == IrOpCode.Call:
+                kind, val = lookup(scopes, ir.args)
+                if kind != IrOpCode.DefProc:
+                    raise RuntimeError('procedure called not existed.')
+                calls.append((len(ret), val))
+                ret.append(Ir(IrOpCode.Call))
+
+            elif ir.op in {IrOpCode.Jump, IrOpCode.BrFalse}:
+                if not isinstance(ir.args, int) or not (0 <= ir.args <= len(body)):
+                    raise RuntimeError('branch out of bounds')
+                ret.append(Ir(ir.op, remap[ir.args]))
+
+            else:
+                ret.append(ir)
+
+        return size
+
+    # 主程序在前, 以 Halt 结束, 过程体依次排在后面, 以 Ret 结束
+    resolve(buf, [], 0)
+    if not ret or ret[-1].op != IrOpCode.Halt:
+        if srcmap is not None:
+            srcmap.mark(len(ret), 0, 0)
+        ret.append(Ir(IrOpCode.Halt))
+
+    while pending:
+        body, scopes, level, proc = pending.popleft()
+        proc['entry'] = len(ret)
+        proc['proc'] = IrProc(proc['name'], level, resolve(body, scopes, level))
+        if srcmap is not None:
+            srcmap.mark(len(ret), 0, 0)
+        ret.append(Ir(IrOpCode.Ret))
+
+    for i, proc in calls:
+        ret[i] = Ir(IrOpCode.Call, proc['entry'], proc['proc'])
+
+    return ret, names
+
+
+_FUSED_BRANCH = {
+    IrOpCode.Eq: IrOpCode.BrIfNotEq,
+    IrOpCode.Ne: IrOpCode.BrIfNotNe,
+    IrOpCode.Lt: IrOpCode.BrIfNotLt,
+    IrOpCode.Lte: IrOpCode.BrIfNotLte,
+    IrOpCode.Gt: IrOpCode.BrIfNotGt,
+    IrOpCode.Gte: IrOpCode.BrIfNotGte,
+}
+
+IR_BRANCHES = {IrOpCode.Jump, IrOpCode.BrFalse, IrOpCode.Call, *_FUSED_BRANCH.values()}
+
+
+def _peephole_match(buf: list[Ir], i: int, targets: set[int]) -> tuple[Ir, int]:
+    ops = [ir.op for ir in buf[i:i + 4]]
+
+    # 窗口内部不能有跳转目标
+    def fusable(n: int) -> bool:
+        return len(ops) >= n and not any(j in targets for j in range(i + 1, i + n))
+
+    if ops[:3] in ([IrOpCode.LoadVar, IrOpCode.LoadLit, IrOpCode.Add], [IrOpCode.LoadVar, IrOpCode.LoadLit, IrOpCode.Sub]):
+        var, lit = buf[i], buf[i + 1].args
+        if ops[2] == IrOpCode.Sub:
+            lit = -lit
+
+        if fusable(4) and ops[3] == IrOpCode.Store and buf[i + 3].args == var.args:
+            return Ir(IrOpCode.IncVar, (*var.args, var.value), lit), 4
+        elif fusable(3):
+            return Ir(IrOpCode.AddVarLit, (*var.args, var.value), lit), 3
+
+    elif ops[:4] == [IrOpCode.LoadLit, IrOpCode.LoadVar, IrOpCode.Add, IrOpCode.Store]:
+        if fusable(4) and buf[i + 3].args == buf[i + 1].args:
+            var = buf[i + 1]
+            return Ir(IrOpCode.IncVar, (*var.args, var.value), buf[i].args), 4
+
+    elif ops[0] in _FUSED_BRANCH and ops[1:2] == [IrOpCode.BrFalse] and fusable(2):
+        return Ir(_FUSED_BRANCH[ops[0]], buf[i + 1].args), 2
+
+    return buf[i], 1
+
+
+def ir_peephole(buf: list[Ir], srcmap: SourceMap | None = None) -> list[Ir]:
+    targets = {ir.args for ir in buf if ir.op in IR_BRANCHES}
+
+    ret = []
+    remap = {}
+    i = 0
+    while i < len(buf):
+        remap[i] = len(ret)
+        ir, n = _peephole_match(buf, i, targets)
+        ret.append(ir)
+        i += n
+    remap[len(buf)] = len(ret)
+
+    for i, ir in enumerate(ret):
+        if ir.op in IR_BRANCHES:
+            ret[i] = ir._replace(args=remap[ir.args])
+
+    # 合并后的指令沿用窗口里第一条的位置
+    if srcmap is not None:
+        srcmap.remap(list(remap)[:len(ret)])
+    return ret
+
+
+def compile_program(src: str, fold: bool = True, peephole: bool = True,
+                    lexer: type[Lexer] = RegexLexer, ints: str | None = None,
+                    srcmap: SourceMap | None = None) -> tuple[list[Ir], list[str]]:
+    ast = IterParser(lexer(src)).program()
+    if fold:
+        ast, _ = ast_fold(ast, ints)
+
+    buf = []
+    ast_gen(ast, buf)
+    buf, names = ir_resolve(buf, srcmap)
+    if peephole:
+        buf = ir_peephole(buf, srcmap)
+    return buf, names
+
+
+def ir_dump(buf: list[Ir], names: list[str]) -> bytes:
+    code = []
+    for ir in buf:
+        value = tuple(ir.value) if isinstance(ir.value, IrProc) else ir.value
+        code.append((int(ir.op), ir.args, value))
+    return marshal.dumps((names, code))
+
+
+def ir_load(data: bytes) -> tuple[list[Ir], list[str]]:
+    names, code = marshal.loads(data)
+    buf = []
+    for op, args, value in code:
+        if isinstance(value, tuple):
+            value = IrProc(*value)
+        buf.append(Ir(IrOpCode(op), args, value))
+    return buf, names
+
+
+class ProgramCache:
+    root: str
+    max_bytes: int
+
+    MAGIC = b'PL0C'
+    HEADER = struct.Struct('<4sQQ')
+    SUFFIX = '.pl0c'
+
+    def __init__(self, root: str, max_bytes: int = 64 << 20):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, src: str, fold: bool = True, peephole: bool = True, target: bytes = b'',
+            ints: str | None = None) -> str:
+        h = hashlib.sha256(COMPILER_VERSION.encode())
+        h.update(b'%d%d' % (fold, peephole))
+        if ints is not None:
+            # 折叠出的常量和生成的 python 代码都依赖整数语义
+            h.update(b'ints=%s;' % ints.encode())
+        h.update(target)
+        h.update(src.encode())
+        return h.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key + self.SUFFIX)
+
+    def get(self, key: str) -> tuple[list[Ir], list[str], bytes | None] | None:
+        try:
+            with open(self.path(key), 'rb') as fp:
+                with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    magic, nir, nnative = self.HEADER.unpack_from(mm)
+                    if magic != self.MAGIC or self.HEADER.size + nir + nnative != len(mm):
+                        return None
+
+                    with memoryview(mm) as view:
+                        buf, names = ir_load(view[self.HEADER.size:self.HEADER.size + nir])
+                    native = mm[self.HEADER.size + nir:] if nnative else None
+        except (OSError, ValueError, EOFError, TypeError, struct.error):
+            return None
+
+        # mtime 作为 LRU 的时间戳
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            pass
+        return buf, names, native
+
+    def put(self, key: str, buf: list[Ir], names: list[str], native: bytes | None = None):
+        data = ir_dump(buf, names)
+        native = native or b''
+
+        # 先写临时文件再 rename, 其他进程不会读到写了一半的文件
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(self.HEADER.pack(self.MAGIC, len(data), len(native)))
+                fp.write(data)
+                fp.write(native)
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        with self._lock():
+            entries = []
+            total = 0
+            for entry in os.scandir(self.root):
+                if not entry.name.endswith(self.SUFFIX):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                total -= size
+
+    @contextlib.contextmanager
+    def _lock(self):
+        with open(os.path.join(self.root, '.lock'), 'wb') as fp:
+            if fcntl is not None:
+                fcntl.flock(fp, fcntl.LOCK_EX)
+            yield
+
+    def compile(self, src: str, fold: bool = True, peephole: bool = True,
+                ints: str | None = None) -> tuple[list[Ir], list[str]]:
+        key = self.key(src, fold, peephole, ints=ints)
+        if (hit := self.get(key)) is not None:
+            return hit[0], hit[1]
+
+        buf, names = compile_program(src, fold, peephole, ints=ints)
+        self.put(key, buf, names)
+        return buf, names
+
+    def compile_python(self, src: str, fold: bool = True, ints: str | None = None) -> tuple[types.CodeType, list[str]]:
+        # code object 用 marshal 存在 native 段, 格式跟着解释器版本走
+        key = self.key(src, fold, False, b'py' + importlib.util.MAGIC_NUMBER, ints)
+        if (hit := self.get(key)) is not None and hit[2] is not None:
+            try:
+                return marshal.loads(hit[2]), hit[1]
+            except (ValueError, EOFError, TypeError):
+                pass
+
+        ast = IterParser(RegexLexer(src)).program()
+        if fold:
+            ast, _ = ast_fold(ast, ints)
+        code = ast_pycompile(ast, ints)
+        self.put(key, [], ast.block.vars, marshal.dumps(code))
+        return code, ast.block.vars
+
+
+class Bytecode(NamedTuple):
+    code: array         # 每条指令 4 个 int32: op, a, b, c
+    consts: list[int]
+    names: list[str]    # 前 nglobals 个是主程序变量, 按 slot 排列
+    nglobals: int
+    procs: dict[int, int]  # 过程入口 -> 名字在 names 里的下标
+    fused: dict[int, int]  # IncVar/AddVarLit 的位置 -> 变量名在 names 里的下标, 只在报错时用
+
+
+BC_WIDTH = 4
+BC_MAGIC = b'PL0B'
+
+
+def bc_encode(buf: list[Ir], names: list[str]) -> Bytecode:
+    code = array('i')
+    consts = []
+    constmap = {}
+    pool = list(names)
+    namemap = {}
+    procs = {}
+    fused = {}
+
+    def const(val: int) -> int:
+        if val not in constmap:
+            constmap[val] = len(consts)
+            consts.append(val)
+        return constmap[val]
+
+    def name(val: str) -> int:
+        if val not in namemap:
+            namemap[val] = len(pool)
+            pool.append(val)
+        return namemap[val]
+
+    for i, ir in enumerate(buf):
+        a = b = c = 0
+        match ir.op:
+            case IrOpCode.LoadVar | IrOpCode.Store:
+                (a, b), c = ir.args, name(ir.value)
+            case IrOpCode.IncVar | IrOpCode.AddVarLit:
+                (a, b, var), c = ir.args, const(ir.value)
+                fused[i] = name(var)
+            case IrOpCode.LoadLit:
+                a = const(ir.args)
+            case IrOpCode.Call:
+                a, b, c = ir.args, ir.value.level, ir.value.size
+                procs[ir.args] = name(ir.value.name)
+            case IrOpCode.DefVar | IrOpCode.DefLit | IrOpCode.DefProc:
+                raise RuntimeError('unresolved ir, run ir_resolve first')
+            case _ if ir.op in IR_BRANCHES:
+                a = ir.args
+        code.extend((ir.op, a, b, c))
+
+    return Bytecode(code, consts, pool, len(names), procs, fused)
+
+
+def bc_decode(bc: Bytecode) -> tuple[list[Ir], list[str]]:
+    buf = []
+    code = bc.code
+
+    for i in range(0, len(code), BC_WIDTH):
+        op, a, b, c = IrOpCode(code[i]), code[i + 1], code[i + 2], code[i + 3]
+        match op:
+            case IrOpCode.LoadVar | IrOpCode.Store:
+                buf.append(Ir(op, (a, b), bc.names[c]))
+            case IrOpCode.IncVar | IrOpCode.AddVarLit:
+                buf.append(Ir(op, (a, b, bc.names[bc.fused[i // BC_WIDTH]]), bc.consts[c]))
+            case IrOpCode.LoadLit:
+                buf.append(Ir(op, bc.consts[a]))
+            case IrOpCode.Call:
+                buf.append(Ir(op, a, IrProc(bc.names[bc.procs[a]], b, c)))
+            case _ if op in IR_BRANCHES:
+                buf.append(Ir(op, a))
+            case _:
+                buf.append(Ir(op))
+
+    return buf, bc.names[:bc.nglobals]
+
+
+def bc_dumps(bc: Bytecode) -> bytes:
+    pools = marshal.dumps((bc.consts, bc.names, bc.nglobals, bc.procs, bc.fused))
+    return BC_MAGIC + struct.pack('<QQ', len(bc.code), len(pools)) + bc.code.tobytes() + pools
+
+
+def _bc_check_frames(code: array, nglobals: int):
+    # 从主程序出发沿 Call 找出会执行的过程体, 过程的层次和帧大小由调用它的 Call 给出.
+    # 本层变量按自己的帧大小检查, 外层变量按所有可能在 display 里的外层过程的帧大小检查
+    n = len(code) // BC_WIDTH
+    frames = {0: (0, nglobals)}
+    calls = {}
+    outer = {}
+    pending = [0]
+    while pending:
+        entry = pending.pop()
+        level, size = frames[entry]
+        end = next((i for i in range(entry, n) if code[i * BC_WIDTH] in {IrOpCode.Ret, IrOpCode.Halt}), n)
+        if end == n or code[end * BC_WIDTH] != (IrOpCode.Halt if entry == 0 else IrOpCode.Ret):
+            raise ValueError('invalid procedure body')
+
+        calls[entry] = set()
+        outer[entry] = []
+        for i in range(entry * BC_WIDTH, (end + 1) * BC_WIDTH, BC_WIDTH):
+            op, a, b, c = code[i:i + BC_WIDTH]
+            if op == IrOpCode.Call:
+                if not (1 <= b <= level + 1) or c < 0:
+                    raise ValueError('invalid call frame')
+                elif a not in frames:
+                    frames[a] = (b, c)
+                    pending.append(a)
+                elif frames[a] != (b, c):
+                    raise ValueError('invalid call frame')
+                calls[entry].add(a)
+            elif op in IR_BRANCHES and not (entry <= a <= end):
+                raise ValueError('branch out of bounds')
+            elif op in {IrOpCode.LoadVar, IrOpCode.Store, IrOpCode.IncVar, IrOpCode.AddVarLit}:
+                if not (0 <= a <= level) or b < 0:
+                    raise ValueError('invalid variable level')
+                elif a == level and b >= size or a == 0 and b >= nglobals:
+                    raise ValueError('invalid variable slot')
+                elif 0 < a < level:
+                    outer[entry].append((a, b))
+
+    # 过程 P 之后只经过更内层的过程调到的过程体, 执行时 display[P 的层次] 可能是 P 的帧
+    limits = {}
+    for entry, (level, size) in frames.items():
+        seen = {entry}
+        stack = [entry]
+        while stack:
+            for callee in calls[stack.pop()]:
+                if callee not in seen and frames[callee][0] > level:
+                    seen.add(callee)
+                    stack.append(callee)
+                    limits[callee, level] = min(limits.get((callee, level), size), size)
+
+    for entry, accesses in outer.items():
+        for level, slot in accesses:
+            if slot >= limits.get((entry, level), 0):
+                raise ValueError('invalid variable slot')
+
+
+def bc_loads(data: bytes) -> Bytecode:
+    if data[:4] != BC_MAGIC:
+        raise ValueError('invalid bytecode magic')
+
+    ncode, npools = struct.unpack_from('<QQ', data, 4)
+    base = 4 + 16
+    code = array('i')
+    code.frombytes(data[base:base + ncode * code.itemsize])
+    if len(code) != ncode or ncode % BC_WIDTH:
+        raise ValueError('truncated bytecode')
+    consts, names, nglobals, procs, fused = marshal.loads(data[base + ncode * code.itemsize:base + ncode * code.itemsize + npools])
+    bc = Bytecode(code, consts, names, nglobals, procs, fused)
+
+    # 从外部读进来的字节码先检查一遍, bc_eval 里就不用再检查
+    n = len(code) // BC_WIDTH
+    for i in range(0, len(code), BC_WIDTH):
+        op, a, b, c = code[i:i + BC_WIDTH]
+        if op not in IrOpCode._value2member_map_:
+            raise ValueError('invalid opcode %d' % op)
+        elif op in IR_BRANCHES and not (0 <= a <= n):
+            raise ValueError('branch out of bounds')
+        elif op == IrOpCode.LoadLit and not (0 <= a < len(consts)):
+            raise ValueError('invalid constant index')
+        elif op in {IrOpCode.IncVar, IrOpCode.AddVarLit} and not (0 <= c < len(consts)):
+            raise ValueError('invalid constant index')
+        elif op in {IrOpCode.IncVar, IrOpCode.AddVarLit} and not (0 <= fused.get(i // BC_WIDTH, -1) < len(names)):
+            raise ValueError('invalid name index')
+        elif op in {IrOpCode.LoadVar, IrOpCode.Store} and not (0 <= c < len(names)):
+            raise ValueError('invalid name index')
+        elif op == IrOpCode.Call and a not in procs:
+            raise ValueError('invalid procedure entry')
+    _bc_check_frames(code, nglobals)
+    return bc
+
+
+def _ir_fix_literals(buf: list[Ir], fix: Callable[[int], int]) -> list[Ir]:
+    # 字面量先按整数语义规整, 运行时只需要检查运算结果
+    ret = []
+    for ir in buf:
+        if ir.op == IrOpCode.LoadLit:
+            ir = ir._replace(args=fix(ir.args))
+        elif ir.op in {IrOpCode.IncVar, IrOpCode.AddVarLit}:
+            ir = ir._replace(value=fix(ir.value))
+        ret.append(ir)
+    return ret
+
+
+def ir_eval(buf: list[Ir] | Bytecode, slots: list[int | None], ints: str | None = None):
+    if isinstance(buf, Bytecode):
+        return bc_eval(buf, slots, ints)
+
+    fix = INT_MODES.get(ints)
+    if fix is not None:
+        buf = _ir_fix_literals(buf, fix)
+
+    # 操作码先换成普通 int 放进局部变量: IntEnum 的属性查找和比较在热循环里很慢
+    code = [(int(ir.op), ir.args, ir.value) for ir in buf]
+    n = len(code)
     pc = 0
     sp = []
-
-    while pc < len(buf):
-        ir = buf[pc]
+    push, pop = sp.append, sp.pop
+    display = [slots]
+    rstack = []
+
+    Add, Sub, Mul, Div, Neg = IrOpCode.Add.value, IrOpCode.Sub.value, IrOpCode.Mul.value, IrOpCode.Div.value, IrOpCode.Neg.value
+    Eq, Ne, Lt, Lte, Gt, Gte = IrOpCode.Eq.value, IrOpCode.Ne.value, IrOpCode.Lt.value, IrOpCode.Lte.value, IrOpCode.Gt.value, IrOpCode.Gte.value
+    Odd, LoadVar, LoadLit, Store = IrOpCode.Odd.value, IrOpCode.LoadVar.value, IrOpCode.LoadLit.value, IrOpCode.Store.value
+    Jump, BrFalse, Call, Ret = IrOpCode.Jump.value, IrOpCode.BrFalse.value, IrOpCode.Call.value, IrOpCode.Ret.value
+    IncVar, AddVarLit = IrOpCode.IncVar.value, IrOpCode.AddVarLit.value
+    BrIfNotEq, BrIfNotNe, BrIfNotLt = IrOpCode.BrIfNotEq.value, IrOpCode.BrIfNotNe.value, IrOpCode.BrIfNotLt.value
+    BrIfNotLte, BrIfNotGt, BrIfNotGte = IrOpCode.BrIfNotLte.value, IrOpCode.BrIfNotGt.value, IrOpCode.BrIfNotGte.value
+    Input, Output, Halt = IrOpCode.Input.value, IrOpCode.Output.value, IrOpCode.Halt.value
+
+    # 按执行频率排列: 变量存取和融合后的条件跳转最多, 其次是算术, 比较和调用
+    while pc < n:
+        op, args, value = code[pc]
         pc += 1
 
-        # 出栈 压栈
-        if ir.op == IrOpCode.Add:
-            v2 = sp.pop()
-            v1 = sp.pop()
-            sp.append(v1 + v2)
+        if op == LoadVar:
+            val = display[args[0]][args[1]]
+            if val is None:
+                raise RuntimeError('variable %s referenced before initialization' % value)
+            push(val)
 
-        elif ir.op == IrOpCode.Sub:
-            v2 = sp.pop()
-            v1 = sp.pop()
-            sp.append(v1 - v2)
+        elif op == LoadLit:
+            if not isinstance(args, int):
+                raise RuntimeError('invalid loadvar args')
+            push(args)
+
+        elif op == Store:
+            display[args[0]][args[1]] = pop()
+
+        elif op == IncVar:
+            frame = display[args[0]]
+            val = frame[args[1]]
+            if val is None:
+                raise RuntimeError('variable %s referenced before initialization' % args[2])
+            frame[args[1]] = val + value if fix is None else fix(val + value)
+
+        elif op == AddVarLit:
+            val = display[args[0]][args[1]]
+            if val is None:
+                raise RuntimeError('variable %s referenced before initialization' % args[2])
+            push(val + value if fix is None else fix(val + value))
+
+        elif BrIfNotEq <= op <= BrIfNotGte:
+            v2 = pop()
+            v1 = pop()
+
+            if op == BrIfNotLt:
+                cond = v1 < v2
+            elif op == BrIfNotLte:
+                cond = v1 <= v2
+            elif op == BrIfNotEq:
+                cond = v1 == v2
+            elif op == BrIfNotNe:
+                cond = v1 != v2
+            elif op == BrIfNotGt:
+                cond = v1 > v2
+            else:
+                cond = v1 >= v2
 
-        elif ir.op == IrOpCode.Mul:
-            v2 = sp.pop()
-            v1 = sp.pop()
-            sp.append(v1 * v2)
+            if not cond:
+                if not (0 <= args <= n):
+                    raise RuntimeError('branch out of bounds')
+                pc = args
 
-        elif ir.op == IrOpCode.Div:
-            v2 = sp.pop()
-            v1 = sp.pop()
+        elif op == Jump:
+            if not isinstance(args, int):
+                raise RuntimeError('invalid jump args')
+            elif 0 <= args <= n:
+                pc = args
+            else:
+                raise RuntimeError('branch out of bounds')
+
+        elif op == BrFalse:
+            if not pop():
+                if not isinstance(args, int):
+                    raise RuntimeError('invalid brfalse args')
+                elif 0 <= args <= n:
+                    pc = args
+                else:
+                    raise RuntimeError('branch out of bounds')
+
+        elif op == Add:
+            v2 = pop()
+            v1 = pop()
+            push(v1 + v2 if fix is None else fix(v1 + v2))
+
+        elif op == Sub:
+            v2 = pop()
+            v1 = pop()
+            push(v1 - v2 if fix is None else fix(v1 - v2))
+
+        elif op == Mul:
+            v2 = pop()
+            v1 = pop()
+            push(v1 * v2 if fix is None else fix(v1 * v2))
 
-            if v2 == 0:
+        elif op == Div:
+            v2 = pop()
+            v1 = pop()
+
+            if ints is not None:
+                push(int_div(v1, v2) if fix is None else fix(int_div(v1, v2)))
+            elif v2 == 0:
                 raise RuntimeError('division by zero')
             else:
-                sp.append(v1 / v2)
+                push(v1 / v2)
+
+        elif op == Neg:
+            sp[-1] = -sp[-1] if fix is None else fix(-sp[-1])
+
+        elif op == Lt:
+            v2 = pop()
+            push(int(pop() < v2))
+
+        elif op == Lte:
+            v2 = pop()
+            push(int(pop() <= v2))
+
+        elif op == Eq:
+            v2 = pop()
+            push(int(pop() == v2))
+
+        elif op == Ne:
+            v2 = pop()
+            push(int(pop() != v2))
+
+        elif op == Gt:
+            v2 = pop()
+            push(int(pop() > v2))
+
+        elif op == Gte:
+            v2 = pop()
+            push(int(pop() >= v2))
+
+        elif op == Odd:
+            sp[-1] = sp[-1] & 1
+
+        elif op == Call:
+            if not isinstance(value, IrProc):
+                raise RuntimeError('procedure called not existed.')
+
+            # display[level] 指向该层最近一次活动的栈帧, 返回时恢复
+            frame = [None] * value.size
+            if value.level == len(display):
+                rstack.append((pc, value.level, None))
+                display.append(frame)
+            else:
+                rstack.append((pc, value.level, display[value.level]))
+                display[value.level] = frame
+            pc = args
+
+        elif op == Ret:
+            pc, level, frame = rstack.pop()
+            display[level] = frame
+
+        elif op == Input:
+            val = pl0_io.read()
+            push(val if fix is None else fix(val))
+
+        elif op == Output:
+            pl0_io.write(pop())
+
+        elif op == Halt:
+            break
+
+        else:
+            raise RuntimeError('invalid instruction')
 
-        elif ir.op == IrOpCode.Neg:
-            sp[-1] = -sp[-1]
 
-        elif ir.op == IrOpCode.Eq:
+def bc_eval(bc: Bytecode, slots: list[int | None], ints: str | None = None):
+    code, consts, names = bc.code, bc.consts, bc.names
+    fix = INT_MODES.get(ints)
+    if fix is not None:
+        consts = [fix(val) for val in consts]
+    n = len(code)
+    pc = 0
+    sp = []
+    display = [slots]
+    rstack = []
+
+    Add, Sub, Mul, Div, Neg = IrOpCode.Add.value, IrOpCode.Sub.value, IrOpCode.Mul.value, IrOpCode.Div.value, IrOpCode.Neg.value
+    Eq, Ne, Lt, Lte, Gt, Gte = IrOpCode.Eq.value, IrOpCode.Ne.value, IrOpCode.Lt.value, IrOpCode.Lte.value, IrOpCode.Gt.value, IrOpCode.Gte.value
+    Odd, LoadVar, LoadLit, Store = IrOpCode.Odd.value, IrOpCode.LoadVar.value, IrOpCode.LoadLit.value, IrOpCode.Store.value
+    Jump, BrFalse, Call, Ret = IrOpCode.Jump.value, IrOpCode.BrFalse.value, IrOpCode.Call.value, IrOpCode.Ret.value
+    IncVar, AddVarLit = IrOpCode.IncVar.value, IrOpCode.AddVarLit.value
+    BrIfNotEq, BrIfNotNe, BrIfNotLt = IrOpCode.BrIfNotEq.value, IrOpCode.BrIfNotNe.value, IrOpCode.BrIfNotLt.value
+    BrIfNotLte, BrIfNotGt, BrIfNotGte = IrOpCode.BrIfNotLte.value, IrOpCode.BrIfNotGt.value, IrOpCode.BrIfNotGte.value
+    Input, Output, Halt = IrOpCode.Input.value, IrOpCode.Output.value, IrOpCode.Halt.value
+
+    # pc 直接用字的下标, 跳转目标乘上指令宽度
+    while pc < n:
+        op = code[pc]
+        a = code[pc + 1]
+        b = code[pc + 2]
+        c = code[pc + 3]
+        pc += BC_WIDTH
+
+        if op == LoadVar:
+            val = display[a][b]
+            if val is None:
+                raise RuntimeError('variable %s referenced before initialization' % names[c])
+            sp.append(val)
+
+        elif op == LoadLit:
+            sp.append(consts[a])
+
+        elif op == Store:
+            display[a][b] = sp.pop()
+
+        elif op == IncVar:
+            frame = display[a]
+            if frame[b] is None:
+                raise RuntimeError('variable %s referenced before initialization' % names[bc.fused[pc // BC_WIDTH - 1]])
+            frame[b] += consts[c]
+            if fix is not None:
+                frame[b] = fix(frame[b])
+
+        elif op == AddVarLit:
+            val = display[a][b]
+            if val is None:
+                raise RuntimeError('variable %s referenced before initialization' % names[bc.fused[pc // BC_WIDTH - 1]])
+            sp.append(val + consts[c] if fix is None else fix(val + consts[c]))
+
+        elif BrIfNotEq <= op <= BrIfNotGte:
             v2 = sp.pop()
             v1 = sp.pop()
-            sp.append(int(v1 == v2))
 
-        elif ir.op == IrOpCode.Ne:
+            if op == BrIfNotLt:
+                cond = v1 < v2
+            elif op == BrIfNotEq:
+                cond = v1 == v2
+            elif op == BrIfNotNe:
+                cond = v1 != v2
+            elif op == BrIfNotLte:
+                cond = v1 <= v2
+            elif op == BrIfNotGt:
+                cond = v1 > v2
+            else:
+                cond = v1 >= v2
+
+            if not cond:
+                pc = a * BC_WIDTH
+
+        elif op == Jump:
+            pc = a * BC_WIDTH
+
+        elif op == BrFalse:
+            if not sp.pop():
+                pc = a * BC_WIDTH
+
+        elif op == Add:
             v2 = sp.pop()
-            v1 = sp.pop()
-            sp.append(int(v1 != v2))
+            sp[-1] += v2
+            if fix is not None:
+                sp[-1] = fix(sp[-1])
 
-        elif ir.op == IrOpCode.Lt:
+        elif op == Sub:
             v2 = sp.pop()
-            v1 = sp.pop()
-            sp.append(int(v1 < v2))
+            sp[-1] -= v2
+            if fix is not None:
+                sp[-1] = fix(sp[-1])
 
-        elif ir.op == IrOpCode.Lte:
+        elif op == Mul:
             v2 = sp.pop()
-            v1 = sp.pop()
-            sp.append(int(v1 <= v2))
+            sp[-1] *= v2
+            if fix is not None:
+                sp[-1] = fix(sp[-1])
 
-        elif ir.op == IrOpCode.Gt:
+        elif op == Div:
             v2 = sp.pop()
-            v1 = sp.pop()
-            sp.append(int(v1 > v2))
+            if ints is not None:
+                sp[-1] = int_div(sp[-1], v2) if fix is None else fix(int_div(sp[-1], v2))
+            elif v2 == 0:
+                raise RuntimeError('division by zero')
+            else:
+                sp[-1] /= v2
+
+        elif op == Neg:
+            sp[-1] = -sp[-1] if fix is None else fix(-sp[-1])
 
-        elif ir.op == IrOpCode.Gte:
+        elif Eq <= op <= Gte:
             v2 = sp.pop()
             v1 = sp.pop()
-            sp.append(int(v1 >= v2))
 
-        elif ir.op == IrOpCode.Odd:
-            sp[-1] = sp[-1] & 1
+            if op == Eq:
+                sp.append(int(v1 == v2))
+            elif op == Ne:
+                sp.append(int(v1 != v2))
+            elif op == Lt:
+                sp.append(int(v1 < v2))
+            elif op == Lte:
+                sp.append(int(v1 <= v2))
+            elif op == Gt:
+                sp.append(int(v1 > v2))
+            else:
+                sp.append(int(v1 >= v2))
 
-        elif ir.op == IrOpCode.LoadVar:
-            if not isinstance(ir.args, str):
-                raise RuntimeError('invalid loadvar args')
+        elif op == Odd:
+            sp[-1] &= 1
+
+        elif op == Call:
+            frame = [None] * c
+            if b == len(display):
+                rstack.append((pc, b, None))
+                display.append(frame)
+            else:
+                rstack.append((pc, b, display[b]))
+                display[b] = frame
+            pc = a * BC_WIDTH
 
-            elif ir.args in ctx.vars:
-                key = ir.args
-                val = ctx.vars[key]
+        elif op == Ret:
+            pc, level, frame = rstack.pop()
+            display[level] = frame
 
+        elif op == Input:
+            val = pl0_io.read()
+            sp.append(val if fix is None else fix(val))
+
+        elif op == Output:
+            pl0_io.write(sp.pop())
+
+        elif op == Halt:
+            break
+
+        else:
+            raise RuntimeError('invalid instruction')
+
+
+IrHandler = Callable[[list[int], list[list[int | None]], list[tuple]], int]
+
+
+def _compile_binary(fn: Callable[[int, int], int], nxt: int) -> IrHandler:
+    def handler(sp, display, rstack):
+        v2 = sp.pop()
+        sp[-1] = fn(sp[-1], v2)
+        return nxt
+    return handler
+
+
+def _compile_branch(fn: Callable[[int, int], bool], ir: Ir, nxt: int, n: int) -> IrHandler:
+    if not isinstance(ir.args, int):
+        raise RuntimeError('invalid branch args')
+    elif not (0 <= ir.args <= n):
+        raise RuntimeError('branch out of bounds')
+    target = ir.args
+
+    def handler(sp, display, rstack):
+        v2 = sp.pop()
+        v1 = sp.pop()
+        return nxt if fn(v1, v2) else target
+    return handler
+
+
+def _compile_int(ir: Ir, nxt: int, fix: Callable[[int], int] | None) -> IrHandler:
+    # 整数语义下的算术; 结果在 int64 范围内时不调用 fix
+    lo, hi = INT64_MIN, INT64_MAX
+    if fix is None:
+        # 大整数模式不会溢出, 只有除法不一样
+        lo, hi = float('-inf'), float('inf')
+
+    match ir.op:
+        case IrOpCode.Add:
+            def handler(sp, display, rstack):
+                v2 = sp.pop()
+                val = sp[-1] + v2
+                sp[-1] = val if lo <= val <= hi else fix(val)
+                return nxt
+
+        case IrOpCode.Sub:
+            def handler(sp, display, rstack):
+                v2 = sp.pop()
+                val = sp[-1] - v2
+                sp[-1] = val if lo <= val <= hi else fix(val)
+                return nxt
+
+        case IrOpCode.Mul:
+            def handler(sp, display, rstack):
+                v2 = sp.pop()
+                val = sp[-1] * v2
+                sp[-1] = val if lo <= val <= hi else fix(val)
+                return nxt
+
+        case IrOpCode.Div:
+            def handler(sp, display, rstack):
+                v2 = sp.pop()
+                val = int_div(sp[-1], v2)
+                sp[-1] = val if lo <= val <= hi else fix(val)
+                return nxt
+
+        case IrOpCode.Neg:
+            def handler(sp, display, rstack):
+                val = -sp[-1]
+                sp[-1] = val if lo <= val <= hi else fix(val)
+                return nxt
+
+        case IrOpCode.IncVar:
+            (level, slot, name), lit = ir.args, ir.value
+
+            def handler(sp, display, rstack):
+                frame = display[level]
+                val = frame[slot]
                 if val is None:
-                    raise RuntimeError('variable %s referenced before initialization' % key)
-                else:
-                    sp.append(val)
+                    raise RuntimeError('variable %s referenced before initialization' % name)
+                val += lit
+                frame[slot] = val if lo <= val <= hi else fix(val)
+                return nxt
 
-            elif ir.args in ctx.consts:
-                sp.append(ctx.consts[ir.args])
+        case IrOpCode.AddVarLit:
+            (level, slot, name), lit = ir.args, ir.value
 
-            else:
-                raise RuntimeError('undefined variable: ' + ir.args)
+            def handler(sp, display, rstack):
+                val = display[level][slot]
+                if val is None:
+                    raise RuntimeError('variable %s referenced before initialization' % name)
+                val += lit
+                sp.append(val if lo <= val <= hi else fix(val))
+                return nxt
+
+        case IrOpCode.Input:
+            def handler(sp, display, rstack):
+                val = pl0_io.read()
+                sp.append(val if lo <= val <= hi else fix(val))
+                return nxt
+
+        case _:
+            raise RuntimeError('invalid instruction')
+
+    return handler
+
+
+_INT_OPS = {
+    IrOpCode.Add, IrOpCode.Sub, IrOpCode.Mul, IrOpCode.Div, IrOpCode.Neg,
+    IrOpCode.IncVar, IrOpCode.AddVarLit, IrOpCode.Input,
+}
+
+
+def _compile_ir(ir: Ir, nxt: int, n: int, ints: str | None = None) -> IrHandler:
+    if ints is not None and ir.op in _INT_OPS:
+        if ir.op in {IrOpCode.IncVar, IrOpCode.AddVarLit} and (
+                not isinstance(ir.args, tuple) or not isinstance(ir.value, int)):
+            raise RuntimeError('invalid incvar args')
+        return _compile_int(ir, nxt, INT_MODES.get(ints))
+
+    match ir.op:
+        case IrOpCode.Add:
+            def handler(sp, display, rstack):
+                v2 = sp.pop()
+                sp[-1] += v2
+                return nxt
+
+        case IrOpCode.Sub:
+            def handler(sp, display, rstack):
+                v2 = sp.pop()
+                sp[-1] -= v2
+                return nxt
+
+        case IrOpCode.Mul:
+            def handler(sp, display, rstack):
+                v2 = sp.pop()
+                sp[-1] *= v2
+                return nxt
+
+        case IrOpCode.Div:
+            def handler(sp, display, rstack):
+                v2 = sp.pop()
+                if v2 == 0:
+                    raise RuntimeError('division by zero')
+                sp[-1] /= v2
+                return nxt
+
+        case IrOpCode.Neg:
+            def handler(sp, display, rstack):
+                sp[-1] = -sp[-1]
+                return nxt
+
+        case IrOpCode.Eq:
+            return _compile_binary(lambda v1, v2: int(v1 == v2), nxt)
+        case IrOpCode.Ne:
+            return _compile_binary(lambda v1, v2: int(v1 != v2), nxt)
+        case IrOpCode.Lt:
+            return _compile_binary(lambda v1, v2: int(v1 < v2), nxt)
+        case IrOpCode.Lte:
+            return _compile_binary(lambda v1, v2: int(v1 <= v2), nxt)
+        case IrOpCode.Gt:
+            return _compile_binary(lambda v1, v2: int(v1 > v2), nxt)
+        case IrOpCode.Gte:
+            return _compile_binary(lambda v1, v2: int(v1 >= v2), nxt)
+
+        case IrOpCode.Odd:
+            def handler(sp, display, rstack):
+                sp[-1] &= 1
+                return nxt
+
+        case IrOpCode.LoadVar:
+            if not isinstance(ir.args, tuple):
+                raise RuntimeError('invalid loadvar args')
+            (level, slot), name = ir.args, ir.value
+
+            def handler(sp, display, rstack):
+                val = display[level][slot]
+                if val is None:
+                    raise RuntimeError('variable %s referenced before initialization' % name)
+                sp.append(val)
+                return nxt
 
-        elif ir.op == IrOpCode.LoadLit:
+        case IrOpCode.LoadLit:
             if not isinstance(ir.args, int):
                 raise RuntimeError('invalid loadvar args')
-            else:
-                sp.append(ir.args)
+            lit = ir.args
+
+            def handler(sp, display, rstack):
+                sp.append(lit)
+                return nxt
 
-        elif ir.op == IrOpCode.Store:
-            if not isinstance(ir.args, str):
+        case IrOpCode.Store:
+            if not isinstance(ir.args, tuple):
                 raise RuntimeError('invalid store args')
-            elif ir.args not in ctx.vars:
-                raise RuntimeError('undefined variable: ' + ir.args)
-            else:
-                ctx.vars[ir.args] = sp.pop()
+            level, slot = ir.args
 
-        elif ir.op == IrOpCode.Jump:
+            def handler(sp, display, rstack):
+                display[level][slot] = sp.pop()
+                return nxt
+
+        case IrOpCode.Jump:
             if not isinstance(ir.args, int):
                 raise RuntimeError('invalid jump args')
-            elif 0 <= ir.args < len(buf):
-                pc = ir.args
-            else:
+            elif not (0 <= ir.args <= n):
                 raise RuntimeError('branch out of bounds')
+            target = ir.args
 
-        elif ir.op == IrOpCode.BrFalse:
-            if not sp.pop():
-                if not isinstance(ir.args, int):
-                    raise RuntimeError('invalid brfalse args')
-                elif 0 <= ir.args < len(buf):
-                    pc = ir.args
+            def handler(sp, display, rstack):
+                return target
+
+        case IrOpCode.BrFalse:
+            if not isinstance(ir.args, int):
+                raise RuntimeError('invalid brfalse args')
+            elif not (0 <= ir.args <= n):
+                raise RuntimeError('branch out of bounds')
+            target = ir.args
+
+            def handler(sp, display, rstack):
+                return nxt if sp.pop() else target
+
+        case IrOpCode.Call:
+            if not isinstance(ir.value, IrProc):
+                raise RuntimeError('procedure called not existed.')
+            elif not (0 <= ir.args < n):
+                raise RuntimeError('branch out of bounds')
+            entry, level, size = ir.args, ir.value.level, ir.value.size
+
+            def handler(sp, display, rstack):
+                if level == len(display):
+                    rstack.append((nxt, level, None))
+                    display.append([None] * size)
                 else:
-                    raise RuntimeError('branch out of bounds')
+                    rstack.append((nxt, level, display[level]))
+                    display[level] = [None] * size
+                return entry
+
+        case IrOpCode.Ret:
+            def handler(sp, display, rstack):
+                pc, level, frame = rstack.pop()
+                display[level] = frame
+                return pc
+
+        case IrOpCode.IncVar:
+            if not isinstance(ir.args, tuple) or not isinstance(ir.value, int):
+                raise RuntimeError('invalid incvar args')
+            (level, slot, name), lit = ir.args, ir.value
+
+            def handler(sp, display, rstack):
+                frame = display[level]
+                val = frame[slot]
+                if val is None:
+                    raise RuntimeError('variable %s referenced before initialization' % name)
+                frame[slot] = val + lit
+                return nxt
 
-        elif ir.op == IrOpCode.DefVar:
-            if not isinstance(ir.args, str):
-                raise RuntimeError('invalid defvar args')
-            elif ir.args in ctx.vars or ir.args in ctx.procs or ir.args in ctx.consts:
-                raise RuntimeError('variable redeclared: ' + ir.args)
-            else:
-                ctx.vars[ir.args] = None
+        case IrOpCode.AddVarLit:
+            if not isinstance(ir.args, tuple) or not isinstance(ir.value, int):
+                raise RuntimeError('invalid addvarlit args')
+            (level, slot, name), lit = ir.args, ir.value
 
-        elif ir.op == IrOpCode.DefLit:
-            if not isinstance(ir.args, str) or not isinstance(ir.value, int):
-                raise RuntimeError('invalid deflit args')
-            elif ir.args in ctx.vars or ir.args in ctx.procs or ir.args in ctx.consts:
-                raise RuntimeError('variable redeclared: ' + ir.args)
-            else:
-                ctx.consts[ir.args] = ir.value
+            def handler(sp, display, rstack):
+                val = display[level][slot]
+                if val is None:
+                    raise RuntimeError('variable %s referenced before initialization' % name)
+                sp.append(val + lit)
+                return nxt
+
+        case IrOpCode.BrIfNotEq:
+            return _compile_branch(lambda v1, v2: v1 == v2, ir, nxt, n)
+        case IrOpCode.BrIfNotNe:
+            return _compile_branch(lambda v1, v2: v1 != v2, ir, nxt, n)
+        case IrOpCode.BrIfNotLt:
+            return _compile_branch(lambda v1, v2: v1 < v2, ir, nxt, n)
+        case IrOpCode.BrIfNotLte:
+            return _compile_branch(lambda v1, v2: v1 <= v2, ir, nxt, n)
+        case IrOpCode.BrIfNotGt:
+            return _compile_branch(lambda v1, v2: v1 > v2, ir, nxt, n)
+        case IrOpCode.BrIfNotGte:
+            return _compile_branch(lambda v1, v2: v1 >= v2, ir, nxt, n)
+
+        case IrOpCode.Input:
+            def handler(sp, display, rstack):
+                sp.append(pl0_io.read())
+                return nxt
+
+        case IrOpCode.Output:
+            def handler(sp, display, rstack):
+                pl0_io.write(sp.pop())
+                return nxt
+
+        case IrOpCode.Halt:
+            def handler(sp, display, rstack):
+                return n
+
+        case _:
+            raise RuntimeError('invalid instruction')
+
+    return handler
+
+
+def ir_compile(buf: list[Ir], ints: str | None = None) -> list[IrHandler]:
+    if (fix := INT_MODES.get(ints)) is not None:
+        buf = _ir_fix_literals(buf, fix)
+    return [_compile_ir(ir, i + 1, len(buf), ints) for i, ir in enumerate(buf)]
+
+
+def ir_run(code: list[IrHandler], slots: list[int | None]):
+    sp = []
+    display = [slots]
+    rstack = []
+
+    pc = 0
+    n = len(code)
+    while pc < n:
+        pc = code[pc](sp, display, rstack)
+
+
+class IrProfile:
+    # 按 IR 序号记录的执行次数和耗时 (ns), 过程按入口记录调用次数和含子调用的耗时
+    buf: list[Ir]
+    lines: list[int] | None
+    counts: list[int]
+    times: list[int]
+    procs: dict[int, list[int]]
+    total: int
+
+    def __init__(self, lines: list[int] | None = None):
+        self.buf = []
+        self.lines = lines
+        self.counts = []
+        self.times = []
+        self.procs = {}
+        self.total = 0
+
+    def by_opcode(self) -> dict[IrOpCode, tuple[int, int]]:
+        ret = {}
+        for ir, count, t in zip(self.buf, self.counts, self.times):
+            if count:
+                c, tt = ret.get(ir.op, (0, 0))
+                ret[ir.op] = (c + count, tt + t)
+        return ret
+
+    def by_line(self) -> dict[int, tuple[int, int]]:
+        # lines 是 IR 序号到源码行号的表 (SourceMap.line_table), 0 表示没有对应的行
+        ret = {}
+        for line, count, t in zip(self.lines or (), self.counts, self.times):
+            if count and line:
+                c, tt = ret.get(line, (0, 0))
+                ret[line] = (c + count, tt + t)
+        return ret
+
+    def by_proc(self) -> dict[str, tuple[int, int]]:
+        names = {ir.args: ir.value.name for ir in self.buf if ir.op == IrOpCode.Call}
+        return {'%s@%d' % (names[entry], entry): (c, t) for entry, (c, t) in self.procs.items()}
+
+    def dump(self) -> dict:
+        return {
+            'instructions': sum(self.counts),
+            'total_ns': self.total,
+            'opcodes': {op.name: {'count': c, 'ns': t} for op, (c, t) in self.by_opcode().items()},
+            'ir': [
+                {'pc': pc, 'op': ir.op.name, 'count': c, 'ns': t,
+                 **({'line': self.lines[pc]} if self.lines and self.lines[pc] else {})}
+                for pc, (ir, c, t) in enumerate(zip(self.buf, self.counts, self.times)) if c
+            ],
+            'procs': {name: {'calls': c, 'ns': t} for name, (c, t) in self.by_proc().items()},
+            'lines': {str(line): {'count': c, 'ns': t} for line, (c, t) in sorted(self.by_line().items())},
+        }
+
+    def report(self, top: int = 20) -> str:
+        total = self.total or 1
+
+        def rows(title: str, items, key: Callable) -> list[str]:
+            out = ['', '%-24s %12s %10s %7s' % (title, 'count', 'ms', '%')]
+            for k, (c, t) in sorted(items, key=lambda kv: -kv[1][1])[:top]:
+                out.append('%-24s %12d %10.3f %6.1f%%' % (key(k), c, t / 1e6, t * 100 / total))
+            return out
+
+        out = ['%d instructions in %.3f ms' % (sum(self.counts), self.total / 1e6)]
+        out += rows('opcode', self.by_opcode().items(), lambda op: op.name)
+        hot = [(pc, (c, t)) for pc, (c, t) in enumerate(zip(self.counts, self.times)) if c]
+        out += rows('pc', hot, lambda pc: '%5d %s%s' % (
+            pc, self.buf[pc].op.name, ' :%d' % self.lines[pc] if self.lines and self.lines[pc] else ''))
+        if self.procs:
+            out += rows('procedure', self.by_proc().items(), str)
+        if self.lines:
+            out += rows('line', self.by_line().items(), str)
+        return '\n'.join(out)
+
+
+def ir_profile(buf: list[Ir], slots: list[int | None], ints: str | None, profile: IrProfile):
+    # 剖析的是 compiled 引擎: 用 ir_compile 的处理函数逐条执行, 每条指令只读一次时钟.
+    # 剖析走单独的循环, 不开时各个引擎的主循环没有额外开销
+    code = ir_compile(buf, ints)
+    n = len(code)
+    ops = [ir.op for ir in buf]
+    profile.buf = buf
+    profile.counts = counts = [0] * n
+    profile.times = times = [0] * n
+    procs = profile.procs
+    clock = time.perf_counter_ns
+
+    sp = []
+    display = [slots]
+    rstack = []
+    # 和 rstack 同步的 (入口, 调用开始时刻), 过程耗时包含 Call 本身;
+    # 递归调用只在最外层返回时计时, 避免重复累加
+    entered = []
+    active = collections.Counter()
+
+    pc = 0
+    start = t = clock()
+    try:
+        while pc < n:
+            nxt = code[pc](sp, display, rstack)
+            now = clock()
+            counts[pc] += 1
+            times[pc] += now - t
+
+            op = ops[pc]
+            if op == IrOpCode.Call:
+                entered.append((nxt, t))
+                active[nxt] += 1
+            elif op == IrOpCode.Ret:
+                entry, t0 = entered.pop()
+                active[entry] -= 1
+                rec = procs.setdefault(entry, [0, 0])
+                rec[0] += 1
+                if not active[entry]:
+                    rec[1] += now - t0
+
+            pc = nxt
+            t = now
+    finally:
+        profile.total = clock() - start
+
+
+class BatchResult(NamedTuple):
+    outputs: list[list[int]]
+    errors: dict[int, str]
+
+
+def _batch_inputs(inputs) -> tuple['np.ndarray', 'np.ndarray']:
+    # 每个 lane 一行输入, 行长可以不同, 补齐成矩阵, 另外记下每行的长度
+    if isinstance(inputs, np.ndarray):
+        inputs = inputs.astype(np.int64, copy=False)
+        if inputs.ndim == 1:
+            inputs = inputs[:, None]
+        return inputs, np.full(len(inputs), inputs.shape[1], np.intp)
+
+    rows = [[int_wrap(row)] if isinstance(row, int) else [int_wrap(val) for val in row] for row in inputs]
+    lens = np.array([len(row) for row in rows], np.intp)
+    ret = np.zeros((len(rows), max(lens, default=0)), np.int64)
+    for i, row in enumerate(rows):
+        ret[i, :len(row)] = row
+    return ret, lens
+
+
+def _batch_div(v1: 'np.ndarray', v2: 'np.ndarray') -> 'np.ndarray':
+    # numpy 的 // 向下取整, 改成向零截断; 除数为 -1 的单独取反, 避开 INT64_MIN // -1
+    neg = v2 == -1
+    v2 = np.where(neg, 1, v2)
+    q = v1 // v2
+    q += (v1 - q * v2 != 0) & ((v1 < 0) != (v2 < 0))
+    return np.where(neg, -v1, q)
+
+
+# 比较和融合分支指令对应的 numpy 函数, 融合分支在比较为假时跳转
+_BATCH_COMPARE = {} if np is None else {
+    IrOpCode.Eq: np.equal, IrOpCode.BrIfNotEq: np.equal,
+    IrOpCode.Ne: np.not_equal, IrOpCode.BrIfNotNe: np.not_equal,
+    IrOpCode.Lt: np.less, IrOpCode.BrIfNotLt: np.less,
+    IrOpCode.Lte: np.less_equal, IrOpCode.BrIfNotLte: np.less_equal,
+    IrOpCode.Gt: np.greater, IrOpCode.BrIfNotGt: np.greater,
+    IrOpCode.Gte: np.greater_equal, IrOpCode.BrIfNotGte: np.greater_equal,
+}
+
+
+def ir_batch(buf: list[Ir], size: int, inputs, ints: str | None = 'wrap') -> BatchResult:
+    # 同一段 ir 同时跑 N 份输入, 每个 lane 对应一份, 变量和操作数栈上的值都是 int64 向量.
+    # 分支让各 lane 的 pc 分开, 按 pc 把 lane 分组停放, 每次执行 pc 最小的一组, 走到别的组
+    # 停放的位置就合并; 表达式里没有跳转, 停放处的操作数栈都是空的.
+    # lane 遇到 Halt 或走出程序末尾就结束, 运行时错误只结束出错的 lane, 记在 errors 里
+    if np is None:
+        raise RuntimeError('ir_batch needs numpy')
+    # numpy 的 int64 运算本身就是回绕的
+    if ints != 'wrap':
+        raise RuntimeError('batch engine needs wrap int64 semantics')
+    buf = _ir_fix_literals(buf, INT_MODES[ints])
+    inputs, avail = _batch_inputs(inputs)
+    n = len(inputs)
+
+    # 每一层一个帧栈, 形状是 (深度, 变量, lane); fp[level] 是各 lane 当前帧的下标, 对应 ir_eval 的 display.
+    # 第 0 层是主程序, 过程的帧从下标 1 开始
+    sizes = [size]
+    for ir in buf:
+        if ir.op == IrOpCode.Call:
+            sizes += [0] * (ir.value.level + 1 - len(sizes))
+            sizes[ir.value.level] = max(sizes[ir.value.level], ir.value.size)
+    frames = [np.zeros((1 if level == 0 else 2, s, n), np.int64) for level, s in enumerate(sizes)]
+    inited = [np.zeros(frame.shape, bool) for frame in frames]
+    fp = [np.zeros(n, np.intp) for _ in sizes]
+    rpc = np.zeros((2, n), np.intp)
+    rlevel = np.zeros((2, n), np.intp)
+    rsp = np.zeros(n, np.intp)
+    ip = np.zeros(n, np.intp)
+
+    outs = []
+    errors = {}
+    groups = {0: np.arange(n)}
+    lanes = stack = None
+
+    def grow(arr: 'np.ndarray', depth: int) -> 'np.ndarray':
+        # 递归变深时帧栈按倍数扩大
+        if depth < len(arr):
+            return arr
+        return np.concatenate([arr, np.zeros((max(depth + 1, 2 * len(arr)) - len(arr), *arr.shape[1:]), arr.dtype)])
+
+    def park(pc: int, idx: 'np.ndarray'):
+        if len(idx) and pc < len(buf):
+            groups[pc] = np.concatenate([groups[pc], idx]) if pc in groups else idx
+
+    def drop(ok: 'np.ndarray', msg: str) -> bool:
+        # 出错的 lane 退出, 返回是否还有 lane
+        nonlocal lanes, stack
+        for lane in lanes[~ok].tolist():
+            errors[lane] = msg
+        lanes = lanes[ok]
+        stack = [val[ok] for val in stack]
+        return len(lanes) > 0
+
+    def load(ir: Ir) -> 'np.ndarray | None':
+        # 融合指令的变量名在 args 里
+        level, slot, *fused = ir.args
+        frame = fp[level][lanes]
+        ok = inited[level][frame, slot, lanes]
+        if not ok.all():
+            name = fused[0] if fused else ir.value
+            if not drop(ok, 'variable %s referenced before initialization' % name):
+                return None
+            frame = frame[ok]
+        return frames[level][frame, slot, lanes]
+
+    def store(ir: Ir, val: 'np.ndarray'):
+        level, slot = ir.args[:2]
+        frame = fp[level][lanes]
+        frames[level][frame, slot, lanes] = val
+        inited[level][frame, slot, lanes] = True
+
+    def branch(cond: 'np.ndarray', target: int, pc: int) -> bool:
+        # 全部不跳时接着执行当前组, 否则停放后重新挑 pc 最小的组
+        if cond.all():
+            return False
+        park(target, lanes[~cond])
+        park(pc, lanes[cond])
+        return True
+
+    while groups:
+        pc = min(groups)
+        lanes = groups.pop(pc)
+        stack = []
+
+        while pc < len(buf):
+            if pc in groups and not stack:
+                lanes = np.concatenate([lanes, groups.pop(pc)])
+            ir = buf[pc]
+            pc += 1
+
+            match ir.op:
+                case IrOpCode.Add | IrOpCode.Sub | IrOpCode.Mul:
+                    v2 = stack.pop()
+                    v1 = stack.pop()
+                    stack.append(v1 + v2 if ir.op == IrOpCode.Add else v1 - v2 if ir.op == IrOpCode.Sub else v1 * v2)
+
+                case IrOpCode.Div:
+                    ok = stack[-1] != 0
+                    if not ok.all() and not drop(ok, 'division by zero'):
+                        break
+                    v2 = stack.pop()
+                    v1 = stack.pop()
+                    stack.append(_batch_div(v1, v2))
+
+                case IrOpCode.Neg:
+                    stack[-1] = -stack[-1]
+
+                case IrOpCode.Odd:
+                    stack[-1] = stack[-1] & 1
+
+                case IrOpCode.Eq | IrOpCode.Ne | IrOpCode.Lt | IrOpCode.Lte | IrOpCode.Gt | IrOpCode.Gte:
+                    v2 = stack.pop()
+                    v1 = stack.pop()
+                    stack.append(_BATCH_COMPARE[ir.op](v1, v2).astype(np.int64))
+
+                case IrOpCode.LoadVar:
+                    val = load(ir)
+                    if val is None:
+                        break
+                    stack.append(val)
+
+                case IrOpCode.LoadLit:
+                    stack.append(np.full(len(lanes), ir.args, np.int64))
+
+                case IrOpCode.Store:
+                    store(ir, stack.pop())
+
+                case IrOpCode.IncVar:
+                    val = load(ir)
+                    if val is None:
+                        break
+                    store(ir, val + ir.value)
+
+                case IrOpCode.AddVarLit:
+                    val = load(ir)
+                    if val is None:
+                        break
+                    stack.append(val + ir.value)
+
+                case IrOpCode.Jump:
+                    park(ir.args, lanes)
+                    break
+
+                case IrOpCode.BrFalse:
+                    if branch(stack.pop() != 0, ir.args, pc):
+                        break
+
+                case IrOpCode.BrIfNotEq | IrOpCode.BrIfNotNe | IrOpCode.BrIfNotLt | \
+                        IrOpCode.BrIfNotLte | IrOpCode.BrIfNotGt | IrOpCode.BrIfNotGte:
+                    v2 = stack.pop()
+                    v1 = stack.pop()
+                    if branch(_BATCH_COMPARE[ir.op](v1, v2), ir.args, pc):
+                        break
+
+                case IrOpCode.Call:
+                    level = ir.value.level
+                    fp[level][lanes] += 1
+                    frames[level] = grow(frames[level], int(fp[level][lanes].max()))
+                    inited[level] = grow(inited[level], len(frames[level]) - 1)
+                    inited[level][fp[level][lanes], :, lanes] = False
+                    rsp[lanes] += 1
+                    rpc = grow(rpc, int(rsp[lanes].max()))
+                    rlevel = grow(rlevel, len(rpc) - 1)
+                    rpc[rsp[lanes], lanes] = pc
+                    rlevel[rsp[lanes], lanes] = level
+                    park(ir.args, lanes)
+                    break
+
+                case IrOpCode.Ret:
+                    # 同一组的 lane 可能从不同的调用点进来, 按返回地址拆开
+                    ret = rpc[rsp[lanes], lanes]
+                    levels = rlevel[rsp[lanes], lanes]
+                    rsp[lanes] -= 1
+                    for level in np.unique(levels).tolist():
+                        fp[level][lanes[levels == level]] -= 1
+                    for target in np.unique(ret).tolist():
+                        park(target, lanes[ret == target])
+                    break
+
+                case IrOpCode.Input:
+                    ok = ip[lanes] < avail[lanes]
+                    if not ok.all() and not drop(ok, 'no more input'):
+                        break
+                    cur = ip[lanes]
+                    stack.append(inputs[lanes, cur])
+                    ip[lanes] = cur + 1
 
-        elif ir.op == IrOpCode.DefProc:
-            if not isinstance(ir.args, str) or not isinstance(ir.value, list):
-                raise RuntimeError('invalid defproc args')
-            elif ir.args in ctx.vars or ir.args in ctx.procs or ir.args in ctx.consts:
-                raise RuntimeError('variable redeclare: ' + ir.args)
+                case IrOpCode.Output:
+                    outs.append((lanes, stack.pop()))
+
+                case IrOpCode.Halt:
+                    break
+
+                case _:
+                    raise RuntimeError('invalid instruction')
+
+    # 按 lane 收集输出, 同一 lane 内保持输出的先后顺序
+    ret = [[] for _ in range(n)]
+    if outs:
+        idx = np.concatenate([lanes for lanes, _ in outs])
+        vals = np.concatenate([vals for _, vals in outs])[np.argsort(idx, kind='stable')].tolist()
+        pos = 0
+        for lane, count in enumerate(np.bincount(idx, minlength=n).tolist()):
+            ret[lane] = vals[pos:pos + count]
+            pos += count
+    return BatchResult(ret, errors)
+
+
+AstClosure = Callable[[], int | None]
+
+
+DEEP_STACK_SIZE = 512 << 20
+DEEP_RECURSION_LIMIT = 1 << 19
+
+
+def _deep_call(fn: Callable, *args):
+    # 嵌套的 AST 和递归的 PL/0 过程直接对应 Python 调用 (compile 里还有 C 递归),
+    # 放到栈足够大的线程里跑. 递归上限按每层 1KB 栈给, 过深时报 RecursionError 而不是撑爆 C 栈
+    ret = error = None
+
+    def target():
+        nonlocal ret, error
+        try:
+            ret = fn(*args)
+        except BaseException as e:
+            error = e
+
+    limit = sys.getrecursionlimit()
+    size = threading.stack_size(DEEP_STACK_SIZE)
+    try:
+        thread = threading.Thread(target=target, daemon=True)
+        sys.setrecursionlimit(max(limit, DEEP_RECURSION_LIMIT))
+        thread.start()
+    finally:
+        threading.stack_size(size)
+    try:
+        thread.join()
+    finally:
+        sys.setrecursionlimit(limit)
+
+    if error is not None:
+        raise error
+    return ret
+
+
+def _closure_thunk(val: int | AstClosure) -> AstClosure:
+    if isinstance(val, int):
+        return lambda: val
+    return val
+
+
+def _closure_binary(op: str, lhs: int | AstClosure, rhs: int | AstClosure) -> AstClosure:
+    # 常量操作数直接内联, 少一层调用
+    if isinstance(lhs, int) and isinstance(rhs, int):
+        lhs = _closure_thunk(lhs)
+
+    match op, isinstance(lhs, int), isinstance(rhs, int):
+        case '+', False, False: return lambda: lhs() + rhs()
+        case '+', False, True: return lambda: lhs() + rhs
+        case '+', True, False: return lambda: lhs + rhs()
+        case '-', False, False: return lambda: lhs() - rhs()
+        case '-', False, True: return lambda: lhs() - rhs
+        case '-', True, False: return lambda: lhs - rhs()
+        case '*', False, False: return lambda: lhs() * rhs()
+        case '*', False, True: return lambda: lhs() * rhs
+        case '*', True, False: return lambda: lhs * rhs()
+        case '/', _, _:
+            lhs, rhs = _closure_thunk(lhs), _closure_thunk(rhs)
+
+            def fn():
+                v1 = lhs()
+                v2 = rhs()
+                if v2 == 0:
+                    raise RuntimeError('division by zero')
+                return v1 / v2
+            return fn
+        case _:
+            raise RuntimeError('invalid expression operator')
+
+
+def _closure_int(op: str, lhs: int | AstClosure, rhs: int | AstClosure,
+                 fix: Callable[[int], int] | None) -> AstClosure:
+    lhs, rhs = _closure_thunk(lhs), _closure_thunk(rhs)
+    match op:
+        case '+': fn = lambda: lhs() + rhs()
+        case '-': fn = lambda: lhs() - rhs()
+        case '*': fn = lambda: lhs() * rhs()
+        case '/': fn = lambda: int_div(lhs(), rhs())
+        case _:
+            raise RuntimeError('invalid expression operator')
+    if fix is None:
+        return fn
+
+    def checked():
+        val = fn()
+        return val if INT64_MIN <= val <= INT64_MAX else fix(val)
+    return checked
+
+
+def _closure_compare(op: str, lhs: int | AstClosure, rhs: int | AstClosure) -> AstClosure:
+    lhs = _closure_thunk(lhs)
+
+    match op, isinstance(rhs, int):
+        case '=', False: return lambda: lhs() == rhs()
+        case '=', True: return lambda: lhs() == rhs
+        case '#', False: return lambda: lhs() != rhs()
+        case '#', True: return lambda: lhs() != rhs
+        case '<', False: return lambda: lhs() < rhs()
+        case '<', True: return lambda: lhs() < rhs
+        case '<=', False: return lambda: lhs() <= rhs()
+        case '<=', True: return lambda: lhs() <= rhs
+        case '>', False: return lambda: lhs() > rhs()
+        case '>', True: return lambda: lhs() > rhs
+        case '>=', False: return lambda: lhs() >= rhs()
+        case '>=', True: return lambda: lhs() >= rhs
+        case _:
+            raise RuntimeError('invalid std condition operation ' + op)
+
+
+def ast_compile(program: Program, slots: list[int | None], ints: str | None = None) -> Callable[[], None]:
+    # 把 AST 一次性编译成嵌套闭包, 运行时只调用根闭包.
+    # 变量在编译期解析成 (level, slot), 帧模型和 ir_eval 的 display 一致
+    display = [slots]
+    fix = INT_MODES.get(ints)
+
+    def binary(op: str, lhs: int | AstClosure, rhs: int | AstClosure) -> AstClosure:
+        if ints is None:
+            return _closure_binary(op, lhs, rhs)
+        return _closure_int(op, lhs, rhs, fix)
+
+    def lookup(scopes: list[dict], name: str) -> tuple[IrOpCode, any]:
+        for scope in reversed(scopes):
+            if name in scope:
+                return scope[name]
+        raise RuntimeError('undefined symbol: ' + name)
+
+    def load(level: int, slot: int, name: str) -> AstClosure:
+        if level == 0:
+            def fn():
+                val = slots[slot]
+                if val is None:
+                    raise RuntimeError('variable %s referenced before initialization' % name)
+                return val
+        else:
+            def fn():
+                val = display[level][slot]
+                if val is None:
+                    raise RuntimeError('variable %s referenced before initialization' % name)
+                return val
+        return fn
+
+    def store(level: int, slot: int, expr: int | AstClosure) -> AstClosure:
+        match level == 0, isinstance(expr, int):
+            case True, True:
+                def fn():
+                    slots[slot] = expr
+            case True, False:
+                def fn():
+                    slots[slot] = expr()
+            case False, True:
+                def fn():
+                    display[level][slot] = expr
+            case _:
+                def fn():
+                    display[level][slot] = expr()
+        return fn
+
+    def factor(node: Factor, scopes: list[dict]) -> int | AstClosure:
+        match node.value:
+            case int(val):
+                return val if fix is None else fix(val)
+            case str(name):
+                kind, val = lookup(scopes, name)
+                if kind == IrOpCode.DefLit:
+                    return val
+                elif kind == IrOpCode.DefVar:
+                    return load(*val, name)
+                raise RuntimeError('invalid loadvar args')
+            case Expression() as expr:
+                return expression(expr, scopes)
+            case _:
+                raise RuntimeError('invalid factor value')
+
+    def term(node: Term, scopes: list[dict]) -> int | AstClosure:
+        ret = factor(node.lhs, scopes)
+        for op, rhs in node.rhs:
+            ret = binary(op, ret, factor(rhs, scopes))
+        return ret
+
+    def expression(node: Expression, scopes: list[dict]) -> int | AstClosure:
+        ret = term(node.lhs, scopes)
+        if node.mod == '-':
+            if isinstance(ret, int):
+                ret = -ret if fix is None else fix(-ret)
+            elif fix is None:
+                neg = ret
+                ret = lambda: -neg()
             else:
-                ctx.procs[ir.args] = ir.value
+                ret = binary('-', 0, ret)
+        elif node.mod not in {'+', ''}:
+            raise RuntimeError('invalid expression sign ' + node.mod)
 
-        elif ir.op == IrOpCode.Call:
-            if ir.args not in ctx.procs:
-                raise RuntimeError('procedure called not existed.')
+        for op, rhs in node.rhs:
+            if op not in {'+', '-'}:
+                raise RuntimeError('invalid expression operator')
+            ret = binary(op, ret, term(rhs, scopes))
+        return ret
+
+    def condition(node: Condition, scopes: list[dict]) -> AstClosure:
+        match node.cond:
+            case OddCondition(expr):
+                expr = _closure_thunk(expression(expr, scopes))
+                return lambda: expr() & 1
+            case StdCondition(op, lhs, rhs):
+                return _closure_compare(op, expression(lhs, scopes), expression(rhs, scopes))
+            case _:
+                raise RuntimeError('invalid condition')
+
+    def statement(node: Statement, scopes: list[dict]) -> AstClosure:
+        match node.stmt:
+            case Assign(name, expr):
+                kind, val = lookup(scopes, name)
+                if kind != IrOpCode.DefVar:
+                    raise RuntimeError('undefined variable: ' + name)
+                return store(*val, expression(expr, scopes))
+
+            case Begin(body):
+                body = [statement(stmt, scopes) for stmt in body]
+                if len(body) == 1:
+                    return body[0]
+
+                def fn():
+                    for stmt in body:
+                        stmt()
+                return fn
+
+            case If(cond, then):
+                cond, then = condition(cond, scopes), statement(then, scopes)
+
+                def fn():
+                    if cond():
+                        then()
+                return fn
+
+            case While(cond, do):
+                cond, do = condition(cond, scopes), statement(do, scopes)
+
+                def fn():
+                    while cond():
+                        do()
+                return fn
+
+            case Call(name):
+                kind, proc = lookup(scopes, name)
+                if kind != IrOpCode.DefProc:
+                    raise RuntimeError('procedure called not existed.')
+                level, size, body = proc
+
+                # display[level] 指向该层最近一次活动的栈帧, 返回时恢复
+                def fn():
+                    saved = display[level]
+                    display[level] = [None] * size
+                    body[0]()
+                    display[level] = saved
+                return fn
+
+            case InputOutput(name, True):
+                kind, val = lookup(scopes, name)
+                if kind != IrOpCode.DefVar:
+                    raise RuntimeError('undefined variable: ' + name)
+                level, slot = val
+                if fix is None:
+                    return store(level, slot, lambda: pl0_io.read())
+                return store(level, slot, lambda: fix(pl0_io.read()))
+
+            case InputOutput(name, False):
+                val = _closure_thunk(factor(Factor(name), scopes))
+                return lambda: pl0_io.write(val())
+
+            case _:
+                raise RuntimeError('invalid statement')
+
+    def block(node: Block, scopes: list[dict], level: int) -> AstClosure:
+        scope = {}
+        for cc in node.consts:
+            if cc.name in scope:
+                raise RuntimeError('variable redeclared: ' + cc.name)
+            scope[cc.name] = (IrOpCode.DefLit, cc.value if fix is None else fix(cc.value))
+        for slot, vv in enumerate(node.vars):
+            if vv in scope:
+                raise RuntimeError('variable redeclared: ' + vv)
+            scope[vv] = (IrOpCode.DefVar, (level, slot))
+
+        # 先登记本层所有过程, 过程体里可以引用同层后面定义的过程和自己
+        if node.procs and len(display) <= level + 1:
+            display.append(None)
+        for pp in node.procs:
+            if pp.name in scope:
+                raise RuntimeError('variable redeclared: ' + pp.name)
+            scope[pp.name] = (IrOpCode.DefProc, (level + 1, len(pp.body.vars), [None]))
+
+        scopes = scopes + [scope]
+        for pp in node.procs:
+            scope[pp.name][1][2][0] = block(pp.body, scopes, level + 1)
+        return statement(node.stmt, scopes)
+
+    root = _deep_call(block, program.block, [], 0)
+    return lambda: _deep_call(root)
+
+
+_PY_BINARY = {'+', '-', '*', '/'}
+_PY_COMPARE = {'=': '==', '#': '!=', '<': '<', '<=': '<=', '>': '>', '>=': '>='}
+
+
+def ast_python(program: Program, ints: str | None = None) -> str:
+    # PL/0 变量 -> Python 局部变量 v_*, 过程 -> 嵌套函数 p_*, 外层变量用 nonlocal.
+    # 静态嵌套的闭包和 ir_eval 的 display 语义一致; 没赋值的变量保持 unbound,
+    # 读它时 Python 自己报错, py_run 再转成和其他引擎一样的 RuntimeError
+    fix = INT_MODES.get(ints)
+
+    def literal(val: int) -> str:
+        if fix is not None:
+            val = fix(val)
+        return repr(val) if val >= 0 else '(%d)' % val
+
+    def checked(expr: str) -> str:
+        # 范围检查内联, 只有溢出时才调用 _fix (py_run 提供)
+        if fix is None:
+            return expr
+        return '(_t if %d <= (_t := %s) <= %d else _fix(_t))' % (INT64_MIN, expr, INT64_MAX)
+    def lookup(scopes: list[dict], name: str) -> tuple[IrOpCode, int, any]:
+        for level in range(len(scopes) - 1, -1, -1):
+            if name in scopes[level]:
+                kind, val = scopes[level][name]
+                return kind, level, val
+        raise RuntimeError('undefined symbol: ' + name)
+
+    def factor(node: Factor, scopes: list[dict]) -> str:
+        match node.value:
+            case int(val):
+                return literal(val)
+            case str(name):
+                kind, _, val = lookup(scopes, name)
+                if kind == IrOpCode.DefLit:
+                    return literal(val)
+                elif kind == IrOpCode.DefVar:
+                    return 'v_' + name
+                raise RuntimeError('invalid loadvar args')
+            case Expression() as expr:
+                return '(%s)' % expression(expr, scopes)
+            case _:
+                raise RuntimeError('invalid factor value')
+
+    def term(node: Term, scopes: list[dict]) -> str:
+        ret = factor(node.lhs, scopes)
+        for op, rhs in node.rhs:
+            if op not in {'*', '/'}:
+                raise RuntimeError('invalid expression operator')
+            if op == '/' and ints is not None:
+                ret = checked('_div(%s, %s)' % (ret, factor(rhs, scopes)))
             else:
-                block = ctx.procs[ir.args]
-                temp_ctx = copy.deepcopy(ctx)
-                temp_buf = copy.deepcopy(block)
-                ir_eval(temp_buf, temp_ctx)
-                for k, v in temp_ctx.vars.items():
-                    if k in ctx.vars:
-                        ctx.vars[k] = v
+                ret = checked('%s %s %s' % (ret, op, factor(rhs, scopes)))
+        return ret
+
+    def expression(node: Expression, scopes: list[dict]) -> str:
+        ret = term(node.lhs, scopes)
+        if node.mod == '-':
+            ret = checked('-(%s)' % ret)
+        elif node.mod not in {'+', ''}:
+            raise RuntimeError('invalid expression sign ' + node.mod)
 
-        elif ir.op == IrOpCode.Input:
-            sp.append(int(input()))
+        for op, rhs in node.rhs:
+            if op not in {'+', '-'}:
+                raise RuntimeError('invalid expression operator')
+            ret = checked('%s %s (%s)' % (ret, op, term(rhs, scopes)))
+        return ret
 
-        elif ir.op == IrOpCode.Output:
-            print(sp.pop())
+    def condition(node: Condition, scopes: list[dict]) -> str:
+        match node.cond:
+            case OddCondition(expr):
+                return '(%s) & 1' % expression(expr, scopes)
+            case StdCondition(op, lhs, rhs):
+                if op not in _PY_COMPARE:
+                    raise RuntimeError('invalid std condition operation ' + op)
+                return '(%s) %s (%s)' % (expression(lhs, scopes), _PY_COMPARE[op], expression(rhs, scopes))
+            case _:
+                raise RuntimeError('invalid condition')
+
+    def store(name: str, scopes: list[dict], outer: set[str]) -> str:
+        kind, level, _ = lookup(scopes, name)
+        if kind != IrOpCode.DefVar:
+            raise RuntimeError('undefined variable: ' + name)
+        if level != len(scopes) - 1:
+            outer.add('v_' + name)
+        return 'v_' + name
+
+    def statement(node: Statement, scopes: list[dict], pad: str, outer: set[str]) -> list[str]:
+        match node.stmt:
+            case Assign(name, expr):
+                return ['%s%s = %s' % (pad, store(name, scopes, outer), expression(expr, scopes))]
+            case Begin([]):
+                return [pad + 'pass']
+            case Begin(body):
+                return [line for stmt in body for line in statement(stmt, scopes, pad, outer)]
+            case If(cond, then):
+                return ['%sif %s:' % (pad, condition(cond, scopes)), *statement(then, scopes, pad + '    ', outer)]
+            case While(cond, do):
+                return ['%swhile %s:' % (pad, condition(cond, scopes)), *statement(do, scopes, pad + '    ', outer)]
+            case Call(name):
+                kind, _, _ = lookup(scopes, name)
+                if kind != IrOpCode.DefProc:
+                    raise RuntimeError('procedure called not existed.')
+                return ['%sp_%s()' % (pad, name)]
+            case InputOutput(name, True):
+                return ['%s%s = %s' % (pad, store(name, scopes, outer), checked('_read()'))]
+            case InputOutput(name, False):
+                return ['%s_write(%s)' % (pad, factor(Factor(name), scopes))]
+            case _:
+                raise RuntimeError('invalid statement')
+
+    def block(node: Block, scopes: list[dict], pad: str) -> list[str]:
+        scope = {}
+        for kind, name, val in [
+            *[(IrOpCode.DefLit, cc.name, cc.value) for cc in node.consts],
+            *[(IrOpCode.DefVar, vv, None) for vv in node.vars],
+            *[(IrOpCode.DefProc, pp.name, None) for pp in node.procs],
+        ]:
+            if name in scope:
+                raise RuntimeError('variable redeclared: ' + name)
+            scope[name] = (kind, val)
+        scopes = scopes + [scope]
+
+        lines = []
+        if node.vars:
+            # 只为让这些名字成为本函数的局部变量, 不会执行
+            lines.append('%sif 0: %s = None' % (pad, ' = '.join('v_' + vv for vv in node.vars)))
+        for pp in node.procs:
+            lines.append('%sdef p_%s():' % (pad, pp.name))
+            lines += block(pp.body, scopes, pad + '    ')
+
+        outer = set()
+        lines += statement(node.stmt, scopes, pad, outer)
+        if outer:
+            lines.insert(0, '%snonlocal %s' % (pad, ', '.join(sorted(outer))))
+        return lines
+
+    lines = ['def pl0_main(slots):', *block(program.block, [], '    ')]
+    if program.block.vars:
+        lines.append('    ns = locals()')
+        lines.append('    slots[:] = [%s]' % ', '.join("ns.get('v_%s')" % vv for vv in program.block.vars))
+    return '\n'.join(lines) + '\n'
+
+
+def ast_pycompile(program: Program, ints: str | None = None) -> types.CodeType:
+    try:
+        return _deep_call(lambda: compile(ast_python(program, ints), '<pl0>', 'exec'))
+    except (SyntaxError, RecursionError, MemoryError) as e:
+        # CPython 自己的限制: 缩进不超过 100 层, 循环嵌套不超过 20 层等
+        raise RuntimeError('program nests too deeply for the python backend: %s' % e) from None
+
+
+def py_run(code: types.CodeType, slots: list[int | None], ints: str | None = None):
+    # code 要用同一个 ints 生成
+    ns = {'_fix': INT_MODES.get(ints), '_div': int_div, '_read': pl0_io.read, '_write': pl0_io.write}
+    exec(code, ns)
+
+    try:
+        _deep_call(ns['pl0_main'], slots)
+    except ZeroDivisionError:
+        raise RuntimeError('division by zero') from None
+    except NameError as e:
+        if (m := re.search(r"'v_(\w+)'", str(e))) is None:
+            raise
+        raise RuntimeError('variable %s referenced before initialization' % m.group(1)) from None
+
+
+IR_ENGINES = {
+    'eval': ir_eval,
+    'compiled': lambda buf, slots, ints=None: ir_run(ir_compile(buf, ints), slots),
+    'bytecode': lambda buf, slots, ints=None: ir_eval(bc_encode(buf, []), slots, ints),
+}
 
-        elif ir.op == IrOpCode.Halt:
-            break
+AST_ENGINES = {
+    'closure': lambda ast, slots, ints=None: ast_compile(ast, slots, ints)(),
+    'python': lambda ast, slots, ints=None: py_run(ast_pycompile(ast, ints), slots, ints),
+}
+
+
+class Job(NamedTuple):
+    src: str
+    input: str = ''
+
+
+class JobResult(NamedTuple):
+    output: str
+    error: str | None
+    worker: int     # 执行它的进程 pid
+    seconds: float
 
+
+# 子进程里按源码序号取准备好的程序, 编译失败的是错误信息
+_job_programs: list[Callable[[], None] | str] = []
+
+
+def _job_prepare(src: str, engine: str, ints: str | None, fold: bool, peephole: bool,
+                 cache: ProgramCache | None) -> Callable[[], None] | str:
+    try:
+        if cache is not None:
+            buf, names = cache.compile(src, fold, peephole, ints)
         else:
-            raise RuntimeError('invalid instruction')
+            buf, names = compile_program(src, fold, peephole, ints=ints)
+    except (SyntaxError, RuntimeError) as e:
+        return '%s: %s' % (type(e).__name__, e)
+
+    match engine:
+        case 'compiled':
+            code = ir_compile(buf, ints)
+            return lambda: ir_run(code, [None] * len(names))
+        case 'bytecode':
+            bc = bc_encode(buf, names)
+            return lambda: bc_eval(bc, [None] * len(names), ints)
+        case _:
+            return lambda: ir_eval(buf, [None] * len(names), ints)
+
+
+def _job_init(prepared: list | None, sources: list[str], *args):
+    # fork 出来的子进程直接用主进程准备好的程序, 其他启动方式在这里各编译一次
+    global _job_programs
+    _job_programs = prepared if prepared is not None else [_job_prepare(src, *args) for src in sources]
+
+
+def _job_run(task: tuple[int, str]) -> tuple[str, str | None, int, float]:
+    index, text = task
+    run = _job_programs[index]
+    out = io.BytesIO()
+    err = None
+    start = time.perf_counter()
+    if isinstance(run, str):
+        err = run
+    else:
+        try:
+            with io_channel(io.BytesIO(text.encode()), out):
+                run()
+        except Exception as e:
+            # 一个任务出错不影响同一批的其他任务
+            err = '%s: %s' % (type(e).__name__, e)
+    return out.getvalue().decode(), err, os.getpid(), time.perf_counter() - start
+
+
+def run_jobs(jobs: Iterable[Job], engine: str = 'compiled', ints: str | None = None, workers: int | None = None,
+             fold: bool = True, peephole: bool = True, cache: ProgramCache | None = None,
+             chunksize: int | None = None) -> Iterator[JobResult]:
+    # 多进程执行一批任务, 结果按任务的顺序逐个产出. 每个不同的源码只编译一次:
+    # 能 fork 时在主进程里准备好, 子进程写时复制地共享; 否则每个子进程各编译一次
+    sources = {}
+    tasks = [(sources.setdefault(job.src, len(sources)), job.input) for job in jobs]
+    workers = workers or os.cpu_count() or 1
+    if chunksize is None:
+        # 每个进程大约分到 8 块, 减少进程间通信的次数
+        chunksize = max(1, len(tasks) // (workers * 8))
+
+    args = engine, ints, fold, peephole, cache
+    if 'fork' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('fork')
+        prepared = [_job_prepare(src, *args) for src in sources]
+    else:
+        ctx = None
+        prepared = None
+
+    with ProcessPoolExecutor(workers, ctx, _job_init, (prepared, list(sources), *args)) as pool:
+        for ret in pool.map(_job_run, tasks, chunksize=chunksize):
+            yield JobResult(*ret)
+
+
+def job_stats(results: Iterable[JobResult]) -> dict[int, tuple[int, float]]:
+    # pid -> (任务数, 执行耗时)
+    ret = {}
+    for res in results:
+        count, seconds = ret.get(res.worker, (0, 0.0))
+        ret[res.worker] = count + 1, seconds + res.seconds
+    return ret
+
+
+def run_job_file(path: str, engine: str, ints: str | None, workers: int | None, fold: bool, peephole: bool,
+                 cache: ProgramCache | None):
+    # src 是相对 FILE 所在目录的路径, 同一个文件只读一次
+    jobs = []
+    files = {}
+    with open(path) as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            if 'source' in job:
+                src = job['source']
+            else:
+                name = os.path.join(os.path.dirname(path), job['src'])
+                if name not in files:
+                    with open(name) as f:
+                        files[name] = f.read()
+                src = files[name]
+            jobs.append(Job(src, job.get('input', '')))
+
+    results = []
+    start = time.perf_counter()
+    for res in run_jobs(jobs, engine, ints, workers, fold, peephole, cache):
+        print(json.dumps({'output': res.output, 'error': res.error}))
+        results.append(res)
+    wall = time.perf_counter() - start
+
+    for pid, (count, seconds) in sorted(job_stats(results).items()):
+        print('worker %d: %d jobs in %.3fs, %.1f jobs/s' % (pid, count, seconds, count / seconds if seconds else 0),
+              file=sys.stderr)
+    print('%d jobs in %.3fs, %.1f jobs/s' % (len(results), wall, len(results) / wall if wall else 0), file=sys.stderr)
 
 
 def main():
-    ps = Parser(Lexer(TEST_PROGRAM))
+    ap = argparse.ArgumentParser()
+    ap.add_argument('src', nargs='?', help='PL/0 source file, runs TEST_PROGRAM if omitted')
+    ap.add_argument('--engine', choices=sorted([*IR_ENGINES, *AST_ENGINES]), default='compiled')
+    ap.add_argument('--no-fold', action='store_true', help='skip constant folding')
+    ap.add_argument('--no-peephole', action='store_true', help='skip superinstruction fusion')
+    ap.add_argument('--ints', choices=sorted(INT_MODES),
+                    help='int64 semantics with truncating division; on overflow wrap, trap or keep big ints')
+    ap.add_argument('--cache', metavar='DIR', help='reuse compiled ir from this directory')
+    ap.add_argument('--profile', action='store_true',
+                    help='run on the compiled engine and print a profile to stderr')
+    ap.add_argument('--profile-json', metavar='FILE', help='also write the profile as json')
+    ap.add_argument('--batch', metavar='FILE',
+                    help='run once per line of FILE on ir_batch, each line holds that run\'s input; needs numpy')
+    ap.add_argument('--jobs', metavar='FILE',
+                    help='run the json lines jobs in FILE, {"src": path or "source": text, "input": text}, '
+                         'on a process pool and print one json result per job')
+    ap.add_argument('--workers', type=int, help='worker processes for --jobs, all cores by default')
+    ap.add_argument('-v', '--verbose', action='store_true')
+    args = ap.parse_args()
+    # 剖析只支持 compiled 引擎
+    if args.profile or args.profile_json is not None:
+        if args.engine != 'compiled':
+            ap.error('--profile runs on the compiled engine, not %s' % args.engine)
+        args.profile = True
+    # 批量执行只支持回绕的 int64
+    if args.batch is not None:
+        if args.ints not in {None, 'wrap'}:
+            ap.error('--batch needs --ints wrap')
+        args.ints = 'wrap'
+
+    if args.jobs is not None:
+        if args.engine not in IR_ENGINES:
+            ap.error('--jobs runs on %s' % ', '.join(IR_ENGINES))
+        run_job_file(args.jobs, args.engine, args.ints, args.workers, not args.no_fold, not args.no_peephole,
+                     ProgramCache(args.cache) if args.cache is not None else None)
+        return
+
+    def run_ir(buf: list[Ir], names: list[str], srcmap: SourceMap | None = None):
+        if args.batch is not None:
+            with open(args.batch) as fp:
+                rows = [[int(tok) for tok in line.split()] for line in fp]
+            result = ir_batch(buf, len(names), rows, args.ints)
+            # 每行输入对应一行输出, 出错的 lane 在 stderr 报告行号
+            sys.stdout.write(''.join(' '.join(map(str, out)) + '\n' for out in result.outputs))
+            for lane, msg in sorted(result.errors.items()):
+                print('line %d: %s' % (lane + 1, msg), file=sys.stderr)
+            return
+
+        if not args.profile:
+            IR_ENGINES[args.engine](buf, [None] * len(names), args.ints)
+            return
+
+        profile = IrProfile(srcmap.line_table(len(buf)) if srcmap is not None else None)
+        try:
+            ir_profile(buf, [None] * len(names), args.ints, profile)
+        finally:
+            print(profile.report(), file=sys.stderr)
+            if args.profile_json is not None:
+                with open(args.profile_json, 'w') as fp:
+                    json.dump(profile.dump(), fp, indent=1)
+
+    if args.cache is not None and args.engine in {*IR_ENGINES, 'python'}:
+        if args.src is None:
+            src = TEST_PROGRAM
+        else:
+            with open(args.src) as fp:
+                src = fp.read()
+
+        cache = ProgramCache(args.cache)
+        if args.engine == 'python':
+            code, names = cache.compile_python(src, not args.no_fold, args.ints)
+            py_run(code, [None] * len(names), args.ints)
+        else:
+            buf, names = cache.compile(src, not args.no_fold, not args.no_peephole, args.ints)
+            run_ir(buf, names)
+        return
+
+    if args.src is None:
+        ast = IterParser(RegexLexer(TEST_PROGRAM)).program()
+    else:
+        # 边读边解析, 不把整个源文件读成 str
+        with open(args.src, 'rb') as fp:
+            ast = IterParser(StreamLexer(fp)).program()
+
     buf = []
-    ast = ps.program()
-    ast.gen(buf)
-    ir_eval(buf, AstEvalContext({}, {}, {}))
+    if not args.no_fold:
+        ast, removed = ast_fold(ast, args.ints)
+        if args.verbose:
+            print('fold: removed %d ir instructions' % removed, file=sys.stderr)
+
+    if args.engine in AST_ENGINES:
+        AST_ENGINES[args.engine](ast, [None] * len(ast.block.vars), args.ints)
+        return
+
+    # 剖析时按源码行汇总
+    srcmap = SourceMap() if args.profile else None
+    ast_gen(ast, buf)
+    buf, names = ir_resolve(buf, srcmap)
+    if not args.no_peephole:
+        n = len(buf)
+        buf = ir_peephole(buf, srcmap)
+        if args.verbose:
+            print('peephole: %d -> %d ir instructions' % (n, len(buf)), file=sys.stderr)
+    run_ir(buf, names, srcmap)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    try:
+        main()
+    finally:
+        # 出错时也先写出已有的输出, 再打印异常
+        stdio.flush()
\ No newline at end of file
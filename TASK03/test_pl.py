@@ -0,0 +1,99 @@
+from array import array
+
+import pytest
+
+from pl import (
+    BC_WIDTH, IR_ENGINES, AstEvalContext, IrOpCode, IterParser, RegexLexer, bc_dumps, bc_encode, bc_loads,
+    compile_program, io_channel,
+)
+
+# 融合成 IncVar/AddVarLit 的读取, 以及过程里的局部变量
+UNSET = [
+    pytest.param('var x; begin x := x + 1 end.', 'x', id='incvar'),
+    pytest.param('var x, y; begin x := y + 1 end.', 'y', id='addvarlit'),
+    pytest.param('var x, z; begin x := z - 3; !x end.', 'z', id='sub'),
+    pytest.param('procedure p; var q; begin q := 2 + q end; call p.', 'q', id='local'),
+]
+
+
+def _run(src: str, engine: str, ints: str | None = None, **options) -> tuple[list[int], str | None]:
+    buf, names = compile_program(src, ints=ints, **options)
+    out = []
+    error = None
+    try:
+        with io_channel([], out.append):
+            IR_ENGINES[engine](buf, [None] * len(names), ints)
+    except RuntimeError as e:
+        error = str(e)
+    return out, error
+
+
+@pytest.mark.parametrize('ints', ['wrap', 'trap', None])
+@pytest.mark.parametrize('engine', sorted(IR_ENGINES))
+@pytest.mark.parametrize('src, name', UNSET)
+def test_unset_fused(src, name, engine, ints):
+    # 窥孔融合前后报的错一样, 都带着变量名
+    fused = _run(src, engine, ints)
+    assert fused == _run(src, engine, ints, peephole=False)
+    assert fused[1] == 'variable %s referenced before initialization' % name
+
+
+# 改坏 Call 的层次/帧大小, 或者变量的层次/slot, 读回来时都要报错
+NESTED = 'var x; procedure p; var y; procedure q; begin y := x end; begin call q end; begin x := 1; call p end.'
+CORRUPT = [
+    pytest.param(IrOpCode.Call, 2, 5, id='call-level'),
+    pytest.param(IrOpCode.Call, 3, -1, id='call-size'),
+    pytest.param(IrOpCode.Store, 1, 3, id='var-level'),
+    pytest.param(IrOpCode.Store, 2, 1, id='outer-slot'),
+    pytest.param(IrOpCode.LoadVar, 2, 1, id='global-slot'),
+]
+
+
+@pytest.mark.parametrize('op, field, delta', CORRUPT)
+def test_bc_loads_frames(op, field, delta):
+    bc = bc_encode(*compile_program(NESTED))
+    assert bc_loads(bc_dumps(bc)).code == bc.code
+    code = array('i', bc.code)
+    i = [i for i in range(0, len(code), BC_WIDTH) if code[i] == op][-1]
+    code[i + field] += delta
+    with pytest.raises(ValueError):
+        bc_loads(bc_dumps(bc._replace(code=code)))
+
+
+# 过程里的常量遮住外层同名变量: 读到常量, 不能赋值
+SHADOW = 'var c, y; procedure p; const c = 9; begin %s end; begin c := 1; call p; !y end.'
+
+
+def _run_tree(src: str) -> list[int]:
+    ast = IterParser(RegexLexer(src)).program()
+    out = []
+    with io_channel([4], out.append):
+        ast.eval(AstEvalContext({}, {}))
+    return out
+
+
+def test_const_shadow():
+    assert _run_tree(SHADOW % 'y := c') == [9]
+    assert _run(SHADOW % 'y := c', 'eval') == ([9], None)
+
+
+@pytest.mark.parametrize('stmt', ['c := 2', '?c'])
+def test_const_assign(stmt):
+    with pytest.raises(RuntimeError, match='undefined variable: c'):
+        _run_tree(SHADOW % stmt)
+
+
+# trap 语义下折叠不能改变是否溢出: 不重排, 不展开括号, 溢出的常量子表达式留到运行时
+TRAP_FOLD = [
+    pytest.param('var a, b, c; begin a := 9223372036854775807; b := 1; c := 1; a := a - b + c; !a end.', id='reorder'),
+    pytest.param('var a; begin a := 9223372036854775807; a := (a + 1) - 1; !a end.', id='parens'),
+    pytest.param('var a; begin a := 1; if a > 5 then a := 9223372036854775807 + 1; !a end.', id='dead-overflow'),
+    pytest.param('var a; begin a := -9223372036854775807 - 1; a := -(-a) + 2 * 3 * a; !a end.', id='negate'),
+    pytest.param('var a; begin a := 7; a := 2 * 3 * a / 4 + (1 + 2) - 4611686018427387904 * 2; !a end.', id='mixed'),
+]
+
+
+@pytest.mark.parametrize('engine', sorted(IR_ENGINES))
+@pytest.mark.parametrize('src', TRAP_FOLD)
+def test_fold_trap(src, engine):
+    assert _run(src, engine, 'trap') == _run(src, engine, 'trap', fold=False)
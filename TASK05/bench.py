@@ -0,0 +1,99 @@
+import argparse
+import time
+
+from pl import IterParser, Lexer, ast_fold, ast_gen, ir_asm, ir_peephole, ir_resolve
+
+BENCH_PROGRAMS = {
+    'sum': """
+var i, s;
+begin
+    i := 0;
+    s := 0;
+    while i < 10000000 do
+    begin
+        i := i + 1;
+        s := i * 2 - 1 + s
+    end
+end.
+""",
+    'fib': """
+var a, b, n, t;
+begin
+    n := 0;
+    while n < 2000000 do
+    begin
+        a := 0;
+        b := 1;
+        t := 0;
+        while t < 5 do
+        begin
+            b := a + b;
+            a := b - a;
+            t := t + 1
+        end;
+        n := n + 1
+    end
+end.
+""",
+    'odd': """
+var i, c;
+begin
+    i := 0;
+    c := 0;
+    while i < 10000000 do
+    begin
+        if odd i then c := c + 1;
+        i := i + 1
+    end
+end.
+""",
+}
+
+
+def compile_ir(src: str):
+    ast, _ = ast_fold(IterParser(Lexer(src)).program(), 'wrap')
+    buf = []
+    ast_gen(ast, buf)
+    buf, _ = ir_resolve(buf)
+    return ir_peephole(buf)
+
+
+def best_of(repeat: int, fn) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_native(name: str, src: str, repeat: int, variants: dict[str, dict]):
+    buf = compile_ir(src)
+    times = {}
+    for label, kwargs in variants.items():
+        fn = ir_asm(buf, ints='wrap', **kwargs)
+        times[label] = best_of(repeat, fn)
+
+    base = next(iter(times.values()))
+    print('%-6s %s' % (name, '  '.join(
+        '%s %8.2f ms (x%.2f)' % (label, t * 1e3, base / t) for label, t in times.items()
+    )))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('programs', nargs='*', help='one of %s, all if omitted' % ', '.join(BENCH_PROGRAMS))
+    ap.add_argument('--repeat', type=int, default=5)
+    args = ap.parse_args()
+
+    variants = {
+        'memory': {'regalloc': False, 'vstack': False},
+        'regalloc': {'vstack': False},
+        'vstack': {},
+    }
+    for name in args.programs or BENCH_PROGRAMS:
+        bench_native(name, BENCH_PROGRAMS[name], args.repeat, variants)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,16 @@
-import copy
-import string
+import argparse
+import atexit
+import collections
+import contextlib
 import ctypes
+import re
+import string
+import sys
+import time
+from array import array
 from enum import IntEnum
-from typing import NamedTuple
+from typing import BinaryIO, Callable, Iterable, Iterator, NamedTuple
+from PeachPy.peachpy import Argument, uint64_t
 from PeachPy.peachpy.x86_64 import *
 from PeachPy.peachpy.x86_64 import abi
 from PeachPy.peachpy.x86_64.operand import *
@@ -50,11 +58,19 @@ KEYWORD_SET = {
     'odd'
 }
 
+
 dll = ctypes.CDLL(None)
 dll.dlsym.restype = ctypes.c_ulong
 
 fn_putchar = dll.dlsym(None, ctypes.create_string_buffer(b'putchar'))
 assert fn_putchar, 'putchar not found'
+fn_printf = dll.dlsym(None, ctypes.create_string_buffer(b'printf'))
+assert fn_printf, 'printf not found'
+fn_scanf = dll.dlsym(None, ctypes.create_string_buffer(b'scanf'))
+assert fn_scanf, 'scanf not found'
+
+fmt_output = ctypes.create_string_buffer(b'%ld\n')
+fmt_input = ctypes.create_string_buffer(b'%ld')
 
 class Token(NamedTuple):
     ty: TokenKind
@@ -145,10 +161,138 @@ class Lexer:
             raise SyntaxError("invaild charset " + repr(self.s[self.i]))
 
 
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+
+def int_wrap(val: int) -> int:
+    return (val - INT64_MIN) % (1 << 64) + INT64_MIN
+
+
+def int_trap(val: int) -> int:
+    raise RuntimeError('integer overflow')
+
+
+def int_div(v1: int, v2: int) -> int:
+    # 向零截断, 和 C 以及 IDIV 一致
+    if v2 == 0:
+        raise RuntimeError('division by zero')
+    q = abs(v1) // abs(v2)
+    return q if (v1 < 0) == (v2 < 0) else -q
+
+
+def _int_fix(overflow: Callable[[int], int]) -> Callable[[int], int]:
+    def fix(val: int) -> int:
+        if INT64_MIN <= val <= INT64_MAX:
+            return val
+        return overflow(val)
+    return fix
+
+
+# 整数语义, 值是规整运算结果的函数, 用 INT_MODES.get(ints) 取.
+# ints 为 None 时保持 Python 的语义, 除法得到 float; 其余都是向零截断的整数除法,
+# 结果超出 int64 时分别回绕, 报错, 或者保留 Python 大整数
+INT_MODES = {
+    'wrap': _int_fix(int_wrap),
+    'trap': _int_fix(int_trap),
+    'bigint': None,
+}
+
+
+class Pl0IO:
+    # ? 和 ! 的输入输出通道.
+    # input 是二进制流 (默认 sys.stdin.buffer) 或者整数的可迭代对象; 流在第一次读时整个读入,
+    # 按空白切分, 用到时才转成整数, 只有终端才一行一行地读.
+    # output 是二进制流 (默认 sys.stdout.buffer) 或者接受整数的函数 (比如 list.append);
+    # 写到流的输出先攒在 bytearray 里, 超过 limit 字节或者 flush 时才真正写出
+    input: 'BinaryIO | Iterable[int] | None'
+    output: 'BinaryIO | Callable[[int], object] | None'
+    limit: int
+
+    def __init__(self, input=None, output=None, limit: int = 1 << 16):
+        self.input = input
+        self.output = output
+        self.limit = limit
+        self.values = None
+        self.buf = bytearray()
+        self.sink = output if callable(output) else None
+
+    def _tokens(self, stream) -> Iterator:
+        if getattr(stream, 'isatty', lambda: False)():
+            # 终端上读之前先把提示之类的输出写出去
+            while True:
+                self.flush()
+                line = stream.readline()
+                if not line:
+                    return
+                yield from line.split()
+        data = stream.read()
+        for m in re.finditer(rb'\S+' if isinstance(data, bytes) else r'\S+', data):
+            yield m.group()
+
+    def read(self) -> int:
+        if self.values is None:
+            if self.input is None:
+                self.values = self._tokens(getattr(sys.stdin, 'buffer', sys.stdin))
+            elif hasattr(self.input, 'read'):
+                self.values = self._tokens(self.input)
+            else:
+                self.values = iter(self.input)
+        try:
+            return int(next(self.values))
+        except StopIteration:
+            raise EOFError('no more input') from None
+
+    def write(self, val: int | float):
+        if self.sink is not None:
+            self.sink(val)
+            return
+        # 旧的整数语义下除法得到 float, 按 print 的格式输出
+        self.buf += b'%d\n' % val if type(val) is int else b'%r\n' % val
+        if len(self.buf) >= self.limit:
+            self.flush()
+
+    def flush(self):
+        if not self.buf:
+            return
+        if self.output is not None:
+            self.output.write(self.buf)
+            self.output.flush()
+        elif hasattr(sys.stdout, 'buffer'):
+            sys.stdout.flush()
+            sys.stdout.buffer.write(self.buf)
+            sys.stdout.buffer.flush()
+        else:
+            sys.stdout.write(self.buf.decode())
+        self.buf.clear()
+
+
+# 当前的输入输出通道, 各个引擎执行 ? 和 ! 时都用它; 默认是标准输入输出, 退出时写出剩下的输出
+stdio = Pl0IO()
+pl0_io = stdio
+atexit.register(stdio.flush)
+
+
+@contextlib.contextmanager
+def io_channel(input=None, output=None, limit: int = 1 << 16):
+    # 执行期间换成给定的通道, 结束时写出剩下的输出
+    global pl0_io
+    saved = pl0_io
+    pl0_io = Pl0IO(input, output, limit)
+    try:
+        yield pl0_io
+    finally:
+        try:
+            pl0_io.flush()
+        finally:
+            pl0_io = saved
+
+
 class AstEvalContext(NamedTuple):
     vars: dict[str, int | None]
     procs: dict[str, 'Block | list[Ir]']
     consts: dict[str, int]
+    ints: str | None = None
 
 
 class IrOpCode(IntEnum):
@@ -173,6 +317,15 @@ class IrOpCode(IntEnum):
     DefLit = 18
     DefProc = 19
     Call = 20
+    Ret = 21
+    IncVar = 30 # LoadVar a; LoadLit c; Add; Store a, args 是 (level, slot, 变量名), value 是 c
+    AddVarLit = 31 # LoadVar a; LoadLit c; Add
+    BrIfNotEq = 32 # 比较 + BrFalse
+    BrIfNotNe = 33
+    BrIfNotLt = 34
+    BrIfNotLte = 35
+    BrIfNotGt = 36
+    BrIfNotGte = 37
     Input = 100
     Output = 101
     Halt = 255
@@ -180,8 +333,8 @@ class IrOpCode(IntEnum):
 
 class Ir(NamedTuple):
     op: IrOpCode
-    args: str | int | None = None
-    value: list['Ir'] | int | None = None
+    args: str | int | tuple[int, int] | tuple[int, int, str] | None = None
+    value: 'list[Ir] | IrProc | int | str | None' = None
 
 
 class Factor(NamedTuple):
@@ -216,6 +369,8 @@ class Factor(NamedTuple):
 
     def eval(self, ctx: AstEvalContext) -> int | None:
         if isinstance(self.value, int):
+            if (fix := INT_MODES.get(ctx.ints)) is not None:
+                return fix(self.value)
             return self.value
         elif isinstance(self.value, str):
             if (key := self.value) in ctx.vars:
@@ -271,6 +426,7 @@ class Term(NamedTuple):
     def eval(self, ctx: AstEvalContext) -> int | None:
         ret = self.lhs.eval(ctx)
         assert ret is not None, 'invalid expression lhs'
+        fix = INT_MODES.get(ctx.ints)
 
         for op, rhs in self.rhs:
             val = rhs.eval(ctx)
@@ -278,6 +434,8 @@ class Term(NamedTuple):
 
             if op == '*':
                 ret *= val
+            elif op == '/' and ctx.ints is not None:
+                ret = int_div(ret, val)
             elif op == '/':
                 if val == 0:
                     raise RuntimeError('division error')
@@ -285,6 +443,9 @@ class Term(NamedTuple):
             else:
                 raise RuntimeError('invalid expression operator')
 
+            if fix is not None:
+                ret = fix(ret)
+
         return ret
 
 
@@ -341,6 +502,9 @@ class Expression(NamedTuple):
 
         ret = self.lhs.eval(ctx) * sign
         assert ret is not None, 'invalid expression lhs'
+        fix = INT_MODES.get(ctx.ints)
+        if fix is not None:
+            ret = fix(ret)
 
         for op, rhs in self.rhs:
             val = rhs.eval(ctx)
@@ -353,6 +517,9 @@ class Expression(NamedTuple):
             else:
                 raise RuntimeError('invalid expression operator')
 
+            if fix is not None:
+                ret = fix(ret)
+
         return ret
 
 
@@ -420,9 +587,12 @@ class InputOutput(NamedTuple):
 
     def eval(self, ctx: AstEvalContext):
         if not self.is_input:
-            print(Factor(self.name).eval(ctx))
+            pl0_io.write(Factor(self.name).eval(ctx))
         elif self.name in ctx.vars:
-            ctx.vars[self.name] = int(input())
+            val = pl0_io.read()
+            if (fix := INT_MODES.get(ctx.ints)) is not None:
+                val = fix(val)
+            ctx.vars[self.name] = val
             return None
         else:
             raise RuntimeError('undefined variable: ' + self.name)
@@ -516,7 +686,7 @@ class StdCondition(NamedTuple):
             buf.append(Ir(IrOpCode.Lt))
         elif self.op == '<=':
             buf.append(Ir(IrOpCode.Lte))
-        elif self.op == '==':
+        elif self.op == '=':
             buf.append(Ir(IrOpCode.Eq))
         elif self.op == '#':
             buf.append(Ir(IrOpCode.Ne))
@@ -537,9 +707,9 @@ class StdCondition(NamedTuple):
             return 1 if lhs < rhs else 0
         elif self.op == '<=':
             return 1 if lhs <= rhs else 0
-        elif self.op == '==':
+        elif self.op == '=':
             return 1 if lhs == rhs else 0
-        elif self.op == '!=':
+        elif self.op == '#':
             return 1 if lhs != rhs else 0
         else:
             raise RuntimeError('invalid std condition operation ' + self.op)
@@ -776,7 +946,7 @@ class Parser:
             if ident.ty != TokenKind.Name:
                 raise SyntaxError('name expected')
             else:
-                return Statement(Call(ident))
+                return Statement(Call(ident.val))
 
         elif self.check(TokenKind.KeyWord, 'begin'):
             body = []
@@ -858,9 +1028,9 @@ class Parser:
         rhs = []
         while True:
             if self.check(TokenKind.Op, '+'):
-                rhs.append(('+', self.factor()))
+                rhs.append(('+', self.term()))
             elif self.check(TokenKind.Op, '-'):
-                rhs.append(('-', self.factor()))
+                rhs.append(('-', self.term()))
             else:
                 return Expression(mod, lhs, rhs)
 
@@ -869,9 +1039,9 @@ class Parser:
         lhs = self.factor()
         while True:
             if self.check(TokenKind.Op, '*'):
-                rhs.append(('*', self.term()))
+                rhs.append(('*', self.factor()))
             elif self.check(TokenKind.Op, '/'):
-                rhs.append(('/', self.term()))
+                rhs.append(('/', self.factor()))
             else:
                 return Term(lhs, rhs)
 
@@ -889,9 +1059,742 @@ class Parser:
         return Factor(expr)
 
 
-def ir_eval(buf: list[Ir], ctx: AstEvalContext):
+def _build_expression(mod: str, items: list) -> Expression:
+    # items 是 [因子, 运算符, 因子, ...], 按优先级切成项
+    terms = []
+    term_ops = []
+    lhs, rhs = items[0], []
+    for op, factor in zip(items[1::2], items[2::2]):
+        if op in {'*', '/'}:
+            rhs.append((op, factor))
+        else:
+            terms.append(Term(lhs, rhs))
+            term_ops.append(op)
+            lhs, rhs = factor, []
+    terms.append(Term(lhs, rhs))
+    return Expression(mod, terms[0], list(zip(term_ops, terms[1:])))
+
+
+class IterParser(Parser):
+    # 用显式栈代替递归下降, 嵌套深度只受内存限制
+
+    def peek(self) -> Token:
+        p = self.lx.i
+        tk = self.lx.next()
+        self.lx.i = p
+        return tk
+
+    def block(self):
+        # 外层块的 (consts, vars, procs, 正在解析的过程名)
+        stack = []
+        while True:
+            const = self.const() if self.check(TokenKind.KeyWord, 'const') else []
+            var = self.var() if self.check(TokenKind.KeyWord, 'var') else []
+            procs = []
+
+            while True:
+                if self.check(TokenKind.KeyWord, 'procedure'):
+                    ident = self.lx.next()
+                    if ident.ty != TokenKind.Name:
+                        raise SyntaxError('name expected')
+                    if not self.check(TokenKind.Op, ';'):
+                        raise SyntaxError('";" expected')
+                    stack.append((const, var, procs, ident.val))
+                    break
+
+                block = Block(const, var, procs, self.statement())
+                if not stack:
+                    return block
+
+                const, var, procs, name = stack.pop()
+                if not self.check(TokenKind.Op, ';'):
+                    raise SyntaxError('";" expected')
+                procs.append(Procedure(name, block))
+
+    def statement(self):
+        # 未完成的外层语句: ('begin', body) / ('if', cond) / ('while', cond)
+        stack = []
+        while True:
+            if self.check(TokenKind.KeyWord, 'begin'):
+                stack.append(('begin', []))
+                continue
+            elif self.check(TokenKind.KeyWord, 'if'):
+                cond = self.condition()
+                self.expect(TokenKind.KeyWord, 'then')
+                stack.append(('if', cond))
+                continue
+            elif self.check(TokenKind.KeyWord, 'while'):
+                cond = self.condition()
+                self.expect(TokenKind.KeyWord, 'do')
+                stack.append(('while', cond))
+                continue
+
+            stmt = super().statement()
+
+            # 内层语句完成, 逐层向外收尾
+            while stack:
+                kind, val = stack[-1]
+                if kind == 'begin':
+                    val.append(stmt)
+                    if not self.check(TokenKind.KeyWord, 'end'):
+                        self.expect(TokenKind.Op, ';')
+                        break
+                    stmt = Statement(Begin(val))
+                elif kind == 'if':
+                    stmt = Statement(If(val, stmt))
+                else:
+                    stmt = Statement(While(val, stmt))
+                stack.pop()
+            else:
+                return stmt
+
+    def sign(self) -> str:
+        if self.check(TokenKind.Op, '+'):
+            return '+'
+        elif self.check(TokenKind.Op, '-'):
+            return '-'
+        return ''
+
+    def expression(self):
+        # 每层括号一帧: (符号, 已读的因子和运算符)
+        stack = []
+        mod, items = self.sign(), []
+        while True:
+            tk = self.lx.next()
+            ty, val = tk.ty, tk.val
+
+            if ty == TokenKind.Op and val == '(':
+                stack.append((mod, items))
+                mod, items = self.sign(), []
+                continue
+            elif ty not in {TokenKind.Num, TokenKind.Name}:
+                raise SyntaxError('( need')
+            items.append(Factor(val))
+
+            while True:
+                tk = self.peek()
+                if tk.ty == TokenKind.Op and tk.val in {'+', '-', '*', '/'}:
+                    items.append(self.lx.next().val)
+                    break
+
+                expr = _build_expression(mod, items)
+                if not stack:
+                    return expr
+                self.expect(TokenKind.Op, ')')
+                mod, items = stack.pop()
+                items.append(Factor(expr))
+
+
+_BINARY_IR = {
+    '+': Ir(IrOpCode.Add),
+    '-': Ir(IrOpCode.Sub),
+    '*': Ir(IrOpCode.Mul),
+    '/': Ir(IrOpCode.Div),
+}
+
+_CMP_IR = {
+    '=': Ir(IrOpCode.Eq),
+    '#': Ir(IrOpCode.Ne),
+    '<': Ir(IrOpCode.Lt),
+    '<=': Ir(IrOpCode.Lte),
+    '>': Ir(IrOpCode.Gt),
+    '>=': Ir(IrOpCode.Gte),
+}
+
+
+def ast_gen(node, buf: list[Ir]):
+    # 与各节点的 gen 输出相同, 用显式栈代替递归.
+    # 栈里是待生成的节点, 现成的 Ir, 或者回填跳转的动作
+    bufs = [buf]
+    marks = []
+    stack = [node]
+
+    while stack:
+        node = stack.pop()
+        buf = bufs[-1]
+
+        match node:
+            case Ir():
+                buf.append(node)
+
+            case 'mark':
+                marks.append(len(buf))
+            case 'branch':
+                marks.append(len(buf))
+                buf.append(Ir(IrOpCode.BrFalse))
+            case 'patch':
+                i = marks.pop()
+                buf[i] = Ir(IrOpCode.BrFalse, len(buf))
+            case 'loop':
+                j = marks.pop()
+                buf.append(Ir(IrOpCode.Jump, marks.pop()))
+                buf[j] = Ir(IrOpCode.BrFalse, len(buf))
+
+            case Program(block):
+                stack += [Ir(IrOpCode.Halt), block]
+
+            case Block(consts, vars, procs, stmt):
+                for cc in consts:
+                    buf.append(Ir(IrOpCode.DefLit, cc.name, cc.value))
+                for vv in vars:
+                    buf.append(Ir(IrOpCode.DefVar, vv))
+                stack.append(stmt)
+                # 过程体生成到单独的 buf, 结束时包成 DefProc
+                for pp in reversed(procs):
+                    stack += [('proc', pp.name), pp.body, 'enter']
+            case 'enter':
+                bufs.append([])
+
+            case Statement(stmt) | Condition(stmt) | Procedure(_, stmt):
+                stack.append(stmt)
+            case Begin(body):
+                stack += reversed(body)
+            case Assign(name, expr):
+                stack += [Ir(IrOpCode.Store, name), expr]
+            case Call(name):
+                buf.append(Ir(IrOpCode.Call, name))
+            case InputOutput(name, False):
+                buf += [Ir(IrOpCode.LoadVar, name), Ir(IrOpCode.Output)]
+            case InputOutput(name, True):
+                buf += [Ir(IrOpCode.Input), Ir(IrOpCode.Store, name)]
+            case If(cond, then):
+                stack += ['patch', then, 'branch', cond]
+            case While(cond, do):
+                stack += ['loop', do, 'branch', cond, 'mark']
+
+            case OddCondition(expr):
+                stack += [Ir(IrOpCode.Odd), expr]
+            case StdCondition(op, lhs, rhs):
+                if op not in _CMP_IR:
+                    raise RuntimeError('invalid std condition operation ' + op)
+                stack += [_CMP_IR[op], rhs, lhs]
+
+            case Expression(mod, lhs, rhs):
+                for op, term in reversed(rhs):
+                    if op not in {'+', '-'}:
+                        raise RuntimeError('invalid expression operator')
+                    stack += [_BINARY_IR[op], term]
+                if mod == '-':
+                    stack.append(Ir(IrOpCode.Neg))
+                elif mod not in {'+', ''}:
+                    raise RuntimeError('invalid expression sign ' + mod)
+                stack.append(lhs)
+            case Term(lhs, rhs):
+                for op, factor in reversed(rhs):
+                    if op not in {'*', '/'}:
+                        raise RuntimeError('invalid expression operator')
+                    stack += [_BINARY_IR[op], factor]
+                stack.append(lhs)
+
+            case Factor(int(val)):
+                buf.append(Ir(IrOpCode.LoadLit, val))
+            case Factor(str(val)):
+                buf.append(Ir(IrOpCode.LoadVar, val))
+            case Factor(Expression() as expr):
+                stack.append(expr)
+
+            # 放在最后, 免得和两个字段的节点 (比如 Assign('proc', ...)) 混淆
+            case ('proc', name):
+                bufs.pop()
+                bufs[-1].append(Ir(IrOpCode.DefProc, name, buf))
+
+            case _:
+                raise RuntimeError('invalid ast node %r' % (node,))
+
+
+def _signed_terms(expr: Expression) -> list[tuple[int, Term]]:
+    if expr.mod == '-':
+        ret = [(-1, expr.lhs)]
+    elif expr.mod in {'+', ''}:
+        ret = [(1, expr.lhs)]
+    else:
+        raise RuntimeError('invalid expression sign ' + expr.mod)
+
+    for op, rhs in expr.rhs:
+        if op == '+':
+            ret.append((1, rhs))
+        elif op == '-':
+            ret.append((-1, rhs))
+        else:
+            raise RuntimeError('invalid expression operator')
+    return ret
+
+
+def _as_expression(val: int | Expression) -> Expression:
+    if isinstance(val, int):
+        return Expression('', Term(Factor(val), []), [])
+    return val
+
+
+def _fold_trapped(val: int, ints: str | None) -> bool:
+    # trap 语义下超出 int64 的常量不折叠, 留到运行时按原来的顺序报错
+    return ints == 'trap' and not INT64_MIN <= val <= INT64_MAX
+
+
+def _fold_factor(factor: Factor, consts: dict[str, int], inner: list, ints: str | None) -> int | Factor:
+    fix = INT_MODES.get(ints)
+    if isinstance(factor.value, int):
+        if _fold_trapped(factor.value, ints):
+            return factor
+        return factor.value if fix is None else fix(factor.value)
+    elif isinstance(factor.value, str):
+        val = consts.get(factor.value, factor)
+        if not isinstance(val, int) or _fold_trapped(val, ints):
+            return factor
+        return val if fix is None else fix(val)
+    elif isinstance(factor.value, Expression):
+        val, = inner
+        if isinstance(val, int):
+            return val
+        elif val.mod == '' and not val.rhs and not val.lhs.rhs:
+            return val.lhs.lhs
+        else:
+            return Factor(val)
+    else:
+        raise RuntimeError('invalid factor value')
+
+
+def _fold_term(term: Term, folded: list, ints: str | None) -> int | Term:
+    fix = INT_MODES.get(ints)
+    factors = list(zip(['*'] + [op for op, _ in term.rhs], folded))
+
+    # trap 语义下中间结果溢出就要报错, 保持原来的顺序和结合方式, 只合并开头连续的常量
+    if ints == 'trap':
+        head, i = folded[0], 1
+        while isinstance(head, int) and i < len(factors) and isinstance(factors[i][1], int):
+            op, val = factors[i]
+            if op == '/' and val == 0:
+                break
+            val = head * val if op == '*' else int_div(head, val)
+            if _fold_trapped(val, ints):
+                break
+            head, i = val, i + 1
+        if isinstance(head, int) and i == len(factors):
+            return head
+        factors = [(op, Factor(f) if isinstance(f, int) else f) for op, f in [('*', head)] + factors[i:]]
+        return Term(factors[0][1], factors[1:])
+
+    # 除法的结果依赖运算顺序, 只折叠操作数
+    if any(op == '/' for op, _ in factors):
+        factors = [(op, Factor(f) if isinstance(f, int) else f) for op, f in factors]
+        return Term(factors[0][1], factors[1:])
+
+    product = 1
+    rest = []
+    for op, f in factors:
+        if op != '*':
+            raise RuntimeError('invalid expression operator')
+        elif isinstance(f, int):
+            product *= f
+            if fix is not None:
+                product = fix(product)
+        else:
+            rest.append(f)
+
+    if not rest:
+        return product
+    elif product != 1:
+        rest.append(Factor(product))
+    return Term(rest[0], [('*', f) for f in rest[1:]])
+
+
+def _fold_expression(expr: Expression, folded: list, ints: str | None) -> int | Expression:
+    fix = INT_MODES.get(ints)
+    total = 0
+    terms = []
+
+    # 和 _fold_term 一样, trap 语义下不展开括号也不调整顺序, -(-x) 也要保留
+    if ints == 'trap':
+        signed = [(sign, Term(Factor(f), []) if isinstance(f, int) else f)
+                  for (sign, _), f in zip(_signed_terms(expr), folded)]
+        head, i = folded[0], 1
+        if isinstance(head, int) and not _fold_trapped(signed[0][0] * head, ints):
+            head = signed[0][0] * head
+            while i < len(signed) and isinstance(folded[i], int):
+                val = head + signed[i][0] * folded[i]
+                if _fold_trapped(val, ints):
+                    break
+                head, i = val, i + 1
+            if i == len(signed):
+                return head
+            signed[i - 1] = (1, Term(Factor(head), []))
+        return Expression(
+            '-' if signed[i - 1][0] < 0 else '',
+            signed[i - 1][1],
+            [('+' if sign > 0 else '-', term) for sign, term in signed[i:]],
+        )
+
+    for (sign, _), val in zip(_signed_terms(expr), folded):
+        if isinstance(val, int):
+            total += sign * val
+        elif not val.rhs and isinstance(val.lhs.value, Expression):
+            # 括号里的加减直接展开, -(-x) 在这里变成 x
+            for s2, t2 in _signed_terms(val.lhs.value):
+                if not t2.rhs and isinstance(t2.lhs.value, int):
+                    total += sign * s2 * t2.lhs.value
+                else:
+                    terms.append((sign * s2, t2))
+        else:
+            terms.append((sign, val))
+        if fix is not None:
+            total = fix(total)
+
+    if not terms:
+        return total
+    elif total == INT64_MIN and fix is not None:
+        # 取绝对值会超出 int64
+        terms.append((1, Term(Factor(total), [])))
+    elif total != 0:
+        terms.append((1 if total > 0 else -1, Term(Factor(abs(total)), [])))
+
+    # 正项放在前面, 省掉一条 Neg
+    terms.sort(key=lambda t: t[0] < 0)
+    return Expression(
+        '-' if terms[0][0] < 0 else '',
+        terms[0][1],
+        [('+' if sign > 0 else '-', term) for sign, term in terms[1:]],
+    )
+
+
+def _fold_condition(cond: Condition, folded: list) -> int | Condition:
+    if isinstance(cond.cond, OddCondition):
+        val, = folded
+        if isinstance(val, int):
+            return val & 1
+        return Condition(OddCondition(val))
+
+    lhs, rhs = folded
+    if isinstance(lhs, int) and isinstance(rhs, int):
+        return StdCondition(cond.cond.op, _as_expression(lhs), _as_expression(rhs)).eval(
+            AstEvalContext({}, {}, {}),
+        )
+    return Condition(StdCondition(cond.cond.op, _as_expression(lhs), _as_expression(rhs)))
+
+
+def _fold_statement(stmt: Statement, folded: list) -> Statement:
+    node = stmt.stmt
+
+    if isinstance(node, Assign):
+        return stmt._replace(stmt=Assign(node.name, _as_expression(folded[0])))
+
+    elif isinstance(node, Begin):
+        return stmt._replace(stmt=Begin(folded))
+
+    elif isinstance(node, If):
+        cond, then = folded
+        if isinstance(cond, int):
+            return then if cond else stmt._replace(stmt=Begin([]))
+        return stmt._replace(stmt=If(cond, then))
+
+    elif isinstance(node, While):
+        cond, do = folded
+        if isinstance(cond, int) and not cond:
+            return stmt._replace(stmt=Begin([]))
+        elif isinstance(cond, int):
+            cond = node.cond
+        return stmt._replace(stmt=While(cond, do))
+
+    else:
+        return stmt
+
+
+def _fold_block(block: Block, folded: list) -> Block:
+    return Block(
+        block.consts,
+        block.vars,
+        [pp._replace(body=body) for pp, body in zip(block.procs, folded)],
+        folded[-1],
+    )
+
+
+def _fold_children(node, consts: dict[str, int]) -> tuple[dict[str, int], list]:
+    match node:
+        case Factor(Expression() as expr):
+            return consts, [expr]
+        case Term(lhs, rhs):
+            return consts, [lhs] + [f for _, f in rhs]
+        case Expression():
+            return consts, [t for _, t in _signed_terms(node)]
+        case Condition(OddCondition(expr)):
+            return consts, [expr]
+        case Condition(StdCondition(_, lhs, rhs)):
+            return consts, [lhs, rhs]
+        case Statement(Assign(_, expr)):
+            return consts, [expr]
+        case Statement(Begin(body)):
+            return consts, body
+        case Statement(If(cond, stmt) | While(cond, stmt)):
+            return consts, [cond, stmt]
+        case Block():
+            consts = {k: v for k, v in consts.items() if k not in node.vars}
+            consts.update((cc.name, cc.value) for cc in node.consts)
+            return consts, [pp.body for pp in node.procs] + [node.stmt]
+        case _:
+            return consts, []
+
+
+def _fold_node(node, consts: dict[str, int], folded: list, ints: str | None):
+    match node:
+        case Factor():
+            return _fold_factor(node, consts, folded, ints)
+        case Term():
+            return _fold_term(node, folded, ints)
+        case Expression():
+            return _fold_expression(node, folded, ints)
+        case Condition():
+            return _fold_condition(node, folded)
+        case Statement():
+            return _fold_statement(node, folded)
+        case Block():
+            return _fold_block(node, folded)
+        case _:
+            raise RuntimeError('invalid ast node %r' % (node,))
+
+
+def _fold(root, consts: dict[str, int], ints: str | None = None):
+    # 后序遍历, 子节点先折叠; 用显式栈, 嵌套深度不受递归限制
+    stack = [(root, consts, None)]
+    out = []
+    while stack:
+        node, consts, n = stack.pop()
+        if n is None:
+            inner, children = _fold_children(node, consts)
+            stack.append((node, consts, len(children)))
+            stack += [(child, inner, None) for child in reversed(children)]
+        else:
+            folded = out[len(out) - n:]
+            del out[len(out) - n:]
+            out.append(_fold_node(node, consts, folded, ints))
+    return out[0]
+
+
+def ast_fold(program: Program, ints: str | None = None) -> tuple[Program, int]:
+    before = []
+    after = []
+    ret = Program(_fold(program.block, {}, ints))
+
+    ast_gen(program, before)
+    ast_gen(ret, after)
+    return ret, _ir_size(before) - _ir_size(after)
+
+
+def _ir_size(buf: list[Ir]) -> int:
+    n = 0
+    stack = [buf]
+    while stack:
+        for ir in stack.pop():
+            if ir.op == IrOpCode.DefProc:
+                stack.append(ir.value)
+            else:
+                n += 1
+    return n
+
+
+class IrProc(NamedTuple):
+    name: str
+    level: int
+    size: int
+
+
+def ir_resolve(buf: list[Ir]) -> tuple[list[Ir], list[str]]:
+    ret = []
+    names = []
+    pending = collections.deque()
+    calls = []
+
+    def lookup(scopes: list[dict], name: str) -> tuple[IrOpCode, any]:
+        for scope in reversed(scopes):
+            if name in scope:
+                return scope[name]
+        raise RuntimeError('undefined symbol: ' + name)
+
+    def resolve(body: list[Ir], scopes: list[dict], level: int) -> int:
+        scope = {}
+        size = 0
+
+        # 先登记本层所有声明, 过程体里可以引用同层后面定义的过程
+        for ir in body:
+            if ir.op not in {IrOpCode.DefVar, IrOpCode.DefLit, IrOpCode.DefProc}:
+                continue
+            elif not isinstance(ir.args, str):
+                raise RuntimeError('invalid declaration args')
+            elif ir.args in scope:
+                raise RuntimeError('variable redeclared: ' + ir.args)
+            elif ir.op == IrOpCode.DefVar:
+                scope[ir.args] = (ir.op, (level, size))
+                size += 1
+                if level == 0:
+                    names.append(ir.args)
+            elif ir.op == IrOpCode.DefLit:
+                if not isinstance(ir.value, int):
+                    raise RuntimeError('invalid deflit args')
+                scope[ir.args] = (ir.op, ir.value)
+            else:
+                if not isinstance(ir.value, list):
+                    raise RuntimeError('invalid defproc args')
+                proc = {'name': ir.args}
+                scope[ir.args] = (ir.op, proc)
+                pending.append((ir.value, scopes + [scope], level + 1, proc))
+
+        scopes = scopes + [scope]
+
+        # 声明被删掉之后, 跳转目标需要重新映射
+        remap = []
+        n = len(ret)
+        for ir in body:
+            remap.append(n)
+            if ir.op not in {IrOpCode.DefVar, IrOpCode.DefLit, IrOpCode.DefProc}:
+                n += 1
+        remap.append(n)
+
+        for ir in body:
+            if ir.op in {IrOpCode.DefVar, IrOpCode.DefLit, IrOpCode.DefProc}:
+                continue
+
+            elif ir.op == IrOpCode.LoadVar:
+                kind, val = lookup(scopes, ir.args)
+                if kind == IrOpCode.DefLit:
+                    ret.append(Ir(IrOpCode.LoadLit, val))
+                elif kind == IrOpCode.DefVar:
+                    ret.append(Ir(IrOpCode.LoadVar, val, ir.args))
+                else:
+                    raise RuntimeError('invalid loadvar args')
+
+            elif ir.op == IrOpCode.Store:
+                kind, val = lookup(scopes, ir.args)
+                if kind != IrOpCode.DefVar:
+                    raise RuntimeError('undefined variable: ' + ir.args)
+                ret.append(Ir(IrOpCode.Store, val, ir.args))
+
+            elif ir.op == IrOpCode.Call:
+                kind, val = lookup(scopes, ir.args)
+                if kind != IrOpCode.DefProc:
+                    raise RuntimeError('procedure called not existed.')
+                calls.append((len(ret), val))
+                ret.append(Ir(IrOpCode.Call))
+
+            elif ir.op in {IrOpCode.Jump, IrOpCode.BrFalse}:
+                if not isinstance(ir.args, int) or not (0 <= ir.args <= len(body)):
+                    raise RuntimeError('branch out of bounds')
+                ret.append(Ir(ir.op, remap[ir.args]))
+
+            else:
+                ret.append(ir)
+
+        return size
+
+    # 主程序在前, 以 Halt 结束, 过程体依次排在后面, 以 Ret 结束
+    resolve(buf, [], 0)
+    if not ret or ret[-1].op != IrOpCode.Halt:
+        ret.append(Ir(IrOpCode.Halt))
+
+    while pending:
+        body, scopes, level, proc = pending.popleft()
+        proc['entry'] = len(ret)
+        proc['proc'] = IrProc(proc['name'], level, resolve(body, scopes, level))
+        ret.append(Ir(IrOpCode.Ret))
+
+    for i, proc in calls:
+        ret[i] = Ir(IrOpCode.Call, proc['entry'], proc['proc'])
+
+    return ret, names
+
+
+_FUSED_BRANCH = {
+    IrOpCode.Eq: IrOpCode.BrIfNotEq,
+    IrOpCode.Ne: IrOpCode.BrIfNotNe,
+    IrOpCode.Lt: IrOpCode.BrIfNotLt,
+    IrOpCode.Lte: IrOpCode.BrIfNotLte,
+    IrOpCode.Gt: IrOpCode.BrIfNotGt,
+    IrOpCode.Gte: IrOpCode.BrIfNotGte,
+}
+
+IR_BRANCHES = {IrOpCode.Jump, IrOpCode.BrFalse, IrOpCode.Call, *_FUSED_BRANCH.values()}
+
+
+def _peephole_match(buf: list[Ir], i: int, targets: set[int]) -> tuple[Ir, int]:
+    ops = [ir.op for ir in buf[i:i + 4]]
+
+    # 窗口内部不能有跳转目标
+    def fusable(n: int) -> bool:
+        return len(ops) >= n and not any(j in targets for j in range(i + 1, i + n))
+
+    if ops[:3] in ([IrOpCode.LoadVar, IrOpCode.LoadLit, IrOpCode.Add], [IrOpCode.LoadVar, IrOpCode.LoadLit, IrOpCode.Sub]):
+        var, lit = buf[i], buf[i + 1].args
+        if ops[2] == IrOpCode.Sub:
+            lit = -lit
+
+        if fusable(4) and ops[3] == IrOpCode.Store and buf[i + 3].args == var.args:
+            return Ir(IrOpCode.IncVar, (*var.args, var.value), lit), 4
+        elif fusable(3):
+            return Ir(IrOpCode.AddVarLit, (*var.args, var.value), lit), 3
+
+    elif ops[:4] == [IrOpCode.LoadLit, IrOpCode.LoadVar, IrOpCode.Add, IrOpCode.Store]:
+        if fusable(4) and buf[i + 3].args == buf[i + 1].args:
+            var = buf[i + 1]
+            return Ir(IrOpCode.IncVar, (*var.args, var.value), buf[i].args), 4
+
+    elif ops[0] in _FUSED_BRANCH and ops[1:2] == [IrOpCode.BrFalse] and fusable(2):
+        return Ir(_FUSED_BRANCH[ops[0]], buf[i + 1].args), 2
+
+    return buf[i], 1
+
+
+def ir_peephole(buf: list[Ir]) -> list[Ir]:
+    targets = {ir.args for ir in buf if ir.op in IR_BRANCHES}
+
+    ret = []
+    remap = {}
+    i = 0
+    while i < len(buf):
+        remap[i] = len(ret)
+        ir, n = _peephole_match(buf, i, targets)
+        ret.append(ir)
+        i += n
+    remap[len(buf)] = len(ret)
+
+    for i, ir in enumerate(ret):
+        if ir.op in IR_BRANCHES:
+            ret[i] = ir._replace(args=remap[ir.args])
+
+    return ret
+
+
+def compile_program(src: str, fold: bool = True, peephole: bool = True,
+                    ints: str | None = None) -> tuple[list[Ir], list[str]]:
+    ast = IterParser(Lexer(src)).program()
+    if fold:
+        ast, _ = ast_fold(ast, ints)
+
+    buf = []
+    ast_gen(ast, buf)
+    buf, names = ir_resolve(buf)
+    if peephole:
+        buf = ir_peephole(buf)
+    return buf, names
+
+
+def _ir_fix_literals(buf: list[Ir], fix: Callable[[int], int]) -> list[Ir]:
+    # 字面量先按整数语义规整, 运行时只需要检查运算结果
+    ret = []
+    for ir in buf:
+        if ir.op == IrOpCode.LoadLit:
+            ir = ir._replace(args=fix(ir.args))
+        elif ir.op in {IrOpCode.IncVar, IrOpCode.AddVarLit}:
+            ir = ir._replace(value=fix(ir.value))
+        ret.append(ir)
+    return ret
+
+
+def ir_eval(buf: list[Ir], slots: list[int | None], ints: str | None = None):
+    fix = INT_MODES.get(ints)
+    if fix is not None:
+        buf = _ir_fix_literals(buf, fix)
+
     pc = 0
     sp = []
+    display = [slots]
+    rstack = []
 
     while pc < len(buf):
         ir = buf[pc]
@@ -901,29 +1804,31 @@ def ir_eval(buf: list[Ir], ctx: AstEvalContext):
         if ir.op == IrOpCode.Add:
             v2 = sp.pop()
             v1 = sp.pop()
-            sp.append(v1 + v2)
+            sp.append(v1 + v2 if fix is None else fix(v1 + v2))
 
         elif ir.op == IrOpCode.Sub:
             v2 = sp.pop()
             v1 = sp.pop()
-            sp.append(v1 - v2)
+            sp.append(v1 - v2 if fix is None else fix(v1 - v2))
 
         elif ir.op == IrOpCode.Mul:
             v2 = sp.pop()
             v1 = sp.pop()
-            sp.append(v1 * v2)
+            sp.append(v1 * v2 if fix is None else fix(v1 * v2))
 
         elif ir.op == IrOpCode.Div:
             v2 = sp.pop()
             v1 = sp.pop()
 
-            if v2 == 0:
+            if ints is not None:
+                sp.append(int_div(v1, v2) if fix is None else fix(int_div(v1, v2)))
+            elif v2 == 0:
                 raise RuntimeError('division by zero')
             else:
                 sp.append(v1 / v2)
 
         elif ir.op == IrOpCode.Neg:
-            sp[-1] = -sp[-1]
+            sp[-1] = -sp[-1] if fix is None else fix(-sp[-1])
 
         elif ir.op == IrOpCode.Eq:
             v2 = sp.pop()
@@ -959,23 +1864,12 @@ def ir_eval(buf: list[Ir], ctx: AstEvalContext):
             sp[-1] = sp[-1] & 1
 
         elif ir.op == IrOpCode.LoadVar:
-            if not isinstance(ir.args, str):
-                raise RuntimeError('invalid loadvar args')
-
-            elif ir.args in ctx.vars:
-                key = ir.args
-                val = ctx.vars[key]
-
-                if val is None:
-                    raise RuntimeError('variable %s referenced before initialization' % key)
-                else:
-                    sp.append(val)
-
-            elif ir.args in ctx.consts:
-                sp.append(ctx.consts[ir.args])
-
+            level, slot = ir.args
+            val = display[level][slot]
+            if val is None:
+                raise RuntimeError('variable %s referenced before initialization' % ir.value)
             else:
-                raise RuntimeError('undefined variable: ' + ir.args)
+                sp.append(val)
 
         elif ir.op == IrOpCode.LoadLit:
             if not isinstance(ir.args, int):
@@ -984,17 +1878,13 @@ def ir_eval(buf: list[Ir], ctx: AstEvalContext):
                 sp.append(ir.args)
 
         elif ir.op == IrOpCode.Store:
-            if not isinstance(ir.args, str):
-                raise RuntimeError('invalid store args')
-            elif ir.args not in ctx.vars:
-                raise RuntimeError('undefined variable: ' + ir.args)
-            else:
-                ctx.vars[ir.args] = sp.pop()
+            level, slot = ir.args
+            display[level][slot] = sp.pop()
 
         elif ir.op == IrOpCode.Jump:
             if not isinstance(ir.args, int):
                 raise RuntimeError('invalid jump args')
-            elif 0 <= ir.args < len(buf):
+            elif 0 <= ir.args <= len(buf):
                 pc = ir.args
             else:
                 raise RuntimeError('branch out of bounds')
@@ -1003,52 +1893,75 @@ def ir_eval(buf: list[Ir], ctx: AstEvalContext):
             if not sp.pop():
                 if not isinstance(ir.args, int):
                     raise RuntimeError('invalid brfalse args')
-                elif 0 <= ir.args < len(buf):
+                elif 0 <= ir.args <= len(buf):
                     pc = ir.args
                 else:
                     raise RuntimeError('branch out of bounds')
 
-        elif ir.op == IrOpCode.DefVar:
-            if not isinstance(ir.args, str):
-                raise RuntimeError('invalid defvar args')
-            elif ir.args in ctx.vars or ir.args in ctx.procs or ir.args in ctx.consts:
-                raise RuntimeError('variable redeclared: ' + ir.args)
-            else:
-                ctx.vars[ir.args] = None
+        elif ir.op == IrOpCode.Call:
+            if not isinstance(ir.value, IrProc):
+                raise RuntimeError('procedure called not existed.')
 
-        elif ir.op == IrOpCode.DefLit:
-            if not isinstance(ir.args, str) or not isinstance(ir.value, int):
-                raise RuntimeError('invalid deflit args')
-            elif ir.args in ctx.vars or ir.args in ctx.procs or ir.args in ctx.consts:
-                raise RuntimeError('variable redeclared: ' + ir.args)
+            # display[level] 指向该层最近一次活动的栈帧, 返回时恢复
+            proc = ir.value
+            frame = [None] * proc.size
+            if proc.level == len(display):
+                rstack.append((pc, proc.level, None))
+                display.append(frame)
             else:
-                ctx.consts[ir.args] = ir.value
+                rstack.append((pc, proc.level, display[proc.level]))
+                display[proc.level] = frame
+            pc = ir.args
+
+        elif ir.op == IrOpCode.Ret:
+            pc, level, frame = rstack.pop()
+            display[level] = frame
+
+        elif ir.op == IrOpCode.IncVar:
+            level, slot, name = ir.args
+            val = display[level][slot]
+            if val is None:
+                raise RuntimeError('variable %s referenced before initialization' % name)
+            else:
+                display[level][slot] = val + ir.value if fix is None else fix(val + ir.value)
 
-        elif ir.op == IrOpCode.DefProc:
-            if not isinstance(ir.args, str) or not isinstance(ir.value, list):
-                raise RuntimeError('invalid defproc args')
-            elif ir.args in ctx.vars or ir.args in ctx.procs or ir.args in ctx.consts:
-                raise RuntimeError('variable redeclare: ' + ir.args)
+        elif ir.op == IrOpCode.AddVarLit:
+            level, slot, name = ir.args
+            val = display[level][slot]
+            if val is None:
+                raise RuntimeError('variable %s referenced before initialization' % name)
             else:
-                ctx.procs[ir.args] = ir.value
+                sp.append(val + ir.value if fix is None else fix(val + ir.value))
 
-        elif ir.op == IrOpCode.Call:
-            if ir.args not in ctx.procs:
-                raise RuntimeError('procedure called not existed.')
+        elif ir.op in {IrOpCode.BrIfNotEq, IrOpCode.BrIfNotNe, IrOpCode.BrIfNotLt,
+                       IrOpCode.BrIfNotLte, IrOpCode.BrIfNotGt, IrOpCode.BrIfNotGte}:
+            v2 = sp.pop()
+            v1 = sp.pop()
+
+            if ir.op == IrOpCode.BrIfNotEq:
+                cond = v1 == v2
+            elif ir.op == IrOpCode.BrIfNotNe:
+                cond = v1 != v2
+            elif ir.op == IrOpCode.BrIfNotLt:
+                cond = v1 < v2
+            elif ir.op == IrOpCode.BrIfNotLte:
+                cond = v1 <= v2
+            elif ir.op == IrOpCode.BrIfNotGt:
+                cond = v1 > v2
             else:
-                block = ctx.procs[ir.args]
-                temp_ctx = copy.deepcopy(ctx)
-                temp_buf = copy.deepcopy(block)
-                ir_eval(temp_buf, temp_ctx)
-                for k, v in temp_ctx.vars.items():
-                    if k in ctx.vars:
-                        ctx.vars[k] = v
+                cond = v1 >= v2
+
+            if not cond:
+                if not (0 <= ir.args <= len(buf)):
+                    raise RuntimeError('branch out of bounds')
+                pc = ir.args
 
         elif ir.op == IrOpCode.Input:
-            sp.append(int(input()))
+            val = pl0_io.read()
+            sp.append(val if fix is None else fix(val))
 
         elif ir.op == IrOpCode.Output:
-            print(sp.pop())
+            pl0_io.write(sp.pop())
 
         elif ir.op == IrOpCode.Halt:
             break
@@ -1057,150 +1970,1226 @@ def ir_eval(buf: list[Ir], ctx: AstEvalContext):
             raise RuntimeError('invalid instruction')
 
 
-def ir_asm(buf: list[Ir]) -> bytes:
-    brtab = {}
-    pctab = []
-    littab = {}
-    vartab = {}
+IrHandler = Callable[[list[int], list[list[int | None]], list[tuple]], int]
+
+
+def _compile_binary(fn: Callable[[int, int], int], nxt: int) -> IrHandler:
+    def handler(sp, display, rstack):
+        v2 = sp.pop()
+        sp[-1] = fn(sp[-1], v2)
+        return nxt
+    return handler
+
+
+def _compile_branch(fn: Callable[[int, int], bool], ir: Ir, nxt: int, n: int) -> IrHandler:
+    if not isinstance(ir.args, int):
+        raise RuntimeError('invalid branch args')
+    elif not (0 <= ir.args <= n):
+        raise RuntimeError('branch out of bounds')
+    target = ir.args
+
+    def handler(sp, display, rstack):
+        v2 = sp.pop()
+        v1 = sp.pop()
+        return nxt if fn(v1, v2) else target
+    return handler
+
+
+def _compile_int(ir: Ir, nxt: int, fix: Callable[[int], int] | None) -> IrHandler:
+    # 整数语义下的算术; 结果在 int64 范围内时不调用 fix
+    lo, hi = INT64_MIN, INT64_MAX
+    if fix is None:
+        # 大整数模式不会溢出, 只有除法不一样
+        lo, hi = float('-inf'), float('inf')
+
+    match ir.op:
+        case IrOpCode.Add:
+            def handler(sp, display, rstack):
+                v2 = sp.pop()
+                val = sp[-1] + v2
+                sp[-1] = val if lo <= val <= hi else fix(val)
+                return nxt
+
+        case IrOpCode.Sub:
+            def handler(sp, display, rstack):
+                v2 = sp.pop()
+                val = sp[-1] - v2
+                sp[-1] = val if lo <= val <= hi else fix(val)
+                return nxt
+
+        case IrOpCode.Mul:
+            def handler(sp, display, rstack):
+                v2 = sp.pop()
+                val = sp[-1] * v2
+                sp[-1] = val if lo <= val <= hi else fix(val)
+                return nxt
+
+        case IrOpCode.Div:
+            def handler(sp, display, rstack):
+                v2 = sp.pop()
+                val = int_div(sp[-1], v2)
+                sp[-1] = val if lo <= val <= hi else fix(val)
+                return nxt
+
+        case IrOpCode.Neg:
+            def handler(sp, display, rstack):
+                val = -sp[-1]
+                sp[-1] = val if lo <= val <= hi else fix(val)
+                return nxt
+
+        case IrOpCode.IncVar:
+            (level, slot, name), lit = ir.args, ir.value
+
+            def handler(sp, display, rstack):
+                frame = display[level]
+                val = frame[slot]
+                if val is None:
+                    raise RuntimeError('variable %s referenced before initialization' % name)
+                val += lit
+                frame[slot] = val if lo <= val <= hi else fix(val)
+                return nxt
 
-    nbuf = [
-        PUSH(rbp),
-        MOV(rbp, rsp),
-        None,
-        PUSH(r15),
-    ]
+        case IrOpCode.AddVarLit:
+            (level, slot, name), lit = ir.args, ir.value
+
+            def handler(sp, display, rstack):
+                val = display[level][slot]
+                if val is None:
+                    raise RuntimeError('variable %s referenced before initialization' % name)
+                val += lit
+                sp.append(val if lo <= val <= hi else fix(val))
+                return nxt
+
+        case IrOpCode.Input:
+            def handler(sp, display, rstack):
+                val = pl0_io.read()
+                sp.append(val if lo <= val <= hi else fix(val))
+                return nxt
+
+        case _:
+            raise RuntimeError('invalid instruction')
+
+    return handler
+
+
+_INT_OPS = {
+    IrOpCode.Add, IrOpCode.Sub, IrOpCode.Mul, IrOpCode.Div, IrOpCode.Neg,
+    IrOpCode.IncVar, IrOpCode.AddVarLit, IrOpCode.Input,
+}
+
+
+def _compile_ir(ir: Ir, nxt: int, n: int, ints: str | None = None) -> IrHandler:
+    if ints is not None and ir.op in _INT_OPS:
+        if ir.op in {IrOpCode.IncVar, IrOpCode.AddVarLit} and (
+                not isinstance(ir.args, tuple) or not isinstance(ir.value, int)):
+            raise RuntimeError('invalid incvar args')
+        return _compile_int(ir, nxt, INT_MODES.get(ints))
+
+    match ir.op:
+        case IrOpCode.Add:
+            def handler(sp, display, rstack):
+                v2 = sp.pop()
+                sp[-1] += v2
+                return nxt
+
+        case IrOpCode.Sub:
+            def handler(sp, display, rstack):
+                v2 = sp.pop()
+                sp[-1] -= v2
+                return nxt
+
+        case IrOpCode.Mul:
+            def handler(sp, display, rstack):
+                v2 = sp.pop()
+                sp[-1] *= v2
+                return nxt
+
+        case IrOpCode.Div:
+            def handler(sp, display, rstack):
+                v2 = sp.pop()
+                if v2 == 0:
+                    raise RuntimeError('division by zero')
+                sp[-1] /= v2
+                return nxt
+
+        case IrOpCode.Neg:
+            def handler(sp, display, rstack):
+                sp[-1] = -sp[-1]
+                return nxt
+
+        case IrOpCode.Eq:
+            return _compile_binary(lambda v1, v2: int(v1 == v2), nxt)
+        case IrOpCode.Ne:
+            return _compile_binary(lambda v1, v2: int(v1 != v2), nxt)
+        case IrOpCode.Lt:
+            return _compile_binary(lambda v1, v2: int(v1 < v2), nxt)
+        case IrOpCode.Lte:
+            return _compile_binary(lambda v1, v2: int(v1 <= v2), nxt)
+        case IrOpCode.Gt:
+            return _compile_binary(lambda v1, v2: int(v1 > v2), nxt)
+        case IrOpCode.Gte:
+            return _compile_binary(lambda v1, v2: int(v1 >= v2), nxt)
+
+        case IrOpCode.Odd:
+            def handler(sp, display, rstack):
+                sp[-1] &= 1
+                return nxt
+
+        case IrOpCode.LoadVar:
+            if not isinstance(ir.args, tuple):
+                raise RuntimeError('invalid loadvar args')
+            (level, slot), name = ir.args, ir.value
+
+            def handler(sp, display, rstack):
+                val = display[level][slot]
+                if val is None:
+                    raise RuntimeError('variable %s referenced before initialization' % name)
+                sp.append(val)
+                return nxt
+
+        case IrOpCode.LoadLit:
+            if not isinstance(ir.args, int):
+                raise RuntimeError('invalid loadvar args')
+            lit = ir.args
+
+            def handler(sp, display, rstack):
+                sp.append(lit)
+                return nxt
+
+        case IrOpCode.Store:
+            if not isinstance(ir.args, tuple):
+                raise RuntimeError('invalid store args')
+            level, slot = ir.args
+
+            def handler(sp, display, rstack):
+                display[level][slot] = sp.pop()
+                return nxt
+
+        case IrOpCode.Jump:
+            if not isinstance(ir.args, int):
+                raise RuntimeError('invalid jump args')
+            elif not (0 <= ir.args <= n):
+                raise RuntimeError('branch out of bounds')
+            target = ir.args
+
+            def handler(sp, display, rstack):
+                return target
+
+        case IrOpCode.BrFalse:
+            if not isinstance(ir.args, int):
+                raise RuntimeError('invalid brfalse args')
+            elif not (0 <= ir.args <= n):
+                raise RuntimeError('branch out of bounds')
+            target = ir.args
+
+            def handler(sp, display, rstack):
+                return nxt if sp.pop() else target
+
+        case IrOpCode.Call:
+            if not isinstance(ir.value, IrProc):
+                raise RuntimeError('procedure called not existed.')
+            elif not (0 <= ir.args < n):
+                raise RuntimeError('branch out of bounds')
+            entry, level, size = ir.args, ir.value.level, ir.value.size
+
+            def handler(sp, display, rstack):
+                if level == len(display):
+                    rstack.append((nxt, level, None))
+                    display.append([None] * size)
+                else:
+                    rstack.append((nxt, level, display[level]))
+                    display[level] = [None] * size
+                return entry
+
+        case IrOpCode.Ret:
+            def handler(sp, display, rstack):
+                pc, level, frame = rstack.pop()
+                display[level] = frame
+                return pc
+
+        case IrOpCode.IncVar:
+            if not isinstance(ir.args, tuple) or not isinstance(ir.value, int):
+                raise RuntimeError('invalid incvar args')
+            (level, slot, name), lit = ir.args, ir.value
+
+            def handler(sp, display, rstack):
+                frame = display[level]
+                val = frame[slot]
+                if val is None:
+                    raise RuntimeError('variable %s referenced before initialization' % name)
+                frame[slot] = val + lit
+                return nxt
+
+        case IrOpCode.AddVarLit:
+            if not isinstance(ir.args, tuple) or not isinstance(ir.value, int):
+                raise RuntimeError('invalid addvarlit args')
+            (level, slot, name), lit = ir.args, ir.value
+
+            def handler(sp, display, rstack):
+                val = display[level][slot]
+                if val is None:
+                    raise RuntimeError('variable %s referenced before initialization' % name)
+                sp.append(val + lit)
+                return nxt
+
+        case IrOpCode.BrIfNotEq:
+            return _compile_branch(lambda v1, v2: v1 == v2, ir, nxt, n)
+        case IrOpCode.BrIfNotNe:
+            return _compile_branch(lambda v1, v2: v1 != v2, ir, nxt, n)
+        case IrOpCode.BrIfNotLt:
+            return _compile_branch(lambda v1, v2: v1 < v2, ir, nxt, n)
+        case IrOpCode.BrIfNotLte:
+            return _compile_branch(lambda v1, v2: v1 <= v2, ir, nxt, n)
+        case IrOpCode.BrIfNotGt:
+            return _compile_branch(lambda v1, v2: v1 > v2, ir, nxt, n)
+        case IrOpCode.BrIfNotGte:
+            return _compile_branch(lambda v1, v2: v1 >= v2, ir, nxt, n)
+
+        case IrOpCode.Input:
+            def handler(sp, display, rstack):
+                sp.append(pl0_io.read())
+                return nxt
+
+        case IrOpCode.Output:
+            def handler(sp, display, rstack):
+                pl0_io.write(sp.pop())
+                return nxt
+
+        case IrOpCode.Halt:
+            def handler(sp, display, rstack):
+                return n
+
+        case _:
+            raise RuntimeError('invalid instruction')
+
+    return handler
 
-    for i, ir in enumerate(buf):
-        pc = len(nbuf)
-        pctab.append(pc)
 
+def ir_compile(buf: list[Ir], ints: str | None = None) -> list[IrHandler]:
+    if (fix := INT_MODES.get(ints)) is not None:
+        buf = _ir_fix_literals(buf, fix)
+    return [_compile_ir(ir, i + 1, len(buf), ints) for i, ir in enumerate(buf)]
+
+
+def ir_run(code: list[IrHandler], slots: list[int | None]):
+    sp = []
+    display = [slots]
+    rstack = []
+
+    pc = 0
+    n = len(code)
+    while pc < n:
+        pc = code[pc](sp, display, rstack)
+
+
+# 给主程序变量分配的寄存器, callee-saved 的排在前面; r8-r10 调外部函数前后要保存
+REG_POOL = (r12, r14, r15, r8, r9, r10)
+CALLER_SAVED = {r8, r9, r10}
+
+# 虚拟操作数栈用的临时寄存器; rdx 留给 display 寻址和 IDIV
+SCRATCH = (rax, rcx, rsi, rdi, r11)
+_LOW8 = {rax: al, rcx: cl, rsi: sil, rdi: dil, r11: r11b}
+_LOW32 = {rax: eax, rcx: ecx, rsi: esi, rdi: edi, r11: r11d}
+
+# 比较和条件分支对应的条件码, 分支是条件不成立时跳
+_ASM_CC = {
+    IrOpCode.Eq: 'e',
+    IrOpCode.Ne: 'ne',
+    IrOpCode.Lt: 'l',
+    IrOpCode.Lte: 'le',
+    IrOpCode.Gt: 'g',
+    IrOpCode.Gte: 'ge',
+}
+_ASM_CC.update({br: _ASM_CC[op] for op, br in _FUSED_BRANCH.items()})
+_CC_SWAP = {'e': 'e', 'ne': 'ne', 'l': 'g', 'le': 'ge', 'g': 'l', 'ge': 'le'}
+_CC_NOT = {'e': 'ne', 'ne': 'e', 'l': 'ge', 'le': 'g', 'g': 'le', 'ge': 'l'}
+_CC_EVAL = {
+    'e': lambda a, b: a == b,
+    'ne': lambda a, b: a != b,
+    'l': lambda a, b: a < b,
+    'le': lambda a, b: a <= b,
+    'g': lambda a, b: a > b,
+    'ge': lambda a, b: a >= b,
+}
+_SETCC = {'e': SETE, 'ne': SETNE, 'l': SETL, 'le': SETLE, 'g': SETG, 'ge': SETGE}
+_JCC = {'e': JE, 'ne': JNE, 'l': JL, 'le': JLE, 'g': JG, 'ge': JGE}
+
+# 原生代码出错时的返回值, 按 uint64_t 取回来
+NATIVE_DIV_ERROR = -1
+NATIVE_OVERFLOW_ERROR = -2
+NATIVE_IO_ERROR = -3
+NATIVE_ERRORS = {
+    NATIVE_DIV_ERROR & ((1 << 64) - 1): 'division by zero',
+    NATIVE_OVERFLOW_ERROR & ((1 << 64) - 1): 'integer overflow',
+    NATIVE_IO_ERROR & ((1 << 64) - 1): 'i/o callback failed',
+}
+
+
+def _imm32(v: int) -> bool:
+    return -(1 << 31) <= v < (1 << 31)
+
+
+def _s64(v: int) -> int:
+    return ((v + (1 << 63)) & ((1 << 64) - 1)) - (1 << 63)
+
+
+def _ir_var(ir: Ir) -> tuple[int, int] | None:
+    if ir.op in {IrOpCode.LoadVar, IrOpCode.Store, IrOpCode.IncVar, IrOpCode.AddVarLit}:
+        return ir.args[:2]
+    return None
+
+
+def _ir_region_procs(buf: list[Ir], region: tuple[int, int]) -> dict[int, tuple[int, int]]:
+    # region 直接或间接调用的过程: 入口 -> (Ret 的位置, 静态层次)
+    procs = {}
+    pending = [region]
+    while pending:
+        start, end = pending.pop()
+        for ir in buf[start:end + 1]:
+            if ir.op != IrOpCode.Call or ir.args in procs:
+                continue
+            elif not isinstance(ir.value, IrProc) or not (0 <= ir.args < len(buf)):
+                raise RuntimeError('procedure called not existed.')
+            ret = next((i for i in range(ir.args, len(buf)) if buf[i].op == IrOpCode.Ret), None)
+            if ret is None:
+                raise RuntimeError('invalid procedure entry')
+            procs[ir.args] = (ret, ir.value.level)
+            pending.append((ir.args, ret))
+    return procs
+
+
+def _ir_region_code(buf: list[Ir], region: tuple[int, int]) -> list[int]:
+    # 分层执行时原生代码会执行的指令: region 本身和它能调到的过程
+    code = set(range(region[0], region[1] + 1))
+    for entry, (ret, _) in _ir_region_procs(buf, region).items():
+        code.update(range(entry, ret + 1))
+    return sorted(code)
+
+
+def ir_region_vars(buf: list[Ir], region: tuple[int, int]) -> set[tuple[int, int]]:
+    # 原生代码里没有 None, 不检查未初始化的变量, 只编译不会读到未初始化变量的 region.
+    # 原生代码调用过程时新建栈帧, 过程体 (包括它调用的内层过程) 读本层变量之前,
+    # 每条路径上都要先赋过值, 否则抛出 RuntimeError.
+    # 返回 region 会读写的解释器栈帧里的变量, 每次进入 region 时它们都要已经有值
+    procs = _ir_region_procs(buf, region)
+
+    # 每个过程和它调用的过程读写的外层变量, 递归调用要迭代到不动点
+    reads = {entry: set() for entry in procs}
+    writes = {entry: set() for entry in procs}
+    changed = True
+    while changed:
+        changed = False
+        for entry, (end, level) in procs.items():
+            r, w = set(), set()
+            for ir in buf[entry:end + 1]:
+                if ir.op == IrOpCode.Call:
+                    r.update(var for var in reads[ir.args] if var[0] < level)
+                    w.update(var for var in writes[ir.args] if var[0] < level)
+                elif (var := _ir_var(ir)) is not None and var[0] < level:
+                    (w if ir.op == IrOpCode.Store else r).add(var)
+            if (r, w) != (reads[entry], writes[entry]):
+                reads[entry], writes[entry] = r, w
+                changed = True
+
+    # 本层的变量: 沿控制流求每条指令之前一定赋过值的 slot, 内层过程读本层变量算在调用处
+    for entry, (end, level) in procs.items():
+        assigned = {entry: frozenset()}
+        pending = [entry]
+        while pending:
+            pc = pending.pop()
+            ir, done = buf[pc], assigned[pc]
+            var = _ir_var(ir)
+            if ir.op == IrOpCode.Call:
+                used = {var[1] for var in reads[ir.args] if var[0] == level}
+            elif var is not None and var[0] == level and ir.op != IrOpCode.Store:
+                used = {var[1]}
+            else:
+                used = set()
+            if not used <= done:
+                raise RuntimeError('region may read an uninitialized variable')
+            elif var is not None and var[0] == level:
+                done = done | {var[1]}
+            if ir.op == IrOpCode.Ret:
+                continue
+
+            succ = [ir.args] if ir.op in IR_BRANCHES and ir.op != IrOpCode.Call else []
+            if ir.op != IrOpCode.Jump:
+                succ.append(pc + 1)
+            for t in succ:
+                if not (entry <= t <= end):
+                    raise RuntimeError('branch out of bounds')
+                new = assigned[t] & done if t in assigned else done
+                if assigned.get(t) != new:
+                    assigned[t] = new
+                    pending.append(t)
+
+    ret = set()
+    for ir in buf[region[0]:region[1] + 1]:
+        if ir.op == IrOpCode.Call:
+            ret |= reads[ir.args] | writes[ir.args]
+        elif (var := _ir_var(ir)) is not None:
+            ret.add(var)
+    return ret
+
+
+def ir_regalloc(buf: list[Ir], region: tuple[int, int] | None = None,
+                pool: tuple = REG_POOL) -> dict[int, 'GeneralPurposeRegister64']:
+    # 线性扫描: 只分配主程序 (level 0) 的变量, 返回 slot -> 寄存器
+    main_end = next((i for i, ir in enumerate(buf) if ir.op == IrOpCode.Halt), len(buf))
+    loops = [(ir.args, i) for i, ir in enumerate(buf)
+             if ir.op in IR_BRANCHES and ir.op != IrOpCode.Call and ir.args <= i]
+
+    # 分层执行时只看原生代码会执行的指令
+    uses = {}
+    for i in range(len(buf)) if region is None else _ir_region_code(buf, region):
+        if (var := _ir_var(buf[i])) is not None and var[0] == 0:
+            uses.setdefault(var[1], []).append(i)
+
+    intervals = []
+    for slot, pos in uses.items():
+        # 过程里用到的变量在任何调用点都活着; 分层执行时 region 外的解释器还要读
+        if region is not None or pos[-1] > main_end:
+            start, end = 0, len(buf)
+        else:
+            start, end = pos[0], pos[-1]
+
+        # 区间和循环相交就要覆盖整个循环, 嵌套循环要反复扩展
+        changed = True
+        while changed:
+            changed = False
+            for s, e in loops:
+                if start <= e and end >= s and (s < start or e > end):
+                    start, end = min(start, s), max(end, e)
+                    changed = True
+
+        weight = sum(10 ** min(sum(s <= p <= e for s, e in loops), 6) for p in pos)
+        intervals.append((start, end, weight, slot))
+
+    ret = {}
+    active = []
+    free = list(pool)
+    for start, end, weight, slot in sorted(intervals):
+        for item in [a for a in active if a[0] < start]:
+            active.remove(item)
+            free.append(ret[item[2]])
+        free.sort(key=pool.index)
+
+        if free:
+            ret[slot] = free.pop(0)
+            active.append((end, weight, slot))
+            continue
+
+        # 寄存器不够时留在内存里的是使用次数 (按循环深度加权) 最少的
+        victim = min(active, key=lambda a: a[1])
+        if victim[1] < weight:
+            active.remove(victim)
+            ret[slot] = ret.pop(victim[2])
+            active.append((end, weight, slot))
+    return ret
+
+
+# 原生代码能实现的整数语义
+NATIVE_INT_MODES = {'wrap', 'trap'}
+
+
+def ir_asm(buf: list[Ir], region: tuple[int, int] | None = None,
+           io: tuple[int, int] | None = None, regalloc: bool = True, vstack: bool = True,
+           ints: str | None = None) -> Callable:
+    # 原生代码只有 int64; 除零和溢出时返回 NATIVE_ERRORS 里的值.
+    # ints 为 None 时解释器的除法得到 float, bigint 不会溢出, 原生代码都对不上
+    if ints not in NATIVE_INT_MODES:
+        raise RuntimeError('native code needs int64 semantics, ints must be wrap or trap')
+    buf = _ir_fix_literals(buf, INT_MODES[ints])
+    trap = ints == 'trap'
+
+    pctab = []
+    labels = [Label('ir%d' % i) for i in range(len(buf) + 1)]
+    exit_label = Label('exit')
+    div_error = Label('div_error')
+    overflow_error = Label('overflow_error')
+    io_error = Label('io_error')
+
+    # rbp 下方依次是: 主程序变量, display 表, scanf 用的临时槽
+    # r13 指向主程序变量, rbx 指向 display 表, display[level] 是该层当前栈帧
+    nslots = 1 + max((ir.args[1] for ir in buf if isinstance(ir.args, tuple) and ir.args[0] == 0), default=-1)
+    maxlevel = max((ir.value.level for ir in buf if ir.op == IrOpCode.Call), default=0)
+    frame_size = (nslots + maxlevel + 2) * 8
+    frame_size += frame_size % 16
+    scratch = MemoryOperand(rbp - (nslots + maxlevel + 2) * 8, 8)
+
+    def display_operand(level: int):
+        return MemoryOperand(rbx + level * 8, 8)
+
+    regs = ir_regalloc(buf, region) if regalloc else {}
+    spills = [reg for reg in REG_POOL if reg in CALLER_SAVED and reg in regs.values()]
+
+    def var_operand(args: tuple[int, int]):
+        level, slot = args
+        if level == 0 and slot in regs:
+            return regs[slot]
+        elif level == 0:
+            return MemoryOperand(r13 + slot * 8, 8)
+        nbuf.append(MOV(rdx, display_operand(level)))
+        return MemoryOperand(rdx + slot * 8, 8)
+
+    # 调外部函数前把 rsp 对齐到 16 字节, 原来的 rsp 存在对齐后的栈顶.
+    # 只有这里需要把 caller-saved 寄存器里的变量溢出到栈上
+    def call_extern(fn: int):
+        for reg in spills:
+            nbuf.append(PUSH(reg))
+        nbuf.append(MOV(r11, rsp))
+        nbuf.append(AND(rsp, -16))
+        nbuf.append(PUSH(r11))
+        nbuf.append(PUSH(r11))
+        nbuf.append(MOV(r11, fn))
+        nbuf.append(XOR(eax, eax))
+        nbuf.append(CALL(r11))
+        nbuf.append(MOV(rsp, [rsp]))
+        for reg in reversed(spills):
+            nbuf.append(POP(reg))
+
+    # 虚拟操作数栈: ('imm', 常数) / ('reg', 临时寄存器) / ('var', 变量), 栈顶在最后.
+    # 只有基本块边界, 调用, 临时寄存器不够的时候才真正压到机器栈上
+    stack = []
+    free = list(SCRATCH)
+    targets = {ir.args for ir in buf if ir.op in IR_BRANCHES}
+
+    def in_memory(e) -> bool:
+        return e[0] == 'var' and not (e[1][0] == 0 and e[1][1] in regs)
+
+    def operand(e):
+        if e[0] == 'var':
+            return var_operand(e[1])
+        return e[1]
+
+    def flush():
+        for e in stack:
+            match e:
+                case ('imm', value) if _imm32(value):
+                    nbuf.append(PUSH(value))
+                case ('imm', value):
+                    nbuf.append(MOV(rdx, value))
+                    nbuf.append(PUSH(rdx))
+                case ('reg', reg):
+                    nbuf.append(PUSH(reg))
+                    free.append(reg)
+                case ('var', args):
+                    nbuf.append(PUSH(var_operand(args)))
+        stack.clear()
+
+    def alloc(avoid=()):
+        for reg in free:
+            if reg not in avoid:
+                free.remove(reg)
+                return reg
+        flush()
+        return alloc(avoid)
+
+    def release(e):
+        if e[0] == 'reg':
+            free.append(e[1])
+
+    def claim(reg):
+        # IDIV 和外部调用的返回值要用 rax, 占着的虚拟栈元素挪到别的寄存器
+        if reg not in free:
+            i = stack.index(('reg', reg))
+            other = alloc((reg,))
+            if reg in free:
+                free.append(other)
+            else:
+                nbuf.append(MOV(other, reg))
+                stack[i] = ('reg', other)
+                free.append(reg)
+        free.remove(reg)
+
+    def pop():
+        if stack:
+            return stack.pop()
+        reg = alloc()
+        nbuf.append(POP(reg))
+        return ('reg', reg)
+
+    def load(e, avoid=()):
+        # 放进一个可以改写的临时寄存器
+        if e[0] == 'reg' and e[1] not in avoid:
+            return e[1]
+        reg = alloc(avoid)
+        nbuf.append(MOV(reg, operand(e)))
+        release(e)
+        return reg
+
+    def narrow(e):
+        # 超过 32 位的立即数只有 MOV 能直接用
+        if e[0] == 'imm' and not _imm32(e[1]):
+            return ('reg', load(e))
+        return e
+
+    def constant(val: int) -> bool:
+        # 编译期算出的常数; trap 模式下溢出的留到运行时报错
+        if trap and not INT64_MIN <= val <= INT64_MAX:
+            return False
+        stack.append(('imm', _s64(val)))
+        return True
+
+    def binary(op: IrOpCode, a, b):
+        if a[0] == b[0] == 'imm':
+            match op:
+                case IrOpCode.Add if constant(a[1] + b[1]): return
+                case IrOpCode.Sub if constant(a[1] - b[1]): return
+                case IrOpCode.Mul if constant(a[1] * b[1]): return
+            a = ('reg', load(a))
+        if op != IrOpCode.Sub and (a[0] == 'imm' or b[0] == 'reg' != a[0]):
+            a, b = b, a
+        b = narrow(b)
+
+        # LEA 不设置标志位, trap 模式下要用 ADD 检查溢出
+        if b[0] == 'imm' and a[0] == 'var' and op == IrOpCode.Add and not in_memory(a) and not trap:
+            reg = alloc()
+            nbuf.append(LEA(reg, [operand(a) + b[1]]))
+        elif b[0] == 'imm' and op == IrOpCode.Mul:
+            reg = alloc() if a[0] != 'reg' else a[1]
+            nbuf.append(IMUL(reg, operand(a), b[1]))
+        else:
+            reg = load(a)
+            match op:
+                case IrOpCode.Add: nbuf.append(ADD(reg, operand(b)))
+                case IrOpCode.Sub: nbuf.append(SUB(reg, operand(b)))
+                case IrOpCode.Mul: nbuf.append(IMUL(reg, operand(b)))
+            release(b)
+        if trap:
+            nbuf.append(JO(overflow_error))
+        stack.append(('reg', reg))
+
+    def compare(a, b, cc: str) -> str | bool:
+        # 两边都是常数时直接返回结果, 否则发出 CMP 返回条件码
+        if a[0] == b[0] == 'imm':
+            return _CC_EVAL[cc](a[1], b[1])
+        if a[0] == 'imm' or in_memory(a) and b[0] == 'reg':
+            a, b, cc = b, a, _CC_SWAP[cc]
+        b = narrow(b)
+        if in_memory(a) and in_memory(b):
+            a = ('reg', load(a))
+        nbuf.append(CMP(operand(a), operand(b)))
+        release(a)
+        release(b)
+        return cc
+
+    def check_target(t):
+        if not isinstance(t, int):
+            raise RuntimeError('invalid branch args')
+        if not (0 <= t <= len(buf)):
+            raise RuntimeError('branch out of bounds')
+
+    def emit(ir: Ir, target: Callable[[int], Label]):
         match ir.op:
-            case IrOpCode.Add:
-                nbuf.append(POP(rax)) # 抛出右值
-                nbuf.append(ADD([rsp], rax)) # 操作内存 加
-            case IrOpCode.Sub:
-                nbuf.append(POP(rax))
-                nbuf.append(SUB([rsp], rax))
-            case IrOpCode.Mul:
-                nbuf.append(POP(rcx))
-                nbuf.append(MOV(rax, [rsp]))
-                nbuf.append(IMUL(rcx))
-                nbuf.append(MOV([rsp], rax))
+            case IrOpCode.Add | IrOpCode.Sub | IrOpCode.Mul:
+                b = pop()
+                binary(ir.op, pop(), b)
             case IrOpCode.Div:
-                nbuf.append(POP(rcx))
-                nbuf.append(MOV(rax, [rsp]))
-                nbuf.append(IDIV(rcx))
-                nbuf.append(MOV([rsp], rax))
+                b = pop()
+                a = pop()
+                # 除数是 0 和 -1 以外的常数时不用检查; IDIV 只接受寄存器, 常数也要先装进寄存器
+                guard = b[0] != 'imm' or b[1] in (0, -1)
+                if b[0] != 'reg' or b[1] == rax:
+                    b = ('reg', load(b, (rax,)))
+                if a != ('reg', rax):
+                    claim(rax)
+                    nbuf.append(MOV(rax, operand(a)))
+                    release(a)
+                if guard:
+                    # 除零跳到错误出口; INT64_MIN / -1 会让 IDIV 触发 #DE, 除以 -1 改用 NEG
+                    neg, done = Label(), Label()
+                    nbuf.append(TEST(b[1], b[1]))
+                    nbuf.append(JZ(div_error))
+                    nbuf.append(CMP(b[1], -1))
+                    nbuf.append(JE(neg))
+                    nbuf.append(CQO())
+                    nbuf.append(IDIV(b[1]))
+                    nbuf.append(JMP(done))
+                    nbuf.append(LABEL(neg))
+                    nbuf.append(NEG(rax))
+                    if trap:
+                        nbuf.append(JO(overflow_error))
+                    nbuf.append(LABEL(done))
+                else:
+                    nbuf.append(CQO())
+                    nbuf.append(IDIV(b[1]))
+                release(b)
+                stack.append(('reg', rax))
             case IrOpCode.Neg:
-                nbuf.append(NEG(MemoryOperand(rax, 8)))
+                a = pop()
+                if a[0] != 'imm' or not constant(-a[1]):
+                    reg = load(a)
+                    nbuf.append(NEG(reg))
+                    if trap:
+                        nbuf.append(JO(overflow_error))
+                    stack.append(('reg', reg))
             case IrOpCode.Eq | IrOpCode.Ne | IrOpCode.Lt | IrOpCode.Lte | IrOpCode.Gt | IrOpCode.Gte:
-                POP(rcx)
-                CMP([rsp], rcx)
-                match ir.op:
-                    case IrOpCode.Eq: nbuf.append(SETE([rsp]))
-                    case IrOpCode.Ne: nbuf.append(SETNE([rsp]))
-                    case IrOpCode.Lt: nbuf.append(SETL([rsp]))
-                    case IrOpCode.Lte: nbuf.append(SETLE([rsp]))
-                    case IrOpCode.Gt: nbuf.append(SETG([rsp]))
-                    case IrOpCode.Gte: nbuf.append(SETGE([rsp]))
+                b = pop()
+                cc = compare(pop(), b, _ASM_CC[ir.op])
+                if isinstance(cc, bool):
+                    stack.append(('imm', int(cc)))
+                else:
+                    # PUSH/MOV 不改标志位, alloc 中途 flush 也没关系
+                    reg = alloc()
+                    nbuf.append(_SETCC[cc](_LOW8[reg]))
+                    nbuf.append(MOVZX(_LOW32[reg], _LOW8[reg]))
+                    stack.append(('reg', reg))
             case IrOpCode.Odd:
-                nbuf.append(AND(MemoryOperand(rsp, 8), 1))
+                a = pop()
+                if a[0] == 'imm':
+                    stack.append(('imm', a[1] & 1))
+                else:
+                    reg = load(a)
+                    nbuf.append(AND(reg, 1))
+                    stack.append(('reg', reg))
             case IrOpCode.LoadVar:
-                if not isinstance(ir.args, str):
+                if not isinstance(ir.args, tuple):
                     raise RuntimeError('invalid loadvar args')
-                elif ir.args in littab:
-                    nbuf.append(MOV(rax, ir.args))
-                    nbuf.append(PUSH(rax))
-                    continue
-                elif ir.args in vartab:
-                    nbuf.append(MOV(rax, [rbp - vartab[ir.args] * 8 - 8]))
-                    nbuf.append(PUSH(rax))
-                else:
-                    raise RuntimeError('undefined variable: ' + ir.args)
+                stack.append(('var', ir.args))
 
             case IrOpCode.LoadLit:
-                if not isinstance(ir.args, str) or not isinstance(ir.value, int):
-                    raise RuntimeError('invalid deflit args')
-                nbuf.append(MOV(rax, ir.args))
-                nbuf.append(PUSH(rax))
+                if not isinstance(ir.args, int):
+                    raise RuntimeError('invalid loadlit args')
+                stack.append(('imm', ir.args))
             case IrOpCode.Store:
-                if not isinstance(ir.args, str):
+                if not isinstance(ir.args, tuple):
                     raise RuntimeError('invalid store args')
-                elif ir.args not in vartab:
-                    raise RuntimeError('undefined variable: ' + ir.args)
-                else:
-                    nbuf.append(POP(rax))
-                    nbuf.append(MOV([rbp - vartab[ir.args] * 8 - 8], rax))
+                a = pop()
+                # 栈里还没取出的旧值要先落地
+                if ('var', ir.args) in stack:
+                    flush()
+                if in_memory(('var', ir.args)):
+                    a = narrow(a)
+                    if in_memory(a):
+                        a = ('reg', load(a))
+                    src = operand(a)
+                    nbuf.append(MOV(var_operand(ir.args), src))
+                elif a != ('var', ir.args):
+                    nbuf.append(MOV(var_operand(ir.args), operand(a)))
+                release(a)
 
             case IrOpCode.Jump:
-                if not isinstance(ir.args, int):
-                    raise RuntimeError('invalid jump args')
-
-                if not (0 <= ir.args < len(buf)):
-                    raise RuntimeError('branch out of bounds')
-
-                nbuf.append(JMP(RIPRelativeOffset(0)))
-                brtab[pc] = ir.args
+                check_target(ir.args)
+                flush()
+                nbuf.append(JMP(target(ir.args)))
 
             case IrOpCode.BrFalse:
-                if not isinstance(ir.args, int):
-                    raise RuntimeError('invalid brfalse args')
+                check_target(ir.args)
+                a = pop()
+                flush()
+                if a[0] == 'imm':
+                    if a[1] == 0:
+                        nbuf.append(JMP(target(ir.args)))
+                    return
+                if in_memory(a):
+                    nbuf.append(CMP(operand(a), 0))
+                else:
+                    nbuf.append(TEST(operand(a), operand(a)))
+                release(a)
+                nbuf.append(JZ(target(ir.args)))
+
+            case IrOpCode.IncVar:
+                var = ir.args[:2]
+                if ('var', var) in stack:
+                    flush()
+                if _imm32(ir.value):
+                    nbuf.append(ADD(var_operand(var), ir.value))
+                else:
+                    reg = load(('imm', ir.value))
+                    nbuf.append(ADD(var_operand(var), reg))
+                    free.append(reg)
+                if trap:
+                    nbuf.append(JO(overflow_error))
+            case IrOpCode.AddVarLit:
+                binary(IrOpCode.Add, ('var', ir.args[:2]), ('imm', ir.value))
+            case IrOpCode.BrIfNotEq | IrOpCode.BrIfNotNe | IrOpCode.BrIfNotLt | \
+                 IrOpCode.BrIfNotLte | IrOpCode.BrIfNotGt | IrOpCode.BrIfNotGte:
+                check_target(ir.args)
+                b = pop()
+                a = pop()
+                flush()
+                cc = compare(a, b, _ASM_CC[ir.op])
+                if cc is False:
+                    nbuf.append(JMP(target(ir.args)))
+                elif cc is not True:
+                    nbuf.append(_JCC[_CC_NOT[cc]](target(ir.args)))
+
+            case IrOpCode.Call:
+                if not isinstance(ir.value, IrProc):
+                    raise RuntimeError('procedure called not existed.')
                 if not (0 <= ir.args < len(buf)):
                     raise RuntimeError('branch out of bounds')
 
-                nbuf.append(POP(rax))
-                nbuf.append(TEST(rax, rax))
-                brtab[pc] = ir.args
-                nbuf.append(JZ(RIPRelativeOffset(0)))
+                # 栈帧由调用方分配, display[level] 指向新帧, 返回后恢复
+                flush()
+                display = display_operand(ir.value.level)
+                nbuf.append(PUSH(display))
+                if ir.value.size:
+                    nbuf.append(SUB(rsp, ir.value.size * 8))
+                nbuf.append(MOV(display, rsp))
+                nbuf.append(CALL(labels[ir.args]))
+                if ir.value.size:
+                    nbuf.append(ADD(rsp, ir.value.size * 8))
+                nbuf.append(POP(display))
+            case IrOpCode.Ret:
+                flush()
+                nbuf.append(RET())
 
-            case IrOpCode.DefVar:
-                if not isinstance(ir.args, str):
-                    raise RuntimeError('invalid defvar args')
-                elif ir.args in littab or ir.args in vartab:
-                    raise RuntimeError('const redeclared: ' + ir.args)
-                else:
-                    vartab[ir.args] = len(vartab)
-
-            case IrOpCode.DefLit:
-                if not isinstance(ir.args, str) or not isinstance(ir.value, int):
-                    raise RuntimeError('invalid deflit args')
-                elif ir.args in littab or ir.args in vartab:
-                    raise RuntimeError('const redeclared: ' + ir.args)
-                else:
-                    littab[ir.args] = ir.value
-
-            case IrOpCode.DefProc:
-                raise NotImplementedError('implement this.') #TODO
             case IrOpCode.Input:
-                pass
+                flush()
+                if io is not None:
+                    # 回调把读到的值写进 scratch, 返回非 0 表示出错
+                    nbuf.append(LEA(rdi, scratch))
+                    call_extern(io[0])
+                    nbuf.append(TEST(rax, rax))
+                    nbuf.append(JNZ(io_error))
+                    nbuf.append(MOV(rax, scratch))
+                else:
+                    nbuf.append(MOV(rdi, ctypes.addressof(fmt_input)))
+                    nbuf.append(LEA(rsi, scratch))
+                    call_extern(fn_scanf)
+                    nbuf.append(MOV(rax, scratch))
+                claim(rax)
+                stack.append(('reg', rax))
             case IrOpCode.Output:
-                nbuf.append(POP(rdi))
-                nbuf.append(MOV(r15, fn_putchar))
-                nbuf.append(CALL(r15))
+                a = pop()
+                flush()
+                arg = rdi if io is not None else rsi
+                if a != ('reg', arg):
+                    nbuf.append(MOV(arg, operand(a)))
+                release(a)
+                if io is not None:
+                    call_extern(io[1])
+                    nbuf.append(TEST(rax, rax))
+                    nbuf.append(JNZ(io_error))
+                else:
+                    nbuf.append(MOV(rdi, ctypes.addressof(fmt_output)))
+                    call_extern(fn_printf)
             case IrOpCode.Halt:
-                break
+                flush()
+                nbuf.append(JMP(labels[len(buf)]))
             case _:
                 raise RuntimeError("invalid instruction.")
-    stack_size = len(vartab) * 8
-    nbuf[nbuf.index(None)] = SUB(rsp, len(vartab) * 8)
+
+        if not vstack:
+            flush()
+
+    nbuf = [
+        PUSH(rbp),
+        MOV(rbp, rsp),
+        SUB(rsp, frame_size),
+        PUSH(rbx),
+        PUSH(r12),
+        PUSH(r13),
+        PUSH(r14),
+        PUSH(r15),
+    ]
+
+    if region is None:
+        nbuf.append(LEA(r13, [rbp - nslots * 8]))
+        nbuf.append(LEA(rbx, [rbp - (nslots + maxlevel + 1) * 8]))
+    else:
+        # 分层执行: rdi 是解释器传进来的 display 表, 从 region 起点开始执行
+        rlabels = {i: Label('r%d' % i) for i in range(region[0], region[1] + 1)}
+        nbuf.append(MOV(rbx, rdi))
+        nbuf.append(MOV(r13, [rbx]))
+        for slot, reg in regs.items():
+            nbuf.append(MOV(reg, [r13 + slot * 8]))
+        nbuf.append(JMP(rlabels[region[0]]))
+
+    # 分层执行时主程序不用生成, 只生成 region 能调到的过程
+    if region is None:
+        code = range(len(buf))
+    else:
+        code = [i for entry, (ret, _) in sorted(_ir_region_procs(buf, region).items()) for i in range(entry, ret + 1)]
+    for i in code:
+        if i in targets:
+            flush()
+        pctab.append(len(nbuf))
+        nbuf.append(LABEL(labels[i]))
+        emit(buf[i], lambda t: labels[t])
+
+    flush()
+    pctab.append(len(nbuf))
+    nbuf.append(LABEL(labels[len(buf)]))
+    nbuf.append(MOV(rax, 0))
+    nbuf.append(JMP(exit_label))
+    nbuf.append(LABEL(div_error))
+    nbuf.append(MOV(rax, NATIVE_DIV_ERROR))
+    nbuf.append(JMP(exit_label))
+    nbuf.append(LABEL(overflow_error))
+    nbuf.append(MOV(rax, NATIVE_OVERFLOW_ERROR))
+    nbuf.append(JMP(exit_label))
+    nbuf.append(LABEL(io_error))
+    nbuf.append(MOV(rax, NATIVE_IO_ERROR))
+    nbuf.append(JMP(exit_label))
+
+    if region is not None:
+        # region 单独再生成一份, 跳出 region 的分支都改成返回目标 pc
+        start, end = region
+        stubs = {}
+
+        def region_target(t: int) -> Label:
+            if t in rlabels:
+                return rlabels[t]
+            return stubs.setdefault(t, Label('x%d' % t))
+
+        for i in range(start, end + 1):
+            if buf[i].op in {IrOpCode.Ret, IrOpCode.Halt}:
+                raise RuntimeError('invalid region')
+            if i in targets:
+                flush()
+            nbuf.append(LABEL(rlabels[i]))
+            emit(buf[i], region_target)
+        flush()
+        nbuf.append(JMP(region_target(end + 1)))
+
+        for t, lab in stubs.items():
+            nbuf.append(LABEL(lab))
+            for slot, reg in regs.items():
+                nbuf.append(MOV([r13 + slot * 8], reg))
+            nbuf.append(MOV(rax, t))
+            nbuf.append(JMP(exit_label))
+
     nbuf.extend([
+        LABEL(exit_label),
+        LEA(rsp, [rbp - frame_size - 40]),
         POP(r15),
-        ADD(rsp, stack_size),
+        POP(r14),
+        POP(r13),
+        POP(r12),
+        POP(rbx),
+        ADD(rsp, frame_size),
         POP(rbp),
         RET()
     ])
 
-    func = Function('pl0_asm', ())
-    func.add_instruction(nbuf)
-    func.finalize(abi.detect()).encode().load()()
+    if region is None:
+        func = Function('pl0_asm', (), uint64_t)
+    else:
+        func = Function('pl0_region', (Argument(uint64_t),), uint64_t)
+    for ins in nbuf:
+        func.add_instruction(ins)
+    return func.finalize(abi.detect()).encode().load()
+
+
+def jit_run(buf: list[Ir], slots: list[int | None], ints: str | None = None):
+    fn = ir_asm(buf, ints=ints)
+    # 原生代码直接调 libc 的 printf/scanf, 先把 pl0_io 里攒着的输出写出去
+    pl0_io.flush()
+    ret = fn()
+    dll.fflush(None)
+    if ret in NATIVE_ERRORS:
+        raise RuntimeError(NATIVE_ERRORS[ret])
+
+
+NATIVE_UNSET = -1 << 63
+
+# I/O 回调返回 0 表示成功; 读到的值写进参数指向的槽
+NativeInput = ctypes.CFUNCTYPE(ctypes.c_int64, ctypes.POINTER(ctypes.c_int64))
+NativeOutput = ctypes.CFUNCTYPE(ctypes.c_int64, ctypes.c_int64)
+
+
+class TierStats:
+    backedges: int
+    calls: int
+    regions: int
+    failures: int
+    fallbacks: int
+    native_entries: int
+    compile_time: float
+    native_time: float
+
+    def __init__(self):
+        self.backedges = 0
+        self.calls = 0
+        self.regions = 0
+        self.failures = 0
+        self.fallbacks = 0
+        self.native_entries = 0
+        self.compile_time = 0.0
+        self.native_time = 0.0
+
+    def __repr__(self) -> str:
+        return 'TierStats(%s)' % ', '.join('%s=%r' % kv for kv in vars(self).items())
+
+
+def ir_tiered(buf: list[Ir], slots: list[int | None],
+              loop_threshold: int = 1000, call_threshold: int = 100, ints: str | None = None) -> TierStats:
+    stats = TierStats()
+    code = ir_compile(buf, ints)
+    counters = {}
+    maxlevel = max((ir.value.level for ir in buf if ir.op == IrOpCode.Call), default=0)
+
+    # 分层执行时 I/O 回调到 Python, 和解释器共用 pl0_io 通道.
+    # 异常不能穿过 ctypes 回调, 先记下来返回非 0, 原生代码退出后再抛出
+    io_errors = []
+
+    def read(ptr) -> int:
+        try:
+            ptr[0] = pl0_io.read()
+        except BaseException as e:
+            io_errors.append(e)
+            return 1
+        return 0
+
+    def write(val: int) -> int:
+        try:
+            pl0_io.write(val)
+        except BaseException as e:
+            io_errors.append(e)
+            return 1
+        return 0
+
+    on_input = NativeInput(read)
+    on_output = NativeOutput(write)
+    io = (
+        ctypes.cast(on_input, ctypes.c_void_p).value,
+        ctypes.cast(on_output, ctypes.c_void_p).value,
+    )
+
+    def native(start: int, end: int, fallback: IrHandler) -> IrHandler:
+        t = time.perf_counter()
+        try:
+            entry_vars = ir_region_vars(buf, (start, end))
+            fn = ir_asm(buf, (start, end), io, ints=ints)
+        except Exception:
+            stats.failures += 1
+            return fallback
+        finally:
+            stats.compile_time += time.perf_counter() - t
+        stats.regions += 1
+
+        def ready(display) -> bool:
+            for level, slot in entry_vars:
+                frame = display[level] if level < len(display) else None
+                if frame is None or slot >= len(frame) or frame[slot] is None:
+                    return False
+            return True
+
+        # 变量搬到 int64 数组里, 未初始化的用 NATIVE_UNSET 表示.
+        # region 要读写的变量还没初始化时这一次解释执行, 原生代码不会碰到 NATIVE_UNSET
+        def handler(sp, display, rstack):
+            if not ready(display):
+                stats.fallbacks += 1
+                return fallback(sp, display, rstack)
+            try:
+                frames = [array('q', [NATIVE_UNSET if v is None else v for v in frame or ()]) for frame in display]
+            except (TypeError, OverflowError):
+                stats.fallbacks += 1
+                return fallback(sp, display, rstack)
+
+            table = array('Q', [frame.buffer_info()[0] for frame in frames])
+            table.extend([0] * (maxlevel + 1 - len(table)))
+
+            t = time.perf_counter()
+            pc = fn(table.buffer_info()[0])
+            stats.native_time += time.perf_counter() - t
+            stats.native_entries += 1
+
+            if io_errors:
+                raise io_errors.pop()
+            if pc in NATIVE_ERRORS:
+                raise RuntimeError(NATIVE_ERRORS[pc])
+            # 原本未初始化的变量原生代码没有碰过, 还原成 None; 其他的可能被算成 INT64_MIN
+            for frame, arr in zip(display, frames):
+                if frame is not None:
+                    frame[:] = [None if old is None else v for old, v in zip(frame, arr)]
+            return pc
+
+        return handler
+
+    def hot_jump(pc: int, target: int) -> IrHandler:
+        def handler(sp, display, rstack):
+            stats.backedges += 1
+            counters[pc] += 1
+            if counters[pc] >= loop_threshold:
+                code[pc] = native(target, pc, lambda sp, display, rstack: target)
+            return target
+
+        counters[pc] = 0
+        return handler
+
+    def hot_call(pc: int, interp: IrHandler) -> IrHandler:
+        entry = buf[pc].args
+
+        def handler(sp, display, rstack):
+            stats.calls += 1
+            counters[entry] += 1
+            if counters[entry] >= call_threshold:
+                code[pc] = native(pc, pc, interp)
+            return interp(sp, display, rstack)
+
+        counters.setdefault(entry, 0)
+        return handler
+
+    # 只有 wrap/trap 有对应的原生代码, 其他模式全程解释执行
+    for pc, ir in enumerate(buf if ints in NATIVE_INT_MODES else ()):
+        if ir.op == IrOpCode.Jump and ir.args <= pc:
+            code[pc] = hot_jump(pc, ir.args)
+        elif ir.op == IrOpCode.Call:
+            code[pc] = hot_call(pc, code[pc])
+
+    ir_run(code, slots)
+    return stats
+
+
+IR_ENGINES = {
+    'eval': ir_eval,
+    'compiled': lambda buf, slots, ints=None: ir_run(ir_compile(buf, ints), slots),
+    'jit': jit_run,
+    'tiered': lambda buf, slots, ints=None: ir_tiered(buf, slots, ints=ints),
+}
+
 
 def main():
-    ps = Parser(Lexer(TEST_PROGRAM))
+    ap = argparse.ArgumentParser()
+    ap.add_argument('src', nargs='?', help='PL/0 source file, runs TEST_PROGRAM if omitted')
+    ap.add_argument('--engine', choices=sorted(IR_ENGINES), default='compiled')
+    ap.add_argument('--jit', dest='engine', action='store_const', const='jit', help='same as --engine jit')
+    ap.add_argument('--loop-threshold', type=int, default=1000, help='back edges before a loop is compiled')
+    ap.add_argument('--call-threshold', type=int, default=100, help='calls before a procedure is compiled')
+    ap.add_argument('--no-fold', action='store_true', help='skip constant folding')
+    ap.add_argument('--no-peephole', action='store_true', help='skip superinstruction fusion')
+    ap.add_argument('--ints', choices=sorted(INT_MODES),
+                    help='int64 semantics with truncating division; on overflow wrap, trap or keep big ints')
+    ap.add_argument('-v', '--verbose', action='store_true')
+    args = ap.parse_args()
+    if args.engine == 'jit' and args.ints not in NATIVE_INT_MODES:
+        ap.error('--engine jit needs --ints wrap or trap')
+
+    if args.src is None:
+        src = TEST_PROGRAM
+    else:
+        with open(args.src) as fp:
+            src = fp.read()
+
+    ps = IterParser(Lexer(src))
     buf = []
     ast = ps.program()
-    ast.gen(buf)
-    ir_eval(buf, AstEvalContext({}, {}, {}))
+    if not args.no_fold:
+        ast, removed = ast_fold(ast, args.ints)
+        if args.verbose:
+            print('fold: removed %d ir instructions' % removed, file=sys.stderr)
+    ast_gen(ast, buf)
+    buf, names = ir_resolve(buf)
+    if not args.no_peephole:
+        n = len(buf)
+        buf = ir_peephole(buf)
+        if args.verbose:
+            print('peephole: %d -> %d ir instructions' % (n, len(buf)), file=sys.stderr)
+    if args.engine == 'tiered':
+        stats = ir_tiered(buf, [None] * len(names), args.loop_threshold, args.call_threshold, args.ints)
+        if args.verbose:
+            print(stats, file=sys.stderr)
+    else:
+        IR_ENGINES[args.engine](buf, [None] * len(names), args.ints)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    try:
+        main()
+    finally:
+        # 出错时也先写出已有的输出, 再打印异常
+        stdio.flush()
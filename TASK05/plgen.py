@@ -0,0 +1,153 @@
+import argparse
+import random
+import sys
+
+# 可调的参数和默认值, suite.py 的 --gen/--scale 也按这里的名字解析
+KNOBS = {
+    'stmts': 50,  # 主程序的语句数, 每个过程按 stmts // (procs + 1) 分配
+    'depth': 3,  # begin/if/while 的最大嵌套层数
+    'parens': 2,  # 表达式里括号的最大嵌套层数
+    'nest': 0.3,  # 还能嵌套时生成复合语句的概率
+    'width': 4,  # 嵌套的 begin 里最多的语句数
+    'procs': 0,  # 过程个数
+    'trips': 10,  # 每个循环的次数
+    'loops': 2,  # 循环的最大嵌套层数, 运行时间大约是 trips ** loops
+    'terms': 3,  # 一个表达式里最多的项数, 括号里的最多 3 项
+    'vars': 8,  # 全局变量个数
+}
+
+# 过程 i 开头调用过程 i - 1, 每 CHAIN 个断开一次, 调用链不会太长, 也没有递归;
+# 主程序调用各条链的末端一次, 每个过程正好执行一次, 运行时间和程序大小成正比
+CHAIN = 4
+
+
+def generate(seed: int = 0, **knobs) -> str:
+    # 生成合法的 PL/0 程序, 同样的 seed 和参数得到同样的程序;
+    # 所有变量先赋值再使用, 除数都是正的常数, 循环计数器只由循环自己修改, 程序一定会结束,
+    # 运算结果可能溢出, 适合 wrap 的整数语义
+    for key in knobs:
+        if key not in KNOBS:
+            raise TypeError('unknown knob ' + key)
+    k = {**KNOBS, **knobs}
+    rnd = random.Random(seed)
+    consts = {'k%d' % i: rnd.randint(1, 9) for i in range(3)}
+
+    def factor(names: list[str], depth: int) -> str:
+        r = rnd.random()
+        if depth > 0 and r < 0.15:
+            return '(' + expression(names, depth - 1, 3) + ')'
+        if r < 0.45:
+            return str(rnd.randint(0, 99))
+        if r < 0.55:
+            return rnd.choice(list(consts))
+        return rnd.choice(names)
+
+    def term(names: list[str], depth: int) -> str:
+        ret = factor(names, depth)
+        r = rnd.random()
+        if r < 0.2:
+            ret += ' * ' + factor(names, depth)
+        elif r < 0.3:
+            ret += ' / ' + rnd.choice([str(rnd.randint(1, 9)), rnd.choice(list(consts))])
+        return ret
+
+    def expression(names: list[str], depth: int, terms: int = 0) -> str:
+        # 括号里的子表达式项数少一些, 否则长度随括号层数指数增长
+        ret = rnd.choice(['', '', '', '-']) + term(names, depth)
+        for _ in range(rnd.randint(1, terms or k['terms']) - 1):
+            ret += rnd.choice([' + ', ' - ']) + term(names, depth)
+        return ret
+
+    def condition(names: list[str]) -> str:
+        if rnd.random() < 0.2:
+            return 'odd ' + expression(names, k['parens'])
+        return '%s %s %s' % (expression(names, k['parens']), rnd.choice(['=', '#', '<', '<=', '>', '>=']), expression(names, k['parens']))
+
+    def statements(scope: dict, n: int, depth: int, loops: int) -> list[str]:
+        # scope: names 可读写的变量, counters 要声明的循环计数器
+        ret = []
+        while n > 0:
+            r = rnd.random()
+            if depth > 0 and r < k['nest']:
+                m = rnd.randint(1, min(n, k['width']))
+                n -= m
+                kind = rnd.random()
+                if kind < 0.3 or loops >= k['loops'] and kind >= 0.6:
+                    body = statements(scope, m, depth - 1, loops)
+                    ret.append('begin\n' + ';\n'.join(body) + '\nend')
+                elif kind < 0.6:
+                    body = statements(scope, m, depth - 1, loops)
+                    ret.append('if %s then begin\n%s\nend' % (condition(scope['names']), ';\n'.join(body)))
+                else:
+                    c = 'c%d_%d' % (scope['id'], len(scope['counters']))
+                    scope['counters'].append(c)
+                    body = statements(scope, m, depth - 1, loops + 1)
+                    body.append('%s := %s + 1' % (c, c))
+                    ret.append('%s := 0;\nwhile %s < %d do begin\n%s\nend' % (c, c, k['trips'], ';\n'.join(body)))
+                continue
+
+            n -= 1
+            r = rnd.random()
+            if r < 0.05 and not loops:
+                ret.append('! ' + rnd.choice(scope['names']))
+            else:
+                ret.append('%s := %s' % (rnd.choice(scope['names']), expression(scope['names'], k['parens'])))
+        return ret
+
+    # 生成器按嵌套层数递归, 层数很多时临时放宽递归限制
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, 4 * (k['depth'] + k['parens']) + 1000))
+    try:
+        glob = ['g%d' % i for i in range(k['vars'])]
+        lines = ['const ' + ', '.join('%s = %d' % kv for kv in consts.items()) + ';']
+        procs = []
+        for i in range(k['procs']):
+            local = ['l%d_%d' % (i + 1, j) for j in range(rnd.randint(1, 2))]
+            scope = {'id': i + 1, 'names': glob + local, 'counters': []}
+            body = ['%s := %s' % (v, rnd.randint(0, 99)) for v in local]
+            if i % CHAIN:
+                body.append('call p%d' % (i - 1))
+            body += statements(scope, max(1, k['stmts'] // (k['procs'] + 1)), k['depth'], 0)
+            procs.append('procedure p%d;\nvar %s;\nbegin\n%s\nend;' % (i, ', '.join(local + scope['counters']), ';\n'.join(body)))
+
+        ends = ['p%d' % i for i in range(k['procs']) if i % CHAIN == CHAIN - 1 or i == k['procs'] - 1]
+        top = {'id': 0, 'names': glob, 'counters': []}
+        body = ['%s := %d' % (v, rnd.randint(0, 99)) for v in glob]
+        body += ['call ' + p for p in ends]
+        body += statements(top, k['stmts'], k['depth'], 0)
+        body += ['! ' + v for v in glob]
+    finally:
+        sys.setrecursionlimit(limit)
+
+    lines.append('var %s;' % ', '.join(glob + top['counters']))
+    lines += procs
+    lines.append('begin\n%s\nend.\n' % ';\n'.join(body))
+    return '\n'.join(lines)
+
+
+def parse_knobs(spec: str) -> dict:
+    # "stmts=1000,depth=5" -> {'stmts': 1000, 'depth': 5}
+    ret = {}
+    for item in filter(None, spec.split(',')):
+        key, _, val = item.partition('=')
+        if key not in KNOBS:
+            raise ValueError('unknown knob ' + key)
+        ret[key] = type(KNOBS[key])(val)
+    return ret
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('knobs', nargs='?', default='', help='comma separated knob=value, from %s' % ', '.join(KNOBS))
+    ap.add_argument('--seed', type=int, default=0)
+    args = ap.parse_args()
+
+    try:
+        knobs = parse_knobs(args.knobs)
+    except ValueError as e:
+        ap.error(str(e))
+    sys.stdout.write(generate(args.seed, **knobs))
+
+
+if __name__ == '__main__':
+    main()
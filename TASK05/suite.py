@@ -0,0 +1,304 @@
+import argparse
+import collections
+import contextlib
+import glob
+import hashlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import plgen
+from pl import (
+    INT_MODES, NATIVE_ERRORS, AstEvalContext, IterParser, Lexer, TokenKind, ast_fold, ast_gen, dll, ir_asm, ir_compile,
+    ir_eval, ir_peephole, ir_resolve, ir_run, ir_tiered, stdio,
+)
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+
+def _tree(ast, buf, names, ints):
+    return lambda: ast.eval(AstEvalContext({}, {}, {}, ints))
+
+
+def _eval(ast, buf, names, ints):
+    return lambda: ir_eval(buf, [None] * len(names), ints)
+
+
+def _compiled(ast, buf, names, ints):
+    code = ir_compile(buf, ints)
+    return lambda: ir_run(code, [None] * len(names))
+
+
+def _jit(ast, buf, names, ints):
+    fn = ir_asm(buf, ints=ints)
+
+    def run():
+        ret = fn()
+        if ret in NATIVE_ERRORS:
+            raise RuntimeError(NATIVE_ERRORS[ret])
+    return run
+
+
+def _tiered(ast, buf, names, ints):
+    return lambda: ir_tiered(buf, [None] * len(names), ints=ints)
+
+
+# 引擎名 -> 准备函数, 准备 (编译) 的耗时单独计入 prepare 阶段, 返回的函数执行一遍程序
+ENGINES = {
+    'tree': _tree,
+    'eval': _eval,
+    'compiled': _compiled,
+    'jit': _jit,
+    'tiered': _tiered,
+}
+
+
+def load_corpus(paths: list[str]) -> dict[str, str]:
+    if not paths:
+        paths = sorted(glob.glob(os.path.join(CORPUS, '*.pl0')))
+    ret = {}
+    for path in paths:
+        if not os.path.exists(path):
+            path = os.path.join(CORPUS, path + '.pl0')
+        with open(path) as fp:
+            ret[os.path.splitext(os.path.basename(path))[0]] = fp.read()
+    return ret
+
+
+def lex(src: str) -> int:
+    lx = Lexer(src)
+    n = 0
+    while lx.next().ty != TokenKind.Eof:
+        n += 1
+    return n
+
+
+def gen(ast) -> tuple[list, list[str]]:
+    buf = []
+    ast_gen(ast, buf)
+    buf, names = ir_resolve(buf)
+    return ir_peephole(buf), names
+
+
+@contextlib.contextmanager
+def captured():
+    # 在 fd 层重定向 stdout, 原生代码里 printf 的输出也能收到
+    out = []
+    stdio.flush()
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with tempfile.TemporaryFile() as fp:
+        os.dup2(fp.fileno(), 1)
+        try:
+            yield out
+        finally:
+            stdio.flush()
+            sys.stdout.flush()
+            dll.fflush(None)
+            os.dup2(saved, 1)
+            os.close(saved)
+            fp.seek(0)
+            out.append(fp.read())
+
+
+def measure(fn, warmup: int, repeat: int) -> list[float]:
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def peak_memory(fn) -> int:
+    # 单独再跑一遍, tracemalloc 会拖慢执行, 不能和计时放在一起
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def summary(times: list[float]) -> dict:
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.fmean(times),
+        'samples': times,
+    }
+
+
+def bench_program(name: str, src: str, engines: list[str], ints: str | None,
+                  warmup: int, repeat: int, memory: bool = False) -> dict[str, dict]:
+    # 结果的键是 "程序/阶段" 或 "程序/阶段:引擎"; memory 为真时另外记录每个阶段的内存峰值 (字节)
+    ret = {}
+
+    def phase(key: str, fn, **extra):
+        ret['%s/%s' % (name, key)] = {**summary(measure(fn, warmup, repeat)), **extra}
+        if memory:
+            ret['%s/%s' % (name, key)]['peak'] = peak_memory(fn)
+
+    try:
+        phase('lex', lambda: lex(src), tokens=lex(src), bytes=len(src))
+        # IterParser 边解析边调用 Lexer, 所以 parse 包含词法分析
+        phase('parse', lambda: IterParser(Lexer(src)).program())
+        ast = IterParser(Lexer(src)).program()
+        phase('fold', lambda: ast_fold(ast, ints))
+        ast, _ = ast_fold(ast, ints)
+        phase('gen', lambda: gen(ast))
+        buf, names = gen(ast)
+    except SyntaxError as e:
+        ret['%s/frontend' % name] = {'error': '%s: %s' % (type(e).__name__, e)}
+        return ret
+
+    outputs = {}
+    for engine in engines:
+        try:
+            with captured():
+                run = ENGINES[engine](ast, buf, names, ints)
+                phase('prepare:' + engine, lambda: ENGINES[engine](ast, buf, names, ints))
+                with captured() as out:
+                    run()
+                phase('run:' + engine, run)
+        except (RuntimeError, AssertionError) as e:
+            ret['%s/run:%s' % (name, engine)] = {'error': str(e)}
+            continue
+        outputs[engine] = hashlib.md5(out[0]).hexdigest()
+
+    # 各引擎的输出应该一致, 和多数不同的在结果里标出来
+    expect = collections.Counter(outputs.values()).most_common(1)[0][0] if outputs else None
+    for engine, digest in outputs.items():
+        ret['%s/run:%s' % (name, engine)]['output'] = digest
+        if digest != expect:
+            ret['%s/run:%s' % (name, engine)]['mismatch'] = True
+    return ret
+
+
+def print_results(results: dict[str, dict]):
+    for key, rec in results.items():
+        if 'error' in rec:
+            print('%-28s %s' % (key, 'error: ' + rec['error']))
+        else:
+            print('%-28s %10.3f ms  (median %.3f ms)%s%s' % (
+                key, rec['min'] * 1e3, rec['median'] * 1e3,
+                '  peak %.1f KB' % (rec['peak'] / 1024) if 'peak' in rec else '',
+                '  OUTPUT MISMATCH' if rec.get('mismatch') else '',
+            ))
+
+
+def print_scaling(results: dict[str, dict], names: list[str], knob: str, values: list):
+    # 每个阶段一行, 每个参数值一列, 方便看耗时和内存随输入规模的增长
+    phases = list(dict.fromkeys(key.split('/', 1)[1] for key in results if key.split('/', 1)[0] in names))
+    print('%-20s' % knob + ''.join('%14s' % v for v in values))
+    for p in phases:
+        recs = [results.get('%s/%s' % (name, p), {}) for name in names]
+        print('%-20s' % p + ''.join('%11.3f ms' % (r['min'] * 1e3) if 'min' in r else '%14s' % '-' for r in recs))
+        if any('peak' in r for r in recs):
+            print('%-20s' % '  peak' + ''.join('%11.1f KB' % (r['peak'] / 1024) if 'peak' in r else '%14s' % '-' for r in recs))
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], threshold: float, floor: float) -> int:
+    # 按最小值比较, 超过阈值的记为回退, 返回回退的个数; 短于 floor 秒的只是噪声, 不参与判断
+    regressions = 0
+    for key, rec in results.items():
+        base = baseline.get(key)
+        if base is None or 'min' not in base or 'min' not in rec:
+            continue
+        ratio = rec['min'] / base['min'] if base['min'] > 0 else float('inf')
+        flag = ''
+        if max(rec['min'], base['min']) < floor:
+            pass
+        elif ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif ratio < 1 - threshold:
+            flag = 'faster'
+        print('%-28s %10.3f ms -> %10.3f ms  x%.2f  %s' % (key, base['min'] * 1e3, rec['min'] * 1e3, ratio, flag))
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('programs', nargs='*', help='corpus names or .pl0 files, the whole corpus if omitted')
+    ap.add_argument('--engines', default=','.join(ENGINES), help='comma separated, from %s' % ', '.join(ENGINES))
+    ap.add_argument('--ints', choices=sorted(INT_MODES), default='wrap', help='integer semantics, the jit needs wrap or trap')
+    ap.add_argument('--warmup', type=int, default=1)
+    ap.add_argument('--repeat', type=int, default=5)
+    ap.add_argument('--json', metavar='FILE', help='write results to FILE')
+    ap.add_argument('--compare', metavar='FILE', help='compare against a baseline written by --json')
+    ap.add_argument('--threshold', type=float, default=0.1, help='relative slowdown reported as a regression')
+    ap.add_argument('--floor', type=float, default=0.1, metavar='MS', help='ignore timings shorter than this in --compare')
+    ap.add_argument('--gen', metavar='KNOBS', help='benchmark a generated program, knobs like stmts=1000,procs=10 (see plgen.py)')
+    ap.add_argument('--scale', metavar='KNOB=V1,V2,...', help='benchmark generated programs with KNOB taking each value')
+    ap.add_argument('--seed', type=int, default=0, help='seed for generated programs')
+    ap.add_argument('--memory', action='store_true', help='also record peak memory of each phase, implied by --scale')
+    args = ap.parse_args()
+
+    engines = args.engines.split(',')
+    for engine in engines:
+        if engine not in ENGINES:
+            ap.error('unknown engine ' + engine)
+
+    programs = {}
+    scaling = None
+    if args.programs or args.gen is None and args.scale is None:
+        programs.update(load_corpus(args.programs))
+    try:
+        knobs = plgen.parse_knobs(args.gen or '')
+        if args.scale is not None:
+            knob, _, values = args.scale.partition('=')
+            values = [plgen.parse_knobs('%s=%s' % (knob, v))[knob] for v in values.split(',')]
+            names = ['gen:%s=%s' % (knob, v) for v in values]
+            for name, v in zip(names, values):
+                programs[name] = plgen.generate(args.seed, **{**knobs, knob: v})
+            scaling = knob, values, names
+        elif args.gen is not None:
+            programs['gen'] = plgen.generate(args.seed, **knobs)
+    except ValueError as e:
+        ap.error(str(e))
+
+    results = {}
+    for name, src in programs.items():
+        results.update(bench_program(name, src, engines, args.ints, args.warmup, args.repeat,
+                                     args.memory or scaling is not None))
+    print_results(results)
+    if scaling is not None:
+        knob, values, names = scaling
+        print()
+        print_scaling(results, names, knob, values)
+
+    if args.json is not None:
+        with open(args.json, 'w') as fp:
+            json.dump({
+                'meta': {
+                    'python': platform.python_version(),
+                    'machine': platform.machine(),
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'ints': args.ints,
+                    'warmup': args.warmup,
+                    'repeat': args.repeat,
+                    'seed': args.seed,
+                    'gen': args.gen,
+                    'scale': args.scale,
+                },
+                'results': results,
+            }, fp, indent=1)
+
+    if args.compare is not None:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)['results']
+        print()
+        if compare(results, baseline, args.threshold, args.floor / 1e3):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import os
+import sys
+
+import pytest
+
+import plgen
+from pl import compile_program, io_channel, ir_tiered
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+# 循环和过程里的除法, 旧语义下得到 float
+DIVIDE = '''
+var x, y, i;
+procedure half;
+    begin y := x / 2; !y; y := 0 end;
+begin
+    x := 7;
+    i := 0;
+    while i < 3 do
+    begin
+        call half;
+        x := x * 3;
+        i := i + 1
+    end;
+    !x
+end.
+'''
+
+# 循环里读未初始化的全局变量, 过程里读未初始化的局部变量, 以及真正等于 INT64_MIN 的值
+UNSET_GLOBAL = 'var i, x, y; begin i := 0; while i < 5 do begin if i = 3 then x := y + 1; i := i + 1 end end.'
+UNSET_LOCAL = '''
+var n;
+procedure p;
+    var q;
+    begin if n = 3 then !q; q := n end;
+begin n := 0; while n < 5 do begin call p; n := n + 1 end end.
+'''
+INT64_MIN = '''
+var x, i;
+begin
+    i := 0;
+    while i < 3 do begin if i = 1 then x := -9223372036854775807 - 1; i := i + 1 end;
+    !x
+end.
+'''
+
+# 门限为 1 时每个循环和过程都编译成原生代码, 门限无穷大时全程解释执行, 两者输出必须一样
+PROGRAMS = [
+    *(pytest.param(name, id=name) for name in ('calls.pl0', 'fib.pl0', 'primes.pl0')),
+    *(pytest.param(seed, id='gen%d' % seed) for seed in range(4)),
+    pytest.param(DIVIDE, id='divide'),
+    pytest.param(UNSET_GLOBAL, id='unset-global'),
+    pytest.param(UNSET_LOCAL, id='unset-local'),
+    pytest.param(INT64_MIN, id='int64-min'),
+]
+
+
+def _load(program) -> str:
+    if isinstance(program, int):
+        return plgen.generate(program, stmts=30, procs=6, trips=5)
+    if not program.endswith('.pl0'):
+        return program
+    with open(os.path.join(CORPUS, program)) as fp:
+        return fp.read()
+
+
+def _run(src: str, ints: str | None, threshold: int, fold: bool = True) -> tuple[list[int], str | None]:
+    buf, names = compile_program(src, fold, ints=ints)
+    out = []
+    error = None
+    try:
+        with io_channel([], out.append):
+            ir_tiered(buf, [None] * len(names), threshold, threshold, ints)
+    except Exception as e:
+        # 旧语义下除法得到 float, 之后的 odd 会报 TypeError, 两边也要一致
+        error = repr(e)
+    return out, error
+
+
+@pytest.mark.parametrize('ints', ['wrap', 'trap', None])
+@pytest.mark.parametrize('program', PROGRAMS)
+def test_threshold(program, ints):
+    src = _load(program)
+    assert _run(src, ints, 1) == _run(src, ints, sys.maxsize)
+
+
+# trap 语义下折叠不能改变是否溢出, 包括永远不会执行到的溢出常量
+TRAP_FOLD = [
+    'var a, b, c; begin a := 9223372036854775807; b := 1; c := 1; a := a - b + c; !a end.',
+    'var a; begin a := 9223372036854775807; a := (a + 1) - 1; !a end.',
+    'var a, i; begin a := 1; i := 0; while i < 3 do begin if a > 5 then a := 9223372036854775807 + 1; i := i + 1 end; !a end.',
+]
+
+
+@pytest.mark.parametrize('threshold', [1, sys.maxsize])
+@pytest.mark.parametrize('src', TRAP_FOLD)
+def test_fold_trap(src, threshold):
+    assert _run(src, 'trap', threshold) == _run(src, 'trap', threshold, fold=False)
+
+
+def test_input_error():
+    # 原生代码里 ? 读不到输入时, 回调里的异常要在原生代码返回后原样抛出
+    src = 'var n, i; begin i := 0; while i < 3 do begin ?n; !n; i := i + 1 end end.'
+    buf, names = compile_program(src, ints='wrap')
+    out = []
+    with pytest.raises(EOFError), io_channel([4, 5], out.append):
+        ir_tiered(buf, [None] * len(names), 1, 1, 'wrap')
+    assert out == [4, 5]
+
+
+@pytest.mark.parametrize('name', ['calls.pl0', 'fib.pl0', 'primes.pl0'])
+def test_native_entries(name):
+    # 初始化检查不能让正常的程序都退回解释执行
+    buf, names = compile_program(_load(name), ints='wrap')
+    with io_channel([], lambda val: None):
+        stats = ir_tiered(buf, [None] * len(names), 1, 1, 'wrap')
+    assert stats.native_entries > 0 and stats.failures == 0